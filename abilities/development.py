@@ -4,12 +4,29 @@ import asyncio
 import io
 import subprocess
 import sys
+import tracemalloc
+from datetime import datetime, timezone
 from pathlib import Path
 
 from discord import File, Interaction, Object, app_commands
 
-from bot import client, tree
+from bot import client, sync_command_tree, tree
 from config import dev_guild_id
+from loop_monitor import lag_histogram
+from loop_monitor import monitor as loop_monitor
+from tracing import export_chrome_trace, recent_traces, stage_summaries
+
+from .music.song_player import SongPlayer
+from .music.streaming import loudness, processes, youtube
+from .music.streaming.broadcast import Broadcast
+from .music.streaming.encoder_settings import LEVELS, OPUS_AUTO, host_load
+from .music.streaming.spotify import SpotifyTrackMetadata
+
+TRACEMALLOC_FRAMES = 10
+TRACEMALLOC_TOP = 25
+
+# what `/memory diff` compares against
+memory_baseline: tracemalloc.Snapshot | None = None
 
 
 @tree.command(
@@ -65,6 +82,26 @@ async def reboot(interaction: Interaction) -> None:
         )
 
 
+@tree.command(
+    name="sync-commands",
+    description="Syncs the command tree with Discord.",
+    guild=Object(dev_guild_id),
+)
+@app_commands.describe(force="Sync even if no command definitions have changed.")
+async def sync_commands(interaction: Interaction, force: bool = False) -> None:
+    await interaction.response.defer(ephemeral=True)
+
+    synced = await sync_command_tree(force=force)
+
+    await interaction.followup.send(
+        (
+            f"Synced commands for {', '.join(synced)}."
+            if synced
+            else "Commands are already up to date."
+        ),
+    )
+
+
 LOG_FILES = [
     Path("cron") / "stdout.log",
     Path("cron") / "stderr.log",
@@ -99,3 +136,253 @@ async def view_logs(interaction: Interaction, line_count: int | None = None) ->
             files.append(File(io.BytesIO(data), filename=log_file.name))
 
     await interaction.followup.send(files=files)
+
+
+@tree.command(
+    name="loop-lag",
+    description="Reports event loop lag and recent slow callbacks.",
+    guild=Object(dev_guild_id),
+)
+@app_commands.choices(
+    monitor=[
+        app_commands.Choice(name="Start", value="start"),
+        app_commands.Choice(name="Stop", value="stop"),
+    ],
+)
+async def loop_lag(interaction: Interaction, monitor: str | None = None) -> None:
+    if monitor == "start":
+        loop_monitor.start(asyncio.get_running_loop())
+    elif monitor == "stop":
+        loop_monitor.stop()
+
+    lines = [
+        f"Monitor is {'running' if loop_monitor.running else 'stopped'}.",
+        f"Samples: {lag_histogram.count}",
+        *(
+            f"{name}: {seconds * 1000:.1f} ms"
+            for name, seconds in lag_histogram.summary().items()
+        ),
+        f"Slow callbacks (> {loop_monitor.slow_callback_threshold * 1000:.0f} ms): {len(loop_monitor.slow_callbacks)} recent",
+    ]
+
+    stacks = "\n\n".join(
+        f"{datetime.fromtimestamp(slow.started_at, timezone.utc).isoformat()} blocked for {slow.duration * 1000:.0f} ms\n{slow.stack}"
+        for slow in loop_monitor.slow_callbacks
+    )
+
+    await interaction.response.send_message(
+        "\n".join(lines),
+        files=(
+            [File(io.BytesIO(stacks.encode()), filename="slow_callbacks.txt")]
+            if stacks
+            else []
+        ),
+        ephemeral=True,
+    )
+
+
+@tree.command(
+    name="audio-stats",
+    description="Shows the encoder level and processing time of each audio stream.",
+    guild=Object(dev_guild_id),
+)
+async def audio_stats(interaction: Interaction) -> None:
+    lines = [f"Host load: {host_load():.0%} per CPU"]
+
+    for guild_id, song_player in SongPlayer.song_player_by_guild.items():
+        if not (queued := song_player.currently_playing):
+            continue
+
+        settings = queued.song.stream.encoder_settings
+        level = settings.level
+        lines.append(
+            f"`{guild_id}`: level {settings.level_index}/{len(LEVELS) - 1} "
+            f"(complexity {level.complexity}, "
+            f"bitrate {'auto' if level.bitrate == OPUS_AUTO else f'{level.bitrate // 1000} kbps'}), "
+            f"{settings.average_processing_time * 1000:.2f} ms per packet",
+        )
+
+    if len(lines) == 1:
+        lines.append("Nothing is playing.")
+
+    await interaction.response.send_message("\n".join(lines), ephemeral=True)
+
+
+@tree.command(
+    name="processes",
+    description="Shows the subprocesses started for songs and open file descriptors.",
+    guild=Object(dev_guild_id),
+)
+@app_commands.describe(reap="Reap exited processes now instead of waiting.")
+async def processes_command(interaction: Interaction, reap: bool = False) -> None:
+    lines = []
+    if reap:
+        lines.append(f"Reaped {processes.reap()} processes.")
+
+    file_descriptors = processes.open_file_descriptor_count()
+    lines.append(
+        f"Open file descriptors: {'unknown' if file_descriptors is None else file_descriptors}",
+    )
+    lines.append(f"Leaked processes: {processes.leaked_counter.value():.0f}")
+
+    counts = processes.process_counts()
+    lines.extend(
+        f"{description}: {count}" for description, count in sorted(counts.items())
+    )
+    if not counts:
+        lines.append("No processes are being tracked.")
+
+    await interaction.response.send_message("\n".join(lines), ephemeral=True)
+
+
+def resident_memory() -> int | None:
+    """
+    The bot's resident set size in bytes. Only available on Linux.
+    """
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+
+    return None
+
+
+def format_bytes(size: float) -> str:
+    for unit in ("B", "KiB", "MiB"):
+        if abs(size) < 1024:
+            return f"{size:.1f} {unit}"
+        size /= 1024
+
+    return f"{size:.1f} GiB"
+
+
+def take_memory_snapshot() -> tracemalloc.Snapshot:
+    return tracemalloc.take_snapshot().filter_traces(
+        (
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap*>"),
+        ),
+    )
+
+
+@tree.command(
+    description="Shows memory usage by guild and cache, or compares tracemalloc snapshots.",
+    guild=Object(dev_guild_id),
+)
+@app_commands.choices(
+    action=[
+        app_commands.Choice(name="Snapshot", value="snapshot"),
+        app_commands.Choice(name="Diff", value="diff"),
+        app_commands.Choice(name="Stop Tracing", value="stop"),
+    ],
+)
+async def memory(interaction: Interaction, action: str | None = None) -> None:
+    global memory_baseline  # noqa: PLW0603
+
+    if action == "stop":
+        tracemalloc.stop()
+        memory_baseline = None
+        await interaction.response.send_message("Stopped tracing.", ephemeral=True)
+        return
+
+    if action == "snapshot":
+        if not tracemalloc.is_tracing():
+            # Only allocations made from now on will show up
+            tracemalloc.start(TRACEMALLOC_FRAMES)
+
+        await interaction.response.defer(ephemeral=True)
+        memory_baseline = await asyncio.to_thread(take_memory_snapshot)
+        traced, _ = tracemalloc.get_traced_memory()
+        await interaction.followup.send(
+            f"Took a snapshot ({format_bytes(traced)} traced). Use `/memory diff` later to see what grew.",
+            ephemeral=True,
+        )
+        return
+
+    if action == "diff":
+        if not memory_baseline:
+            await interaction.response.send_message(
+                "Take a snapshot first.",
+                ephemeral=True,
+            )
+            return
+
+        await interaction.response.defer(ephemeral=True)
+        snapshot = await asyncio.to_thread(take_memory_snapshot)
+        differences = snapshot.compare_to(memory_baseline, "traceback")
+        report = "\n\n".join(
+            f"{format_bytes(difference.size_diff)} in {difference.count_diff:+} blocks\n"
+            + "\n".join(difference.traceback.format())
+            for difference in differences[:TRACEMALLOC_TOP]
+        )
+        await interaction.followup.send(
+            "\n".join(
+                f"{format_bytes(difference.size_diff)}: {difference.traceback[0]}"
+                for difference in differences[:5]
+            )
+            or "Nothing changed.",
+            files=[File(io.BytesIO(report.encode()), filename="memory_diff.txt")],
+            ephemeral=True,
+        )
+        return
+
+    rss = resident_memory()
+    broadcasts = list(Broadcast.instances)
+    buffered_bytes = sum(broadcast.buffered_bytes for broadcast in broadcasts)
+    lines = [
+        f"Resident memory: {'unknown' if rss is None else format_bytes(rss)}",
+        f"Buffered packets: {format_bytes(buffered_bytes)} in {len(broadcasts)} broadcasts",
+        f"Spotify track cache: {len(SpotifyTrackMetadata.cache)} tracks",
+        f"Live songs: {len(youtube.live_songs)}",
+        f"Loudness index: {len(loudness.measured_videos())} videos",
+        f"Song players: {len(SongPlayer.song_player_by_guild)}",
+    ]
+    for guild_id, song_player in SongPlayer.song_player_by_guild.items():
+        usage = song_player.memory_usage()
+        lines.append(
+            f"`{guild_id}`: {len(song_player.queued_songs)} songs, "
+            + ", ".join(f"{format_bytes(size)} {name}" for name, size in usage.items()),
+        )
+
+    await interaction.response.send_message("\n".join(lines)[:2000], ephemeral=True)
+
+
+@tree.command(
+    name="play-traces",
+    description="Shows where `/play` spends its time and exports recent traces.",
+    guild=Object(dev_guild_id),
+)
+async def play_traces(interaction: Interaction) -> None:
+    traces = list(recent_traces)
+    summaries = stage_summaries("play")
+    if not summaries:
+        await interaction.response.send_message(
+            "No `/play` commands have been traced yet.",
+            ephemeral=True,
+        )
+        return
+
+    lines = [f"Stage percentiles (p50 / p90 / p99) from {len(traces)} recent traces:"]
+    for stage, summary in sorted(
+        summaries.items(),
+        key=lambda item: -item[1]["p90"],
+    ):
+        lines.append(
+            f"{stage}: "
+            + " / ".join(f"{seconds * 1000:.0f}" for seconds in summary.values())
+            + " ms",
+        )
+
+    await interaction.response.send_message(
+        "\n".join(lines),
+        files=[
+            File(
+                io.BytesIO(export_chrome_trace(traces).encode()),
+                filename="play_traces.json",
+            ),
+        ],
+        ephemeral=True,
+    )
@@ -0,0 +1,148 @@
+"""
+Admission control for `/play`.
+
+Every `/play` looks its song up and, unless that song is already streaming,
+starts a pipeline for it, so requests are checked against global and per-guild
+limits on lookups, queued songs and running pipelines before any work is done,
+and refused immediately when the bot is at capacity.
+"""
+
+from __future__ import annotations
+
+from collections import Counter
+from types import TracebackType
+
+import metrics
+from config import (
+    max_pipelines,
+    max_pipelines_per_guild,
+    max_queued_songs,
+    max_queued_songs_per_guild,
+    max_resolutions,
+    max_resolutions_per_guild,
+)
+
+from .song_player import SongPlayer
+from .streaming.broadcast import BroadcastAudioSource, active_pipelines
+
+rejected_counter = metrics.counter(
+    "play_requests_rejected_total",
+    "Number of `/play` requests refused, by the limit that was reached.",
+    label_name="reason",
+)
+resolutions_gauge = metrics.gauge(
+    "song_resolutions_in_flight",
+    "Number of songs currently being looked up and started.",
+)
+
+resolutions_by_guild: Counter[int] = Counter()
+
+
+class OverCapacity(Exception):
+    """The message is meant to be shown to the user."""
+
+
+def guild_pipeline_count(song_player: SongPlayer | None) -> int:
+    """
+    Number of still downloading pipelines that a guild's queue is holding on to.
+    """
+    if not song_player:
+        return 0
+
+    return sum(
+        isinstance(queued.song.stream, BroadcastAudioSource)
+        and queued.song.stream.broadcast.pipeline_active
+        for queued in song_player.queued_songs
+    )
+
+
+def check_capacity(guild_id: int) -> None:
+    """
+    Raises `OverCapacity` if another song can't be added to `guild_id`'s queue.
+    Songs which are still being looked up count towards every limit, since
+    each of them will soon be queued with a pipeline of its own.
+    """
+    song_player = SongPlayer.song_player_by_guild.get(guild_id)
+    guild_resolutions = resolutions_by_guild[guild_id]
+    total_resolutions = resolutions_gauge.value()
+    guild_queued_songs = len(song_player.queued_songs) if song_player else 0
+    total_queued_songs = sum(
+        len(player.queued_songs) for player in SongPlayer.song_player_by_guild.values()
+    )
+
+    limits = [
+        (
+            "guild_resolutions",
+            guild_resolutions >= max_resolutions_per_guild,
+            "I'm still looking up your other songs, please wait a moment.",
+        ),
+        (
+            "resolutions",
+            total_resolutions >= max_resolutions,
+            "I'm looking up too many songs right now, please try again shortly.",
+        ),
+        (
+            "guild_queued_songs",
+            guild_queued_songs + guild_resolutions >= max_queued_songs_per_guild,
+            f"The queue is full ({max_queued_songs_per_guild} songs).",
+        ),
+        (
+            "queued_songs",
+            total_queued_songs + total_resolutions >= max_queued_songs,
+            "I'm at capacity right now, please try again later.",
+        ),
+        (
+            "guild_pipelines",
+            guild_pipeline_count(song_player) + guild_resolutions
+            >= max_pipelines_per_guild,
+            "Too many songs in the queue are still downloading, please try again shortly.",
+        ),
+        (
+            "pipelines",
+            active_pipelines.value() + total_resolutions >= max_pipelines,
+            "I'm at capacity right now, please try again later.",
+        ),
+    ]
+
+    for reason, exceeded, message in limits:
+        if exceeded:
+            rejected_counter.inc(label=reason)
+            raise OverCapacity(message)
+
+
+class Admission:
+    """
+    Holds a guild's place among the in flight resolutions until it's exited,
+    by which point the song has either been queued or failed.
+    """
+
+    def __init__(self: Admission, guild_id: int) -> None:
+        self.guild_id = guild_id
+
+    def __enter__(self: Admission) -> Admission:
+        return self
+
+    def __exit__(
+        self: Admission,
+        exc_type: type[BaseException] | None,
+        exc_value: BaseException | None,
+        traceback: TracebackType | None,
+    ) -> None:
+        resolutions_by_guild[self.guild_id] -= 1
+        if resolutions_by_guild[self.guild_id] <= 0:
+            del resolutions_by_guild[self.guild_id]
+
+        resolutions_gauge.dec()
+
+
+def admit(guild_id: int) -> Admission:
+    """
+    Raises `OverCapacity` if the request should be refused.
+    Otherwise, the returned `Admission` must be used as a context manager
+    around looking up and queueing the song.
+    """
+    check_capacity(guild_id)
+
+    resolutions_by_guild[guild_id] += 1
+    resolutions_gauge.inc()
+    return Admission(guild_id)
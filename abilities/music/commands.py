@@ -1,26 +1,64 @@
 from __future__ import annotations
 
+import asyncio
+import re
+from typing import TYPE_CHECKING, Awaitable, Callable
+
 import discord
 from discord import Interaction, app_commands
 
 from bot import tree
+from config import max_resolutions_per_guild
+from tracing import span, start_trace
 
 from . import ui
+from .admission import OverCapacity, admit
 from .song_player import SongPlayer
-from .streaming import spotify, youtube
+from .streaming import direct, spotify, youtube
+from .streaming.broadcast import Station, StationSong
+
+if TYPE_CHECKING:
+    from discord.member import VocalGuildChannel
+
+    from .streaming.common import Song
 
 MAXIMUM_VOLUME = 150  # percent
+MAXIMUM_EQ_GAIN = 12  # decibels
+MAXIMUM_PLAYMANY_SONGS = 10
+
+# what `/playmany` reports back to the user, rather than failing entirely
+PLAYMANY_ERRORS = (
+    OverCapacity,
+    youtube.ExtractionError,
+    spotify.InvalidTrack,
+    direct.UnplayableSource,
+)
 
 
 async def song_autocomplete(
-    interaction: discord.Interaction,  # noqa
+    interaction: discord.Interaction,
     current: str,
 ) -> list[app_commands.Choice[str]]:
     current = current.strip()
     if not current:
         return []
 
-    tracks = await spotify.search(current)
+    if interaction.namespace.platform == "library":
+        # choices can't be longer than 100 characters
+        return [
+            app_commands.Choice(
+                name=f"{entry.title} by {entry.artist}"[:100],
+                value=entry.path,
+            )
+            for entry in direct.search_library(current)
+            if len(entry.path) <= 100
+        ]
+
+    try:
+        tracks = await spotify.search(current, spotify.Priority.AUTOCOMPLETE)
+    except spotify.RateLimited:
+        return []
+
     return [
         app_commands.Choice(
             name=track.youtube_search_term[:100],
@@ -30,6 +68,50 @@ async def song_autocomplete(
     ]
 
 
+async def find_voice_channel(interaction: Interaction) -> VocalGuildChannel | None:
+    """
+    Finds the voice channel of the user who sent the interaction.
+    If they aren't in one, responds to the interaction explaining why.
+    """
+    guild = interaction.guild
+    member = interaction.user
+    if not isinstance(member, discord.Member) or not guild:
+        if guild:
+            member = await guild.fetch_member(member.id)
+        else:
+            await interaction.response.send_message(
+                "I cannot play music in DMs.",
+            )
+            return None
+
+    if member.voice is None:
+        await interaction.response.send_message(
+            "You are not connected to a voice channel.",
+        )
+        return None
+
+    channel = member.voice.channel
+    if channel is None:
+        await interaction.response.send_message(
+            "Error: Unable to find a voice channel.",
+        )
+        return None
+
+    return channel
+
+
+async def station_autocomplete(
+    interaction: discord.Interaction,  # noqa
+    current: str,
+) -> list[app_commands.Choice[str]]:
+    current = current.strip().lower()
+    return [
+        app_commands.Choice(name=name, value=name)
+        for name in Station.stations
+        if current in name.lower()
+    ][:25]
+
+
 @tree.command(description="Sets the volume")
 @app_commands.describe(volume="The volume to play at, such as '50' for half volume.")
 async def volume(interaction: Interaction, volume: float) -> None:
@@ -64,59 +146,233 @@ async def volume(interaction: Interaction, volume: float) -> None:
     )
 
 
+@tree.command(description="Sets audio effects such as bass boost and speed")
+@app_commands.describe(
+    bass="Bass boost (or cut) in decibels, such as '6'.",
+    mid="Mid range boost (or cut) in decibels.",
+    treble="Treble boost (or cut) in decibels.",
+    compressor="Evens out loud and quiet parts.",
+    speed="Playback speed (also changes pitch), such as '1.25'.",
+    reset="Turns off all effects.",
+)
+async def effects(
+    interaction: Interaction,
+    bass: float | None = None,
+    mid: float | None = None,
+    treble: float | None = None,
+    compressor: bool | None = None,
+    speed: float | None = None,
+    reset: bool = False,
+) -> None:
+    from .streaming.effects import MAXIMUM_SPEED, MINIMUM_SPEED, EffectSettings
+
+    if not interaction.guild or not (song_player := SongPlayer.get(interaction.guild)):
+        await interaction.response.send_message(
+            "I'm not playing music.",
+            ephemeral=True,
+        )
+        return
+
+    for gain in (bass, mid, treble):
+        if gain is not None and abs(gain) > MAXIMUM_EQ_GAIN:
+            await interaction.response.send_message(
+                f"Boosts must be between -{MAXIMUM_EQ_GAIN} and {MAXIMUM_EQ_GAIN} decibels (you entered {gain:g}).",
+                ephemeral=True,
+            )
+            return
+
+    if speed is not None and not MINIMUM_SPEED <= speed <= MAXIMUM_SPEED:
+        await interaction.response.send_message(
+            f"Speed must be between {MINIMUM_SPEED:g}x and {MAXIMUM_SPEED:g}x (you entered {speed:g}x).",
+            ephemeral=True,
+        )
+        return
+
+    current = (
+        EffectSettings() if reset or not song_player.effects else song_player.effects
+    )
+    song_player.effects = EffectSettings(
+        bass_db=current.bass_db if bass is None else bass,
+        mid_db=current.mid_db if mid is None else mid,
+        treble_db=current.treble_db if treble is None else treble,
+        compressor=current.compressor if compressor is None else compressor,
+        speed=current.speed if speed is None else speed,
+    )
+
+    await interaction.response.send_message(
+        embed=discord.Embed(
+            title="Effects Set",
+            description=(
+                ", ".join(song_player.effects.describe())
+                if song_player.effects
+                else "No effects."
+            ),
+            color=ui.BLUE,
+        ),
+    )
+
+
+async def fetch_song(song: str, platform: str) -> Song:
+    if platform == "library":
+        return await direct.fetch_from_library(song)
+
+    if direct.is_audio_url(song):
+        return await direct.fetch_url(song)
+
+    if platform == "youtube" or ("youtube.com" in song or "youtu.be" in song):
+        return await youtube.fetch(song)
+
+    return await spotify.fetch(song)
+
+
+PLATFORM_CHOICES = [
+    app_commands.Choice(name="YouTube", value="youtube"),
+    app_commands.Choice(name="Spotify", value="spotify"),
+    app_commands.Choice(name="Music library", value="library"),
+]
+
+
 @tree.command(description="Plays a song")
-@app_commands.describe(song="The URL or name of a song from YouTube or Spotify.")
+@app_commands.describe(
+    song="The name or URL of a song (YouTube, Spotify or an audio file), or one from the music library.",
+)
 @app_commands.autocomplete(
     song=song_autocomplete,
 )
-@app_commands.choices(
-    platform=[
-        app_commands.Choice(name="YouTube", value="youtube"),
-        app_commands.Choice(name="Spotify", value="spotify"),
-    ],
-)
+@app_commands.choices(platform=PLATFORM_CHOICES)
 async def play(interaction: Interaction, song: str, platform: str = "spotify") -> None:
     """
     Plays a song from YouTube or Spotify.
     """
-    guild = interaction.guild
-    member = interaction.user
-    if not isinstance(member, discord.Member) or not guild:
-        if guild:
-            member = await guild.fetch_member(member.id)
-        else:
-            await interaction.response.send_message(
-                "I cannot play music in DMs.",
-            )
+    trace = start_trace("play")
+    # once the song is queued, the song player finishes the trace instead
+    outcome: str | None = "error"
+    try:
+        guild = interaction.guild
+        channel = await find_voice_channel(interaction)
+        if not guild or not channel:
+            outcome = "no voice channel"
             return
 
-    if member.voice is None:
-        await interaction.response.send_message(
-            "You are not connected to a voice channel.",
-        )
+        try:
+            admission = admit(guild.id)
+        except OverCapacity as e:
+            outcome = "over capacity"
+            await interaction.response.send_message(str(e), ephemeral=True)
+            return
+
+        with admission:
+            with span("defer"):
+                await interaction.response.defer()
+
+            try:
+                audio = await fetch_song(song, platform)
+            except (youtube.ExtractionError, direct.UnplayableSource) as e:
+                outcome = "unplayable"
+                await interaction.followup.send(str(e))
+                return
+
+            song_player = SongPlayer.get_or_create(guild)
+            await song_player.play_or_queue(
+                audio,
+                channel,
+                interaction.user,
+                interaction.followup,
+                interaction.channel,
+            )
+            outcome = None
+    finally:
+        if outcome:
+            trace.finish(outcome)
+
+
+@tree.command(description="Plays several songs, in order")
+@app_commands.describe(
+    songs="URLs or names of songs from YouTube or Spotify, separated by semicolons.",
+)
+@app_commands.choices(platform=PLATFORM_CHOICES)
+async def playmany(
+    interaction: Interaction,
+    songs: str,
+    platform: str = "spotify",
+) -> None:
+    """
+    Looks up several songs at once and queues them in the order given.
+    """
+    guild = interaction.guild
+    channel = await find_voice_channel(interaction)
+    if not guild or not channel:
         return
 
-    channel = member.voice.channel
-    if channel is None:
+    queries = [query.strip() for query in re.split(r"[;\n]", songs) if query.strip()]
+    if not 0 < len(queries) <= MAXIMUM_PLAYMANY_SONGS:
         await interaction.response.send_message(
-            "Error: Unable to find a voice channel.",
+            f"Please list between 1 and {MAXIMUM_PLAYMANY_SONGS} songs, separated by semicolons.",
+            ephemeral=True,
         )
         return
 
     await interaction.response.defer()
+    song_player = SongPlayer.get_or_create(guild)
 
-    if platform == "youtube" or ("youtube.com" in song or "youtu.be" in song):
-        audio = await youtube.fetch(song)
-    else:
-        audio = await spotify.fetch(song)
+    async def queue(audio: Song) -> None:
+        await song_player.play_or_queue(
+            audio,
+            channel,
+            interaction.user,
+            interaction.followup,
+            interaction.channel,
+        )
 
-    song_player = SongPlayer.get_or_create(guild)
-    await song_player.play_or_queue(
-        audio,
-        channel,
-        interaction.user,
-        interaction.followup,
+    failures = await queue_in_order(guild.id, queries, platform, queue)
+    if failures:
+        await interaction.followup.send(
+            f"Couldn't queue {len(failures)} of {len(queries)} songs:\n"
+            + "\n".join(failures),
+        )
+
+
+async def queue_in_order(
+    guild_id: int,
+    queries: list[str],
+    platform: str,
+    queue: Callable[[Song], Awaitable[None]],
+) -> list[str]:
+    """
+    Looks up songs concurrently, but queues them in the order given.
+    Returns why each song that couldn't be queued failed, in order.
+    """
+    # Each song waits for the one before it to be queued (or fail) before it's
+    # queued itself. Each keeps its slot until then, and slots are handed out
+    # in order, so the earliest unfinished song always has one.
+    slots = asyncio.Semaphore(max_resolutions_per_guild)
+    finished = [asyncio.Event() for _ in queries]
+    failures: list[tuple[int, str]] = []
+
+    async def resolve_and_queue(index: int, query: str) -> None:
+        async with slots:
+            try:
+                with admit(guild_id):
+                    audio = await fetch_song(query, platform)
+                    if index > 0:
+                        await finished[index - 1].wait()
+
+                    await queue(audio)
+            except PLAYMANY_ERRORS as e:
+                failures.append((index, f"`{query}`: {e}"))
+            except Exception as e:
+                # one song shouldn't stop the rest from being queued
+                print(f"Couldn't queue {query!r} for /playmany: {e!r}")
+                failures.append((index, f"`{query}`: Something went wrong."))
+            finally:
+                if index > 0:
+                    await finished[index - 1].wait()
+                finished[index].set()
+
+    await asyncio.gather(
+        *(resolve_and_queue(index, query) for index, query in enumerate(queries)),
     )
+    return [failure for _, failure in sorted(failures)]
 
 
 @tree.command(description="Skips the current song in the queue")
@@ -170,6 +426,82 @@ async def skip(interaction: Interaction) -> None:
     song_player.skip_current_song()
 
 
+@tree.command(description="Pauses the current song")
+async def pause(interaction: Interaction) -> None:
+    """
+    Pauses the current song, keeping its place and the rest of the queue.
+    """
+    guild = interaction.guild
+    if guild is None:
+        await interaction.response.send_message(
+            "I cannot pause music in DMs.",
+        )
+        return
+
+    song_player = SongPlayer.get(guild)
+    if not song_player or not song_player.currently_playing:
+        await interaction.response.send_message(
+            "I am not playing music.",
+            ephemeral=True,
+            delete_after=3,
+        )
+        return
+
+    if not song_player.pause():
+        await interaction.response.send_message(
+            "The music is already paused. Use `/resume` to carry on.",
+            ephemeral=True,
+            delete_after=3,
+        )
+        return
+
+    embed = discord.Embed(
+        title=f"Paused: {song_player.currently_playing.song.title}",
+        color=ui.BLUE,
+        url=song_player.currently_playing.song.url or None,
+    )
+    embed.add_field(name="Paused By", value=interaction.user.mention)
+    await interaction.response.send_message(embed=embed)
+
+
+@tree.command(description="Resumes the paused song")
+async def resume(interaction: Interaction) -> None:
+    """
+    Carries on playing the paused song from where it was paused.
+    """
+    guild = interaction.guild
+    if guild is None:
+        await interaction.response.send_message(
+            "I cannot resume music in DMs.",
+        )
+        return
+
+    song_player = SongPlayer.get(guild)
+    if not song_player or not song_player.currently_playing:
+        await interaction.response.send_message(
+            "I am not playing music.",
+            ephemeral=True,
+            delete_after=3,
+        )
+        return
+
+    if not song_player.resume():
+        await interaction.response.send_message(
+            "The music isn't paused.",
+            ephemeral=True,
+            delete_after=3,
+        )
+        return
+
+    embed = discord.Embed(
+        title=f"Resumed: {song_player.currently_playing.song.title}",
+        color=ui.BLUE,
+        url=song_player.currently_playing.song.url or None,
+    )
+    embed.add_field(name="Resumed By", value=interaction.user.mention)
+    await interaction.response.send_message(embed=embed)
+
+
 @tree.command(description="Stops playing music")
 async def stop(interaction: Interaction) -> None:
     """
@@ -194,7 +526,7 @@ async def stop(interaction: Interaction) -> None:
         return
     assert song_player is not None
 
-    song_player.stop()
+    await song_player.stop()
     await interaction.response.send_message(
         embed=discord.Embed(
             title="Stopped Playing Music",
@@ -202,3 +534,107 @@ async def stop(interaction: Interaction) -> None:
             color=ui.BLUE,
         ),
     )
+
+
+@tree.command(description="Hosts or tunes into a radio station shared between servers")
+@app_commands.describe(station="The name of the station.")
+@app_commands.autocomplete(station=station_autocomplete)
+@app_commands.choices(
+    action=[
+        app_commands.Choice(name="Tune In", value="tune-in"),
+        app_commands.Choice(name="Host", value="host"),
+        app_commands.Choice(name="End", value="end"),
+    ],
+)
+async def radio(
+    interaction: Interaction, station: str, action: str = "tune-in"
+) -> None:
+    """
+    Radio mode. The hosting server plays music as usual, and every server
+    tuned in hears the same songs live, sharing the host's audio stream.
+    """
+    guild = interaction.guild
+    if guild is None:
+        await interaction.response.send_message(
+            "I cannot play music in DMs.",
+        )
+        return
+
+    if action == "host":
+        try:
+            hosted = Station.create(station, guild.id)
+        except ValueError as e:
+            await interaction.response.send_message(str(e), ephemeral=True)
+            return
+
+        song_player = SongPlayer.get_or_create(guild)
+        if song_player.station:
+            song_player.station.close()
+        song_player.station = hosted
+        if song_player.currently_playing:
+            hosted.set_current(song_player.currently_playing.song)
+
+        await interaction.response.send_message(
+            embed=discord.Embed(
+                title=f"Now Hosting Station: {station}",
+                description="Songs played in this server will also play in every server tuned in to this station.",
+                color=ui.BLUE,
+            ),
+        )
+        return
+
+    if action == "end":
+        song_player = SongPlayer.get(guild)
+        if not song_player or not song_player.station:
+            await interaction.response.send_message(
+                "This server isn't hosting a station.",
+                ephemeral=True,
+            )
+            return
+
+        song_player.station.close()
+        song_player.station = None
+        await interaction.response.send_message(
+            embed=discord.Embed(title=f"Ended Station: {station}", color=ui.BLUE),
+        )
+        return
+
+    tuned = Station.stations.get(station)
+    if not tuned or not tuned.current_song:
+        await interaction.response.send_message(
+            f"Station {station!r} isn't playing anything right now.",
+            ephemeral=True,
+        )
+        return
+
+    if tuned.host_guild_id == guild.id:
+        await interaction.response.send_message(
+            "This server is hosting that station.",
+            ephemeral=True,
+        )
+        return
+
+    channel = await find_voice_channel(interaction)
+    if not channel:
+        return
+
+    await interaction.response.defer()
+
+    host = interaction.client.get_guild(tuned.host_guild_id)
+    song_player = SongPlayer.get_or_create(guild)
+    await song_player.play_or_queue(
+        StationSong(
+            title=f"Radio: {tuned.name}",
+            artist=host.name if host else "another server",
+            artist_url=tuned.current_song.artist_url,
+            url=tuned.current_song.url,
+            image_url=tuned.current_song.image_url,
+            duration=0,
+            stream=tuned.source(),
+            station=tuned,
+        ),
+        channel,
+        interaction.user,
+        interaction.followup,
+        interaction.channel,
+    )
@@ -1,25 +1,21 @@
 import discord
 
-from bot import client
+from bot import client, shutdown_callbacks
 
 from .song_player import SongPlayer
+from .streaming.spotify import close_spotify_client
+
+shutdown_callbacks.append(close_spotify_client)
 
 
 @client.event
 async def on_voice_state_update(
     member: discord.Member,
-    _before: discord.VoiceState,
-    _after: discord.VoiceState,
+    before: discord.VoiceState,
+    after: discord.VoiceState,
 ) -> None:
     song_player = SongPlayer.get(member.guild)
-    if not song_player or not song_player.voice_client:
+    if not song_player:
         return
 
-    channel_member_ids = {
-        member.id for member in song_player.voice_client.channel.members
-    }
-    listeners = channel_member_ids - {client.user.id if client.user else None}
-
-    if not listeners:
-        song_player.stop()
-        await song_player.voice_client.disconnect()
+    song_player.update_listeners(member, before, after)
@@ -0,0 +1,170 @@
+"""
+"Now Playing" and "Added to Queue" messages.
+
+Each guild sends its messages one at a time, in order, from a background task,
+so that a slow or rate limited webhook never holds up playback. (discord.py
+itself waits out 429s, and sending one at a time keeps us from piling more
+requests onto the same bucket in the meantime.)
+
+Songs added to the queue in a burst, such as by `/playmany`, are summarized
+into one message. Followup webhooks stop working 15 minutes after their
+interaction, which a long queue easily outlasts, so later messages are sent
+to the channel the command was used in instead.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, Callable
+
+import aiohttp
+import discord
+
+import metrics
+
+from . import ui
+
+if TYPE_CHECKING:
+    from .streaming.common import Song
+
+# Followup webhooks last 15 minutes from the interaction, which was a little
+# before the webhook was handed to us
+FOLLOWUP_LIFETIME = 14 * 60  # seconds
+# How long an "Added to Queue" message waits for others to summarize it with
+COALESCE_WINDOW = 1.0  # seconds
+# "Unauthorized" (invalid webhook token) and "Not Found" (unknown webhook)
+EXPIRED_WEBHOOK_STATUSES = frozenset({401, 404})
+# Fields of "Added to Queue" messages that are the same for the whole burst
+SUMMARY_FIELDS = ("Requested By", "Voice Channel")
+
+notification_counter = metrics.counter(
+    "notifications_total",
+    "Song notifications, by outcome (sent, coalesced, fallback or failed).",
+    label_name="outcome",
+)
+
+
+@dataclass
+class Destination:
+    """
+    Where to send messages about a command: its followup webhook until that
+    expires, then the channel it was used in.
+    """
+
+    webhook: discord.Webhook
+    fallback_channel: discord.abc.Messageable | None = None
+    expires_at: float = field(
+        default_factory=lambda: time.monotonic() + FOLLOWUP_LIFETIME,
+    )
+
+    @property
+    def token(self: Destination) -> str | None:
+        return getattr(self.webhook, "token", None)
+
+
+@dataclass
+class Notification:
+    destination: Destination
+    embed: discord.Embed
+    # set on "Added to Queue" messages, which can be summarized
+    queued_song: Song | None = None
+    # called once the message has been sent (or given up on)
+    on_sent: Callable[[], None] | None = None
+
+    def can_join(self: Notification, batch: Notification) -> bool:
+        # every interaction needs a followup of its own, or it's left "thinking"
+        return (
+            self.queued_song is not None
+            and batch.queued_song is not None
+            and self.destination.token == batch.destination.token
+        )
+
+
+class Notifier:
+    def __init__(self: Notifier) -> None:
+        self.pending: deque[Notification] = deque()
+        self.expired_tokens: set[str] = set()
+        self._dispatcher: asyncio.Task | None = None
+
+    def notify(self: Notifier, notification: Notification) -> None:
+        """
+        Queues a message, without waiting for it to be sent.
+        Must be called from the event loop (see `call_soon_threadsafe`).
+        """
+        self.pending.append(notification)
+        if not self._dispatcher or self._dispatcher.done():
+            self._dispatcher = asyncio.ensure_future(self._dispatch())
+
+    async def _dispatch(self: Notifier) -> None:
+        while self.pending:
+            notification = self.pending.popleft()
+            batch = [notification]
+            if notification.queued_song:
+                # give the rest of a burst a moment to arrive
+                await asyncio.sleep(COALESCE_WINDOW)
+                while self.pending and self.pending[0].can_join(notification):
+                    batch.append(self.pending.popleft())
+
+            embed = notification.embed if len(batch) == 1 else self.summarize(batch)
+            notification_counter.inc(len(batch) - 1, label="coalesced")
+            await self.send(notification.destination, embed)
+
+            for sent in batch:
+                if sent.on_sent:
+                    sent.on_sent()
+
+    @staticmethod
+    def summarize(batch: list[Notification]) -> discord.Embed:
+        embed = ui.embed_queued_songs(
+            [
+                notification.queued_song
+                for notification in batch
+                if notification.queued_song
+            ],
+        )
+        for embed_field in batch[0].embed.fields:
+            if embed_field.name in SUMMARY_FIELDS:
+                embed.add_field(name=embed_field.name, value=embed_field.value)
+
+        return embed
+
+    async def send(
+        self: Notifier,
+        destination: Destination,
+        embed: discord.Embed,
+    ) -> None:
+        token = destination.token
+        expired = time.monotonic() > destination.expires_at
+        if not expired and token not in self.expired_tokens:
+            try:
+                await destination.webhook.send(embed=embed)
+            except discord.HTTPException as e:
+                if e.status not in EXPIRED_WEBHOOK_STATUSES:
+                    notification_counter.inc(label="failed")
+                    print(f"Couldn't send a notification: {e!r}")
+                    return
+
+                if token:
+                    self.expired_tokens.add(token)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                notification_counter.inc(label="failed")
+                print(f"Couldn't send a notification: {e!r}")
+                return
+            else:
+                notification_counter.inc(label="sent")
+                return
+
+        if not destination.fallback_channel:
+            notification_counter.inc(label="failed")
+            return
+
+        try:
+            await destination.fallback_channel.send(embed=embed)
+        except (discord.HTTPException, aiohttp.ClientError, asyncio.TimeoutError) as e:
+            notification_counter.inc(label="failed")
+            print(f"Couldn't send a notification to the channel either: {e!r}")
+        else:
+            notification_counter.inc(label="fallback")
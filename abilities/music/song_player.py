@@ -1,24 +1,71 @@
 from __future__ import annotations
 
 import asyncio
+import sys
+import time
 from dataclasses import dataclass
 from typing import TYPE_CHECKING, ClassVar
 
 import discord
 
+import metrics
+from config import (
+    empty_channel_grace_period,
+    empty_channel_pause_limit,
+    voice_linger_period,
+)
+from tracing import Trace, current_trace, span
+
 from . import ui
+from .notifications import Destination, Notification, Notifier
+from .streaming.broadcast import BroadcastAudioSource
 
 if TYPE_CHECKING:
     from discord.member import VocalGuildChannel
 
+    from .streaming.broadcast import Station
     from .streaming.common import Song
+    from .streaming.effects import EffectSettings
+
+
+# Players which have been disconnected with nothing queued for this long are
+# forgotten, so that `song_player_by_guild` doesn't grow forever
+IDLE_PLAYER_LIFETIME = 10 * 60  # seconds
+
+# How long to wait for the voice connection to come back before giving up on it
+VOICE_RECONNECT_TIMEOUT = 30  # seconds
+
+reconnect_histogram = metrics.histogram(
+    "voice_reconnect_seconds",
+    "Time from losing the voice connection mid-song to resuming the song.",
+)
+connect_histogram = metrics.histogram(
+    "voice_connect_seconds",
+    "Time taken to join (or move to) a voice channel for a song.",
+)
+connection_counter = metrics.counter(
+    "voice_connections_total",
+    "Voice connections needed by songs, by kind (reused, connected or moved).",
+    label_name="kind",
+)
+reconnect_counter = metrics.counter(
+    "voice_reconnects_total",
+    "Songs interrupted by the voice connection, by outcome (resumed or abandoned).",
+    label_name="outcome",
+)
 
 
 @dataclass
 class QueuedSong:
     song: Song
     requested_by: discord.User | discord.Member
-    send_followups_to: discord.Webhook
+    followups: Destination
+    # the `/play` trace, until the song starts playing
+    trace: Trace | None = None
+    started: bool = False
+    skipped: bool = False
+    # the voice connection dropped, and `_resume_after_disconnect` is waiting for it
+    interrupted: bool = False
 
 
 class SongPlayer:
@@ -30,8 +77,13 @@ class SongPlayer:
 
     @classmethod
     def get_or_create(cls: type[SongPlayer], guild: discord.Guild) -> SongPlayer:
+        """
+        Must be called from the event loop, which new players' eviction runs on.
+        """
         if guild.id not in cls.song_player_by_guild:
-            cls.song_player_by_guild[guild.id] = cls(guild)
+            song_player = cls.song_player_by_guild[guild.id] = cls(guild)
+            # in case it never gets as far as connecting (e.g. `/play` fails)
+            song_player._schedule_eviction()
 
         return cls.song_player_by_guild[guild.id]
 
@@ -39,6 +91,28 @@ class SongPlayer:
         self.guild = guild
         self.queued_songs: list[QueuedSong] = []
         self._volume: float = 1.0
+        self._effects: EffectSettings | None = None
+
+        # Number of members (other than us) in our voice channel,
+        # kept up to date by `update_listeners` instead of being recounted.
+        self.listener_count = 0
+        self._empty_channel_task: asyncio.Task | None = None
+        self._eviction_task: asyncio.Task | None = None
+        self._linger_task: asyncio.Task | None = None
+        # `_linger_task` has started disconnecting, so it can't be cancelled
+        self._disconnecting_idle = False
+
+        # The radio station this guild is hosting, if any
+        self.station: Station | None = None
+
+        # Where we were last asked to play, for reconnecting
+        self.channel: VocalGuildChannel | None = None
+
+        self.paused = False
+        # paused because everyone left, so it resumes when someone is back
+        self.auto_paused = False
+
+        self.notifier = Notifier()
 
     @property
     def volume(self: SongPlayer) -> float:
@@ -51,10 +125,28 @@ class SongPlayer:
         for queued in self.queued_songs:
             queued.song.stream.volume = value
 
+    @property
+    def effects(self: SongPlayer) -> EffectSettings | None:
+        return self._effects
+
+    @effects.setter
+    def effects(self: SongPlayer, value: EffectSettings | None) -> None:
+        self._effects = value if value and value.enabled else None
+
+        for queued in self.queued_songs:
+            # each stream needs its own chain, since effects have state
+            queued.song.stream.effects = (
+                self._effects.build_chain() if self._effects else None
+            )
+
     @property
     def currently_playing(self: SongPlayer) -> QueuedSong | None:
         return self.queued_songs[0] if self.queued_songs else None
 
+    @property
+    def idle(self: SongPlayer) -> bool:
+        return not self.queued_songs and not self.voice_client and not self.station
+
     @property
     def voice_client(self: SongPlayer) -> discord.VoiceClient | None:
         vc = self.guild.voice_client
@@ -67,16 +159,153 @@ class SongPlayer:
 
         return vc
 
+    def recount_listeners(self: SongPlayer) -> None:
+        """
+        Counts the listeners from scratch.
+        Only needed when we join or move between channels.
+        """
+        vc = self.voice_client
+        self.listener_count = (
+            sum(member.id != self.guild.me.id for member in vc.channel.members)
+            if vc
+            else 0
+        )
+        self._schedule_empty_channel_check()
+
+    def update_listeners(
+        self: SongPlayer,
+        member: discord.Member,
+        before: discord.VoiceState,
+        after: discord.VoiceState,
+    ) -> None:
+        if member.id == self.guild.me.id:
+            # we were moved (or disconnected)
+            self.recount_listeners()
+            if after.channel is None:
+                self._schedule_eviction()
+            else:
+                self.channel = after.channel
+            return
+
+        vc = self.voice_client
+        if not vc:
+            return
+
+        channel_id = vc.channel.id
+        was_listening = before.channel is not None and before.channel.id == channel_id
+        is_listening = after.channel is not None and after.channel.id == channel_id
+        if was_listening == is_listening:
+            # mute, deafen, etc. or activity in some other channel
+            return
+
+        self.listener_count += 1 if is_listening else -1
+        self._schedule_empty_channel_check()
+
+    def _schedule_empty_channel_check(self: SongPlayer) -> None:
+        if self.listener_count > 0:
+            if self._empty_channel_task:
+                self._empty_channel_task.cancel()
+                self._empty_channel_task = None
+            if self.auto_paused:
+                self.resume()
+        elif not self._empty_channel_task and self.voice_client:
+            self._empty_channel_task = asyncio.ensure_future(
+                self._leave_empty_channel(),
+            )
+
+    async def _leave_empty_channel(self: SongPlayer) -> None:
+        # Give listeners a moment to come back (e.g. reconnecting or switching
+        # devices) instead of throwing away the queue immediately.
+        await asyncio.sleep(empty_channel_grace_period)
+
+        if empty_channel_pause_limit > 0 and self.currently_playing:
+            # Keep the queue in case they come back, but not forever,
+            # since the connection and pipelines are still held open.
+            if not self.paused:
+                self.auto_paused = self.pause()
+            await asyncio.sleep(empty_channel_pause_limit)
+
+        self._empty_channel_task = None
+        if self.listener_count > 0 or not self.voice_client:
+            return
+
+        await self.stop()
+
+    def _schedule_linger(self: SongPlayer) -> None:
+        if not self._linger_task:
+            self._linger_task = asyncio.ensure_future(self._disconnect_when_idle())
+
+    async def _disconnect_when_idle(self: SongPlayer) -> None:
+        await asyncio.sleep(voice_linger_period)
+
+        # (the task stays set until disconnected, so no other is scheduled)
+        try:
+            if not self.currently_playing and self.voice_client:
+                self._disconnecting_idle = True
+                await self.voice_client.disconnect()
+        finally:
+            self._disconnecting_idle = False
+            self._linger_task = None
+
+    def _schedule_eviction(self: SongPlayer) -> None:
+        if not self._eviction_task:
+            self._eviction_task = asyncio.ensure_future(self._evict_when_idle())
+
+    async def _evict_when_idle(self: SongPlayer) -> None:
+        await asyncio.sleep(IDLE_PLAYER_LIFETIME)
+        self._eviction_task = None
+
+        if self.song_player_by_guild.get(self.guild.id) is not self:
+            return
+
+        if self.idle:
+            del self.song_player_by_guild[self.guild.id]
+        elif not self.voice_client:
+            # queued but not connected (yet), which no disconnect will follow
+            self._schedule_eviction()
+
+    def memory_usage(self: SongPlayer) -> dict[str, int]:
+        """
+        Approximate number of bytes held on to by this guild's queue.
+        Packets shared with other guilds are counted for each of them.
+        """
+        broadcasts = {
+            id(queued.song.stream.broadcast): queued.song.stream.broadcast
+            for queued in self.queued_songs
+            if isinstance(queued.song.stream, BroadcastAudioSource)
+        }
+        effects_buffers = [
+            queued.song.stream.effects.pending.nbytes
+            for queued in self.queued_songs
+            if queued.song.stream.effects
+        ]
+        return {
+            "packets": sum(
+                broadcast.buffered_bytes for broadcast in broadcasts.values()
+            ),
+            "song metadata": sum(
+                sys.getsizeof(value)
+                for queued in self.queued_songs
+                for value in vars(queued.song).values()
+            ),
+            "effects buffers": sum(effects_buffers),
+        }
+
     def _play_recursively(self: SongPlayer, voice_client: discord.VoiceClient) -> None:
-        if voice_client.is_playing():
+        if voice_client.is_playing() or voice_client.is_paused():
             # The voice client _already_ has a recursive `after` callback
             # so we don't need to create another one.
             return
 
+        if self.currently_playing and self.currently_playing.interrupted:
+            # `_resume_after_disconnect` will carry on once the connection is back
+            return
+
         if not self.currently_playing:
             # No more songs!
-            # Time to disconnect.
-            asyncio.ensure_future(voice_client.disconnect(), loop=voice_client.loop)
+            # Stay connected for a while in case more are queued.
+            # (this can be called from the voice client's thread)
+            voice_client.loop.call_soon_threadsafe(self._schedule_linger)
             return
 
         if not voice_client.is_connected():
@@ -86,7 +315,25 @@ class SongPlayer:
 
             voice_client = self.voice_client
 
+        queued_song = self.currently_playing
+
         def after(e: BaseException | None) -> None:
+            stream = queued_song.song.stream
+            if (
+                not queued_song.skipped
+                and not stream.ended
+                and (e is None or isinstance(e, (OSError, discord.ConnectionClosed)))
+            ):
+                # The connection dropped (or we were disconnected) mid-song,
+                # so keep the song and its position instead of advancing.
+                queued_song.interrupted = True
+                stream.suspend()
+                asyncio.run_coroutine_threadsafe(
+                    self._resume_after_disconnect(queued_song, e),
+                    voice_client.loop,
+                )
+                return
+
             if e:
                 print(
                     f"Error occurred in SongPlayer: {e!r}. Advancing to the next song.",
@@ -98,17 +345,101 @@ class SongPlayer:
             # and begin the next one
             self._play_recursively(voice_client)
 
-        queued_song = self.currently_playing
+        if not queued_song.started:
+            # (songs resumed after a disconnect have already been announced)
+            queued_song.started = True
+            self._announce(queued_song, voice_client)
+
+        voice_client.play(queued_song.song.stream, after=after)
+        if self.paused:
+            # e.g. resuming after a disconnect while paused
+            voice_client.pause()
+
+    def _announce(
+        self: SongPlayer,
+        queued_song: QueuedSong,
+        voice_client: discord.VoiceClient,
+    ) -> None:
+        trace, queued_song.trace = queued_song.trace, None
 
         embed = ui.embed_song(queued_song.song, title_prefix="Now Playing: ")
         embed.add_field(name="Requested By", value=queued_song.requested_by.mention)
         embed.add_field(name="Voice Channel", value=voice_client.channel.mention)
-        asyncio.ensure_future(
-            queued_song.send_followups_to.send(embed=embed),
-            loop=voice_client.loop,
+
+        announced_at = time.perf_counter()
+
+        def on_sent() -> None:
+            if trace:
+                trace.add("now playing message", announced_at, time.perf_counter())
+
+        # (this can be called from the voice client's thread)
+        voice_client.loop.call_soon_threadsafe(
+            self.notifier.notify,
+            Notification(queued_song.followups, embed, on_sent=on_sent),
         )
 
-        voice_client.play(queued_song.song.stream, after=after)
+        if trace:
+            play_started_at = time.perf_counter()
+
+            def on_first_packet() -> None:
+                trace.add("first packet", play_started_at, time.perf_counter())
+                trace.finish()
+
+            queued_song.song.stream.on_first_packet = on_first_packet
+
+        if self.station:
+            self.station.set_current(queued_song.song)
+
+    async def _resume_after_disconnect(
+        self: SongPlayer,
+        queued_song: QueuedSong,
+        error: BaseException | None,
+    ) -> None:
+        """
+        Waits for discord.py to reconnect (reconnecting ourselves if it can't),
+        then carries on playing `queued_song` from the packet it stopped at.
+        If we were disconnected on purpose (e.g. kicked), the song is dropped.
+        """
+        print(f"Voice connection lost mid-song ({error!r}), resuming once it's back.")
+        started_at = time.perf_counter()
+
+        voice_client = self.voice_client
+        if voice_client and not voice_client.is_connected():
+            connected = await asyncio.to_thread(
+                voice_client.wait_until_connected,
+                VOICE_RECONNECT_TIMEOUT,
+            )
+            if not connected and self.channel:
+                await voice_client.disconnect(force=True)
+                try:
+                    voice_client = await self.channel.connect(
+                        timeout=VOICE_RECONNECT_TIMEOUT,
+                    )
+                except (asyncio.TimeoutError, discord.ClientException) as e:
+                    print(f"Couldn't reconnect to voice: {e!r}.")
+                    voice_client = None
+
+        if self.currently_playing is not queued_song:
+            # skipped or stopped in the meantime, which already cleaned it up
+            return
+
+        queued_song.interrupted = False
+        if not voice_client or not voice_client.is_connected():
+            reconnect_counter.inc(label="abandoned")
+            self.queued_songs.pop(0)
+            # (in case the voice client hasn't let go of it yet)
+            queued_song.song.stream.suspended = False
+            queued_song.song.stream.cleanup()
+            return
+
+        if voice_client.is_playing() or voice_client.is_paused():
+            # the interrupted player gave up without marking itself as stopped
+            voice_client.stop()
+
+        self.recount_listeners()
+        reconnect_histogram.observe(time.perf_counter() - started_at)
+        reconnect_counter.inc(label="resumed")
+        self._play_recursively(voice_client)
 
     async def play_or_queue(
         self: SongPlayer,
@@ -116,52 +447,170 @@ class SongPlayer:
         channel: VocalGuildChannel,
         requested_by: discord.User | discord.Member,
         send_followups_to: discord.Webhook,
+        fallback_channel: discord.abc.Messageable | None = None,
     ) -> None:
+        """
+        Messages about the song go to `send_followups_to`, or once that has
+        expired, to `fallback_channel` (usually where the command was used).
+        """
         if channel.guild != self.guild:
             msg = f"You're using the wrong SongPlayer, partner. This SongPlayer is for guild {self.guild.id!r}, but that channel is in guild {channel.guild.id!r}."
             raise ValueError(msg)
 
+        # Songs that start playing later are only traced until they're queued
+        trace = current_trace.get()
+        followups = Destination(send_followups_to, fallback_channel)
         if self.currently_playing:
             embed = ui.embed_song(song, title_prefix="Added to Queue: ")
             embed.add_field(name="Requested By", value=requested_by.mention)
             embed.add_field(name="Voice Channel", value=channel.mention)
-            await send_followups_to.send(embed=embed)
+            self.notifier.notify(Notification(followups, embed, queued_song=song))
+
+            if trace:
+                trace.finish()
+                trace = None
 
+        self.channel = channel
         song.stream.volume = self.volume
+        if self.effects:
+            song.stream.effects = self.effects.build_chain()
         self.queued_songs.append(
             QueuedSong(
                 song=song,
                 requested_by=requested_by,
-                send_followups_to=send_followups_to,
+                followups=followups,
+                trace=trace,
             ),
         )
         assert self.currently_playing is not None
 
+        if linger_task := self._linger_task:
+            if self._disconnecting_idle:
+                # too late to keep the connection, so connect again once it's closed
+                await asyncio.shield(linger_task)
+            else:
+                # the connection is still open from the last song
+                linger_task.cancel()
+                self._linger_task = None
+
+        connect_started_at = time.perf_counter()
         if not self.voice_client:
-            await channel.connect()
+            with span("voice connect"):
+                await channel.connect()
+            connection_counter.inc(label="connected")
+            connect_histogram.observe(time.perf_counter() - connect_started_at)
+            self.recount_listeners()
         elif self.voice_client.channel != channel:
-            await self.voice_client.move_to(channel)
+            with span("voice connect"):
+                await self.voice_client.move_to(channel)
+            connection_counter.inc(label="moved")
+            connect_histogram.observe(time.perf_counter() - connect_started_at)
+            self.recount_listeners()
+        else:
+            connection_counter.inc(label="reused")
         assert self.voice_client is not None
 
         self._play_recursively(self.voice_client)
 
+    def pause(self: SongPlayer) -> bool:
+        """
+        Stops reading packets, leaving the current song (and whatever its
+        pipeline has buffered) where it is, so that `resume` is instant.
+        Once its pipe is full, the song's `ffmpeg` blocks on writing to it,
+        so a paused guild uses no CPU. Returns whether anything was paused.
+        """
+        if self.paused or not self.currently_playing:
+            return False
+
+        self.paused = True
+        if self.voice_client and self.voice_client.is_playing():
+            self.voice_client.pause()
+
+        return True
+
+    def resume(self: SongPlayer) -> bool:
+        """
+        Returns whether anything was resumed.
+        """
+        if not self.paused:
+            return False
+
+        self.paused = self.auto_paused = False
+        if self.voice_client and self.voice_client.is_paused():
+            self.voice_client.resume()
+
+        return True
+
     def skip_current_song(self: SongPlayer) -> QueuedSong | None:
         current_song = self.currently_playing
         if not current_song:
             # there is nothing to skip...
             return None
 
-        if self.voice_client:
+        # skipping means moving on to the next song, so it isn't paused
+        self.paused = self.auto_paused = False
+        current_song.skipped = True
+        if self.voice_client and not current_song.interrupted:
             # will also call the `after` callback which pops the song
             self.voice_client.stop()
         else:
             self.queued_songs.pop(0)
+            # never reached the voice client (or it let go of the song when
+            # the connection dropped), which would've cleaned it up
+            current_song.song.stream.suspended = False
+            current_song.song.stream.cleanup()
 
         return current_song
 
-    def stop(self: SongPlayer) -> None:
+    async def stop(self: SongPlayer) -> None:
+        """
+        Clears the queue and disconnects straight away, without lingering.
+        """
         # delete everything after the current song
+        removed_songs = self.queued_songs[1:]
         del self.queued_songs[1:]
+        for queued in removed_songs:
+            # releases their pipelines, which would otherwise keep running
+            queued.song.stream.cleanup()
 
         # and skip the current song
         self.skip_current_song()
+
+        if self.voice_client:
+            await self.voice_client.disconnect()
+
+
+players_gauge = metrics.gauge(
+    "song_players",
+    "Number of guilds with a song player, whether or not it's connected.",
+)
+active_guilds_gauge = metrics.gauge(
+    "song_players_connected",
+    "Number of guilds the bot is connected to a voice channel in.",
+)
+queued_songs_gauge = metrics.gauge(
+    "queued_songs",
+    "Number of songs queued across every guild, including the ones playing.",
+)
+paused_guilds_gauge = metrics.gauge(
+    "song_players_paused",
+    "Number of guilds whose song is paused, including automatically.",
+)
+longest_queue_gauge = metrics.gauge(
+    "queued_songs_longest",
+    "Number of songs queued in the guild with the longest queue.",
+)
+
+
+def _update_player_gauges() -> None:
+    players = list(SongPlayer.song_player_by_guild.values())
+    queue_lengths = [len(player.queued_songs) for player in players]
+
+    players_gauge.set(len(players))
+    active_guilds_gauge.set(sum(1 for player in players if player.voice_client))
+    paused_guilds_gauge.set(sum(1 for player in players if player.paused))
+    queued_songs_gauge.set(sum(queue_lengths))
+    longest_queue_gauge.set(max(queue_lengths, default=0))
+
+
+metrics.scrape_callbacks.append(_update_player_gauges)
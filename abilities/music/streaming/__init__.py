@@ -1 +1,10 @@
-from . import common, spotify, youtube  # noqa
+from . import (  # noqa
+    broadcast,
+    common,
+    direct,
+    loudness,
+    ogg,
+    processes,
+    spotify,
+    youtube,
+)
@@ -0,0 +1,440 @@
+from __future__ import annotations
+
+import subprocess
+import threading
+import weakref
+from contextlib import suppress
+from dataclasses import dataclass
+from typing import IO, Callable, ClassVar, Iterable, Iterator
+
+import metrics
+
+from . import processes
+from .common import OPUS_FRAME_DURATION, BufferedOpusAudioSource
+from .common import Song as BaseSong
+from .ogg import OggPacketReader
+
+# Packets are kept so that late joiners hear the song from the start, but only
+# this many of them once every reader has moved on, so that live streams and
+# long radio sessions don't grow without limit
+HISTORY_LIMIT = 10 * 60 * 50  # packets (ten minutes of 20 ms frames)
+TRIM_INTERVAL = 10 * 50  # packets between trims
+
+# A pipeline that ends more than this far short of the song's duration died
+# (e.g. its stream URL expired), so it's restarted from where it stopped
+EARLY_END_TOLERANCE = 5  # seconds
+MAXIMUM_RESTARTS = 3
+
+HEADER_PREFIXES = (b"OpusHead", b"OpusTags")
+# One frame of silence, for radio listeners while the host isn't playing anything
+SILENCE_PACKET = b"\xf8\xff\xfe"
+
+active_pipelines = metrics.gauge(
+    "audio_pipelines_active",
+    "Number of download and transcoding pipelines that are still producing audio.",
+)
+restart_counter = metrics.counter(
+    "audio_pipeline_restarts_total",
+    "Pipelines that ended before the song did, by outcome (resumed or failed).",
+    label_name="outcome",
+)
+
+# Starts a new pipeline `seconds` into the song: (Ogg Opus stream, its process)
+Restart = Callable[[float], tuple[IO[bytes], subprocess.Popen]]
+
+
+class Broadcast:
+    """
+    A single Ogg Opus pipeline whose packets can be read by any number of
+    `BroadcastAudioSource`s, each with its own position and volume.
+
+    Packets are kept until the last subscriber unsubscribes, so that a
+    guild which starts the song later still hears it from the beginning,
+    except for those more than `HISTORY_LIMIT` behind that every reader
+    has already read.
+    """
+
+    # every Broadcast that hasn't been garbage collected, for memory accounting
+    instances: ClassVar[weakref.WeakSet[Broadcast]] = weakref.WeakSet()
+
+    def __init__(
+        self: Broadcast,
+        stream: IO[bytes],
+        cleanup_processes: Iterable[subprocess.Popen] = (),
+        duration: float | None = None,
+        restart: Restart | None = None,
+    ) -> None:
+        """
+        If the stream ends more than `EARLY_END_TOLERANCE` short of `duration`
+        (seconds), `restart` is used to carry on from where it stopped.
+        """
+        self.cleanup_processes = list(cleanup_processes)
+        processes.release_with(self, self.cleanup_processes)
+        # (index of the first kept packet, kept packets), swapped as a whole
+        # when trimming so that readers never see one without the other
+        self._window: tuple[int, list[bytes]] = (0, [])
+        # the packet each reader is up to, which is never trimmed
+        self._positions: dict[object, int] = {}
+        self.finished = False
+        self.closed = False
+        self.subscriber_count = 0
+        # until the stream finishes or the processes are killed
+        self.pipeline_active = True
+        active_pipelines.inc()
+
+        self.stream = stream
+        self._packets_iterator = OggPacketReader(stream).iter_packets()
+        self.duration = duration
+        self._restart = restart
+        self.restarts = 0
+        self.audio_packet_count = 0
+        # held by whichever subscriber is reading new packets from the pipe
+        self._read_lock = threading.Lock()
+        self._subscriber_lock = threading.Lock()
+        self.instances.add(self)
+
+    @property
+    def packets(self: Broadcast) -> list[bytes]:
+        return self._window[1]
+
+    @property
+    def first_index(self: Broadcast) -> int:
+        return self._window[0]
+
+    @property
+    def end_index(self: Broadcast) -> int:
+        first_index, packets = self._window
+        return first_index + len(packets)
+
+    @property
+    def buffered_bytes(self: Broadcast) -> int:
+        return sum(map(len, self.packets))
+
+    def add_reader(self: Broadcast, start: int = 0) -> object:
+        """
+        Registers a reader starting at packet `start`, which keeps the packets
+        it hasn't read yet from being trimmed. Pass the returned key to `packet`.
+        """
+        reader = object()
+        with self._subscriber_lock:
+            self._positions[reader] = start
+
+        return reader
+
+    def remove_reader(self: Broadcast, reader: object) -> None:
+        with self._subscriber_lock:
+            self._positions.pop(reader, None)
+
+    def packet(self: Broadcast, index: int, reader: object = None) -> bytes | None:
+        """
+        Waits for and returns the packet at `index`,
+        or `None` if the stream ended before then.
+        `index` must not have been trimmed already (see `add_reader`).
+        """
+        if reader is not None:
+            self._positions[reader] = index
+
+        first_index, packets = self._window
+        if index < first_index + len(packets):
+            return packets[index - first_index]
+
+        with self._read_lock:
+            while index >= self.end_index and not self.finished:
+                try:
+                    packet = next(self._packets_iterator)
+                except StopIteration:
+                    if not self._restart_early_end():
+                        self.finished = True
+                        self._end_pipeline()
+                    continue
+                except ValueError:
+                    # the pipe was closed underneath us
+                    self.finished = True
+                    self._end_pipeline()
+                    continue
+
+                if not packet.startswith(HEADER_PREFIXES):
+                    self.audio_packet_count += 1
+                self.packets.append(packet)
+
+            self._trim()
+
+        first_index, packets = self._window
+        return (
+            packets[index - first_index] if index < first_index + len(packets) else None
+        )
+
+    def _restart_early_end(self: Broadcast) -> bool:
+        """
+        Replaces a pipeline that ended before the song did with a new one,
+        starting where it stopped. Must be called with `_read_lock` held.
+        Returns whether there's a new pipeline to read from.
+        """
+        position = self.audio_packet_count * OPUS_FRAME_DURATION / 1000
+        if (
+            not self._restart
+            or not self.duration
+            or position > self.duration - EARLY_END_TOLERANCE
+            or self.restarts >= MAXIMUM_RESTARTS
+            or self.closed
+        ):
+            return False
+
+        self.restarts += 1
+        print(f"Pipeline ended {self.duration - position:.0f}s early, restarting it.")
+        try:
+            stream, process = self._restart(position)
+        except Exception as e:
+            restart_counter.inc(label="failed")
+            print(f"Couldn't restart the pipeline: {e!r}")
+            return False
+
+        with self._subscriber_lock:
+            if self.closed:
+                # unsubscribed in the meantime, so nobody will release it
+                processes.release(process)
+                return False
+
+            processes.release(*self.cleanup_processes)
+            processes.release_with(self, [process])
+            self.cleanup_processes = [process]
+            self.stream = stream
+
+        restart_counter.inc(label="resumed")
+        # (the new stream's headers would arrive in the middle of the song)
+        self._packets_iterator = (
+            packet
+            for packet in OggPacketReader(stream).iter_packets()
+            if not packet.startswith(HEADER_PREFIXES)
+        )
+        return True
+
+    def _trim(self: Broadcast) -> None:
+        """
+        Drops the oldest packets beyond `HISTORY_LIMIT` that every reader
+        has read. Must be called with `_read_lock` held.
+        """
+        first_index, packets = self._window
+        if len(packets) <= HISTORY_LIMIT + TRIM_INTERVAL:
+            return
+
+        end_index = first_index + len(packets)
+        with self._subscriber_lock:
+            oldest_position = min(self._positions.values(), default=end_index)
+
+        trim_to = min(oldest_position, end_index - HISTORY_LIMIT)
+        if trim_to > first_index:
+            self._window = (trim_to, packets[trim_to - first_index :])
+
+    def iter_packets(
+        self: Broadcast,
+        start: int = 0,
+        reader: object = None,
+    ) -> Iterator[bytes]:
+        # joining after the start has been trimmed, so start from what's left
+        index = max(start, self.first_index)
+        while (packet := self.packet(index, reader)) is not None:
+            yield packet
+            index += 1
+
+    def subscribe(self: Broadcast) -> None:
+        with self._subscriber_lock:
+            if self.closed:
+                msg = "Cannot subscribe to a closed Broadcast."
+                raise ValueError(msg)
+
+            self.subscriber_count += 1
+
+    def unsubscribe(self: Broadcast) -> None:
+        with self._subscriber_lock:
+            self.subscriber_count -= 1
+            if self.subscriber_count > 0:
+                return
+
+            self.closed = True
+
+        processes.release(*self.cleanup_processes)
+        # (pipes are closed by the reaper too, but files and sockets aren't)
+        with suppress(OSError, ValueError):
+            self.stream.close()
+
+        with self._read_lock:
+            self._window = (self.end_index, [])
+        self._end_pipeline()
+
+    def _end_pipeline(self: Broadcast) -> None:
+        with self._subscriber_lock:
+            if not self.pipeline_active:
+                return
+
+            self.pipeline_active = False
+
+        active_pipelines.dec()
+
+    def source(self: Broadcast, start: int = 0) -> BroadcastAudioSource:
+        return BroadcastAudioSource(self, start)
+
+
+class BroadcastAudioSource(BufferedOpusAudioSource):
+    def __init__(
+        self: BroadcastAudioSource,
+        broadcast: Broadcast,
+        start: int = 0,
+    ) -> None:
+        self.broadcast = broadcast
+        self.reader = broadcast.add_reader(start)
+        super().__init__(broadcast.iter_packets(start, self.reader))
+
+        # (until subscribed, so that cleaning up after a failed subscribe is a no-op)
+        self.unsubscribed = True
+        try:
+            broadcast.subscribe()
+        except ValueError:
+            broadcast.remove_reader(self.reader)
+            raise
+
+        self.unsubscribed = False
+
+    def cleanup(self: BroadcastAudioSource) -> None:
+        if self.suspended:
+            self.suspended = False
+            return
+
+        self.encoder_settings.close()
+        if not self.unsubscribed:
+            self.unsubscribed = True
+            self.broadcast.remove_reader(self.reader)
+            self.broadcast.unsubscribe()
+
+
+class Station:
+    """
+    Radio mode: one guild hosts a station and plays songs as usual,
+    while other guilds tune in and hear whatever the host is currently
+    playing, live, without starting any pipelines of their own.
+    """
+
+    stations: ClassVar[dict[str, Station]] = {}
+
+    def __init__(self: Station, name: str, host_guild_id: int) -> None:
+        self.name = name
+        self.host_guild_id = host_guild_id
+        self.current: Broadcast | None = None
+        self.current_song: BaseSong | None = None
+        self.closed = False
+
+        self._changed = threading.Condition()
+
+    @classmethod
+    def create(cls: type[Station], name: str, host_guild_id: int) -> Station:
+        if (existing := cls.stations.get(name)) and not existing.closed:
+            msg = f"There is already a station called {name!r}."
+            raise ValueError(msg)
+
+        station = cls.stations[name] = cls(name, host_guild_id)
+        return station
+
+    def set_current(self: Station, song: BaseSong) -> None:
+        """
+        Switches every tuned in guild over to the host's new song.
+        """
+        if not isinstance(song.stream, BroadcastAudioSource):
+            return
+
+        broadcast = song.stream.broadcast
+        broadcast.subscribe()
+
+        with self._changed:
+            previous = self.current
+            self.current = broadcast
+            self.current_song = song
+            self._changed.notify_all()
+
+        if previous:
+            previous.unsubscribe()
+
+    def close(self: Station) -> None:
+        with self._changed:
+            self.closed = True
+            previous, self.current = self.current, None
+            self._changed.notify_all()
+
+        if previous:
+            previous.unsubscribe()
+
+        if self.stations.get(self.name) is self:
+            del self.stations[self.name]
+
+    def iter_live_packets(
+        self: Station,
+        listener: StationAudioSource | None = None,
+    ) -> Iterator[bytes]:
+        """
+        Yields whatever the host is playing, from when it's first read, and
+        silence while it isn't playing anything, until the station closes or
+        `listener` (the source being fed) stops.
+        """
+        broadcast: Broadcast | None = None
+        reader: object = None
+        index = 0
+
+        try:
+            while True:
+                with self._changed:
+                    idle = (
+                        self.current is broadcast
+                        and not self.closed
+                        and (not broadcast or broadcast.finished)
+                    )
+                    if idle:
+                        self._changed.wait(OPUS_FRAME_DURATION / 1000)
+
+                    if self.closed or (listener and listener.stopped):
+                        return
+
+                    still_idle = self.current is broadcast and idle
+                    if self.current is not broadcast:
+                        if broadcast:
+                            broadcast.remove_reader(reader)
+
+                        # join the new song at its live edge
+                        broadcast = self.current
+                        assert broadcast is not None
+                        index = broadcast.end_index
+                        reader = broadcast.add_reader(index)
+
+                if still_idle:
+                    # (so the voice client's thread is never stuck in `read`)
+                    yield SILENCE_PACKET
+                    continue
+
+                assert broadcast is not None
+                packet = broadcast.packet(index, reader)
+                if packet is not None:
+                    index += 1
+                    yield packet
+        finally:
+            if broadcast:
+                broadcast.remove_reader(reader)
+
+    def source(self: Station) -> StationAudioSource:
+        return StationAudioSource(self)
+
+
+class StationAudioSource(BufferedOpusAudioSource):
+    def __init__(self: StationAudioSource, station: Station) -> None:
+        # (the generator doesn't run until the first read, after this)
+        super().__init__(station.iter_live_packets(self))
+        # set by `cleanup`, which ends the live packets
+        self.stopped = False
+
+    def cleanup(self: StationAudioSource) -> None:
+        if not self.suspended:
+            self.stopped = True
+
+        super().cleanup()
+
+
+@dataclass
+class StationSong(BaseSong):
+    station: Station
@@ -2,24 +2,47 @@ from __future__ import annotations
 
 import asyncio
 import subprocess
+import time
+import weakref
 from dataclasses import dataclass
+from functools import cache
 from math import log
-from typing import IO, ClassVar, Iterable
+from typing import IO, TYPE_CHECKING, Callable, ClassVar, Iterable, Iterator
 
 import discord
-from discord.oggparse import OggStream
-from pydub import AudioSegment
+
+import metrics
+
+from . import loudness, processes
+from .encoder_settings import AdaptiveEncoderSettings, EncoderLevel, global_level
+from .ogg import OggPacketReader, enlarge_pipe
+
+if TYPE_CHECKING:
+    from types import ModuleType
+
+    import opuslib
+    from pydub import AudioSegment
+
+    from .effects import EffectsChain
 
 
 class OpuslibLoadError(ImportError):
     """Raised when opuslib fails to load."""
 
 
-try:
-    import opuslib
-except Exception as e:
-    msg = "`opuslib` failed to load. Did you install the Opus codec? Please see ./abilities/music/streaming/opus-binary/README.md"
-    raise OpuslibLoadError(msg) from e
+@cache
+def load_opuslib() -> ModuleType:
+    """
+    Imports opuslib on first use, since it loads the native Opus library.
+    """
+    try:
+        import opuslib
+    except Exception as e:
+        msg = "`opuslib` failed to load. Did you install the Opus codec? Please see ./abilities/music/streaming/opus-binary/README.md"
+        raise OpuslibLoadError(msg) from e
+
+    return opuslib
+
 
 OPUS_APPLICATION = "audio"
 OPUS_FRAME_DURATION = 20  # milliseconds
@@ -28,26 +51,69 @@ OPUS_CHANNELS = 2  # stereo
 OPUS_SAMPLE_WIDTH = 2  # opus samples are 16 bits
 OPUS_FRAME_SIZE = OPUS_SAMPLE_RATE // (1000 // OPUS_FRAME_DURATION)
 
+underrun_counter = metrics.counter(
+    "audio_underruns_total",
+    "Packets that took longer than a frame to read, stalling playback.",
+)
+
 
 class BufferedOpusAudioSource(discord.AudioSource):
     def __init__(
         self: BufferedOpusAudioSource,
-        stream: IO[bytes],
+        stream: IO[bytes] | Iterator[bytes],
         cleanup_processes: Iterable[subprocess.Popen] = (),
     ) -> None:
-        self.stream = OggStream(stream)
+        """
+        `stream` is either an Ogg Opus byte stream or an iterator of Opus packets.
+        """
         self.cleanup_processes = cleanup_processes
 
-        self.packets_iterator = self.stream.iter_packets()
-        self.peeked_packet: bytes | None = None
-
-        self.decoder = opuslib.Decoder(OPUS_SAMPLE_RATE, OPUS_CHANNELS)
-        self.encoder = opuslib.Encoder(
-            OPUS_SAMPLE_RATE,
-            OPUS_CHANNELS,
-            OPUS_APPLICATION,
+        # (file objects are iterators too, so check for `read` rather than `__next__`)
+        self.packets_iterator = (
+            OggPacketReader(stream).iter_packets()
+            if hasattr(stream, "read")
+            else stream
         )
+        self.peeked_packet: bytes | None = None
+        self.last_packet: bytes | None = None
+        # whether the stream has run out, as opposed to playback being interrupted
+        self.ended = False
+        # see `suspend`
+        self.suspended = False
+
+        self._decoder: opuslib.Decoder | None = None
+        self._encoder: opuslib.Encoder | None = None
+        self.encoder_settings = AdaptiveEncoderSettings(OPUS_FRAME_DURATION / 1000)
+        # in case this is dropped without being cleaned up
+        weakref.finalize(self, self.encoder_settings.close)
         self.volume: float = 1.0
+        # called (once) when the first packet has been read, e.g. to time startup
+        self.on_first_packet: Callable[[], None] | None = None
+        self.effects: EffectsChain | None = None
+
+    @property
+    def decoder(self: BufferedOpusAudioSource) -> opuslib.Decoder:
+        if self._decoder is None:
+            self._decoder = load_opuslib().Decoder(OPUS_SAMPLE_RATE, OPUS_CHANNELS)
+
+        return self._decoder
+
+    @property
+    def encoder(self: BufferedOpusAudioSource) -> opuslib.Encoder:
+        if self._encoder is None:
+            self._encoder = load_opuslib().Encoder(
+                OPUS_SAMPLE_RATE,
+                OPUS_CHANNELS,
+                OPUS_APPLICATION,
+            )
+            self.apply_encoder_level(self.encoder_settings.level)
+            self.encoder_settings.start()
+
+        return self._encoder
+
+    def apply_encoder_level(self: BufferedOpusAudioSource, level: EncoderLevel) -> None:
+        self.encoder.complexity = level.complexity
+        self.encoder.bitrate = level.bitrate
 
     @property
     def db_gain(self: BufferedOpusAudioSource) -> float:
@@ -69,6 +135,13 @@ class BufferedOpusAudioSource(discord.AudioSource):
         if packet.startswith((b"OpusHead", b"OpusTags")):
             return packet
 
+        if self.db_gain == 0:
+            # Nothing to adjust, so skip decoding and re-encoding entirely
+            return packet
+
+        from pydub import AudioSegment
+
+        started_at = time.perf_counter()
         pcm_data = self.decoder.decode(packet, OPUS_FRAME_SIZE)
 
         segment = AudioSegment(
@@ -81,18 +154,66 @@ class BufferedOpusAudioSource(discord.AudioSource):
         segment = self.adjust_volume(segment)
 
         assert isinstance(segment.raw_data, bytes)
-        return self.encoder.encode(segment.raw_data, OPUS_FRAME_SIZE)
+        encoded = self.encoder.encode(segment.raw_data, OPUS_FRAME_SIZE)
+
+        if level := self.encoder_settings.record(time.perf_counter() - started_at):
+            self.apply_encoder_level(level)
+
+        return encoded
+
+    def postprocess_with_effects(
+        self: BufferedOpusAudioSource,
+        effects: EffectsChain,
+    ) -> bytes:
+        """
+        Like `postprocess_packet`, but runs the audio through `effects`.
+        Some effects change the length of the audio, so this may consume
+        any number of packets to produce one.
+        """
+        while not effects.has_frame():
+            try:
+                packet = next(self.packets_iterator)
+            except StopIteration:
+                # play out what the effects are still holding on to first
+                if not effects.flush():
+                    raise
+                break
+
+            if packet.startswith((b"OpusHead", b"OpusTags")):
+                return packet
+
+            effects.feed(self.decoder.decode(packet, OPUS_FRAME_SIZE))
+
+        gain = 10 ** (self.db_gain / 20)
+        return self.encoder.encode(effects.pop_frame(gain), OPUS_FRAME_SIZE)
 
     def read(self: BufferedOpusAudioSource) -> bytes:
         if self.peeked_packet is not None:
             packet = self.peeked_packet
             self.peeked_packet = None
         else:
+            started_at = time.perf_counter()
             try:
-                packet = self.postprocess_packet(next(self.packets_iterator))
+                if effects := self.effects:
+                    packet = self.postprocess_with_effects(effects)
+                else:
+                    packet = self.postprocess_packet(next(self.packets_iterator))
             except StopIteration:
                 packet = b""
 
+            # the voice client reads one packet per frame, so a slower read
+            # (after the first, which is expected to wait) falls behind
+            elapsed = time.perf_counter() - started_at
+            if packet and self.last_packet and elapsed > OPUS_FRAME_DURATION / 1000:
+                underrun_counter.inc()
+
+        self.last_packet = packet
+        self.ended = not packet
+
+        if self.on_first_packet:
+            on_first_packet, self.on_first_packet = self.on_first_packet, None
+            on_first_packet()
+
         return packet
 
     def peek(self: BufferedOpusAudioSource) -> bytes:
@@ -105,42 +226,118 @@ class BufferedOpusAudioSource(discord.AudioSource):
 
         return self.peeked_packet
 
+    def suspend(self: BufferedOpusAudioSource) -> None:
+        """
+        Keeps this source alive through the next `cleanup` (which the voice
+        client calls once it stops playing it), so that it can be played
+        again from where it left off. The last packet read is assumed to
+        have never been sent, so it's read again.
+        """
+        self.suspended = True
+        if self.last_packet and self.peeked_packet is None:
+            self.peeked_packet = self.last_packet
+
     @staticmethod
     def is_opus() -> bool:
         return True
 
     def cleanup(self: BufferedOpusAudioSource) -> None:
-        for process in self.cleanup_processes:
-            process.kill()
+        if self.suspended:
+            self.suspended = False
+            return
+
+        self.encoder_settings.close()
+        processes.release(*self.cleanup_processes)
+
+
+# When reading from a URL, ffmpeg retries dropped connections and, for seekable
+# streams, resumes with a `Range` request from the byte it stopped at.
+FFMPEG_RECONNECT_ARGUMENTS = [
+    "-reconnect",
+    "1",
+    "-reconnect_streamed",
+    "1",
+    "-reconnect_on_network_error",
+    "1",
+    "-reconnect_delay_max",
+    "5",
+]
 
 
 def transmux_to_ogg_opus(
-    audio_data_stream: IO[bytes],
+    source: IO[bytes] | str,
+    measure_loudness_of: str | None = None,
+    http_headers: dict[str, str] | None = None,
+    start_at: float = 0,
+    gain_db: float = 0,
 ) -> tuple[IO[bytes], subprocess.Popen]:
-    encoding_process = subprocess.Popen(
+    """
+    `source` is either a stream (such as another process's stdout), or a URL
+    (which ffmpeg downloads from directly, sending `http_headers`) or a path,
+    which is read from `start_at` seconds in.
+
+    If `measure_loudness_of` is a video ID, its loudness is measured and
+    recorded along the way (see `loudness.measure_in_background`).
+    `gain_db` is applied while transcoding, so that a known normalization
+    gain doesn't cost re-encoding every packet later.
+    """
+    measure_loudness = measure_loudness_of is not None
+    # (measured before the gain is applied)
+    audio_filters = [
+        *([loudness.FFMPEG_FILTER] if measure_loudness else []),
+        *([f"volume={gain_db:.2f}dB"] if gain_db else []),
+    ]
+
+    if isinstance(source, str):
+        headers = "".join(
+            f"{name}: {value}\r\n" for name, value in (http_headers or {}).items()
+        )
+        is_url = source.startswith(("http://", "https://"))
+        input_arguments = [
+            *(FFMPEG_RECONNECT_ARGUMENTS if is_url else []),
+            *(["-headers", headers] if headers else []),
+            *(["-ss", f"{start_at:.3f}"] if start_at else []),
+            "-i",
+            source,
+        ]
+        stdin: IO[bytes] | int = subprocess.DEVNULL
+    else:
+        input_arguments = ["-i", "pipe:0"]
+        stdin = source
+
+    encoding_process = processes.spawn(
         [
             "ffmpeg",
             "-hide_banner",
             "-loglevel",
-            "error",
-            "-i",
-            "pipe:0",
+            loudness.FFMPEG_LOGLEVEL if measure_loudness else "error",
+            *input_arguments,
+            *(["-af", ",".join(audio_filters)] if audio_filters else []),
             "-f",
             "opus",
             "-application",
             OPUS_APPLICATION,
             "-frame_duration",
             str(OPUS_FRAME_DURATION),
+            *global_level().ffmpeg_arguments(),
             "-ar",
             str(OPUS_SAMPLE_RATE),
             "-ac",
             str(OPUS_CHANNELS),
             "pipe:1",
         ],
-        stdin=audio_data_stream,
+        stdin=stdin,
         stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE if measure_loudness else None,
+        # OggPacketReader does its own buffering
+        bufsize=0,
     )
     assert encoding_process.stdout
+    enlarge_pipe(encoding_process.stdout)
+
+    if measure_loudness_of is not None:
+        assert encoding_process.stderr
+        loudness.measure_in_background(measure_loudness_of, encoding_process.stderr)
 
     return encoding_process.stdout, encoding_process
 
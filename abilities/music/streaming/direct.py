@@ -0,0 +1,511 @@
+"""
+Songs that don't need yt-dlp: direct links to audio files, and files in the
+host's own music library (see `MUSIC_LIBRARY_DIRECTORY` in ENVIRONMENT.md).
+
+The library is indexed with ffprobe (tags, durations and codecs) into a
+persistent index, so that searching it never touches the disk. Refreshing the
+index only probes files that are new or have changed since the last refresh.
+
+Ogg Opus files are read straight into the player, skipping ffmpeg entirely.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import io
+import ipaddress
+import json
+import os
+import socket
+import subprocess
+import threading
+import time
+from contextlib import suppress
+from dataclasses import asdict, dataclass
+from functools import cached_property
+from http.client import HTTPException
+from math import ceil
+from pathlib import Path, PurePosixPath
+from typing import Any, ClassVar
+from urllib.parse import unquote, urlparse
+from urllib.request import HTTPRedirectHandler, Request, build_opener
+
+import metrics
+from config import music_library_directory
+from tracing import span
+
+from . import processes
+from .broadcast import Broadcast
+from .common import Song as BaseSong
+from .common import transmux_to_ogg_opus
+from .loudness import measured_loudness, normalization_gain
+
+LIBRARY_INDEX_FILE = Path("music_library_index.json")
+AUDIO_EXTENSIONS = frozenset(
+    {".aac", ".flac", ".m4a", ".mp3", ".oga", ".ogg", ".opus", ".wav", ".webm"},
+)
+PROBE_TIMEOUT = 15  # seconds
+HTTP_TIMEOUT = 10  # seconds
+MAXIMUM_RESUMES = 5  # per stream
+RESUME_DELAY = 1  # seconds
+SEARCH_RESULTS = 10
+
+fetch_histogram = metrics.histogram(
+    "direct_fetch_seconds",
+    "Time from fetching a linked or library song to its stream having started.",
+)
+
+
+class UnplayableSource(Exception):
+    """The message is meant to be shown to the user."""
+
+
+@dataclass
+class Song(BaseSong):
+    platform_color: ClassVar[int] = 0x9B59B6
+
+    album: str
+    source: str  # a URL or a path
+
+
+@dataclass
+class Description:
+    """
+    What ffprobe found out about an audio file.
+    """
+
+    title: str
+    artist: str
+    album: str
+    duration: float  # seconds
+    is_ogg_opus: bool
+
+
+@dataclass
+class LibraryEntry(Description):
+    path: str  # relative to the library directory
+    size: int  # bytes
+    modified_at: float  # unix timestamp
+
+    @cached_property
+    def search_text(self: LibraryEntry) -> str:
+        return f"{self.title} {self.artist} {self.album} {self.path}".lower()
+
+
+class PublicRedirectHandler(HTTPRedirectHandler):
+    """
+    Follows redirects, unless they lead to a private network address.
+    """
+
+    def redirect_request(
+        self: PublicRedirectHandler,
+        request: Request,
+        response: Any,  # noqa: ANN401
+        code: int,
+        message: str,
+        headers: Any,  # noqa: ANN401
+        new_url: str,
+    ) -> Request | None:
+        refuse_private_url(new_url)
+        return super().redirect_request(
+            request,
+            response,
+            code,
+            message,
+            headers,
+            new_url,
+        )
+
+
+opener = build_opener(PublicRedirectHandler)
+
+
+class RangedHTTPStream(io.RawIOBase):
+    """
+    Reads a URL from start to finish. If the connection drops partway through
+    and the server accepts ranges, reading carries on with a `Range` request
+    from the byte it stopped at, instead of the song ending early.
+    """
+
+    def __init__(self: RangedHTTPStream, url: str) -> None:
+        self.url = url
+        self.position = 0
+        self.resumes = 0
+
+        try:
+            self.response = opener.open(url, timeout=HTTP_TIMEOUT)
+        except (OSError, HTTPException) as e:
+            # (HTTPError and URLError are OSErrors)
+            msg = f"Couldn't download {url!r}: {e}"
+            raise UnplayableSource(msg) from e
+
+        self.accepts_ranges = self.response.headers.get("Accept-Ranges") == "bytes"
+        length = self.response.headers.get("Content-Length")
+        self.length = int(length) if length and length.isdigit() else None
+
+    def readable(self: RangedHTTPStream) -> bool:
+        return True
+
+    def _resume(self: RangedHTTPStream) -> bool:
+        while self.resumes < MAXIMUM_RESUMES:
+            self.resumes += 1
+            self.response.close()
+            time.sleep(RESUME_DELAY * (self.resumes - 1))
+
+            request = Request(self.url, headers={"Range": f"bytes={self.position}-"})
+            try:
+                response = opener.open(request, timeout=HTTP_TIMEOUT)
+            except (OSError, HTTPException):
+                continue
+            except UnplayableSource:
+                return False
+
+            if response.status != 206:
+                # starting over would repeat what's already been played
+                response.close()
+                return False
+
+            self.response = response
+            return True
+
+        return False
+
+    def readinto(self: RangedHTTPStream, buffer: Any) -> int:  # noqa: ANN401
+        while True:
+            try:
+                read = self.response.readinto(buffer)
+                interrupted = False
+            except (OSError, HTTPException, ValueError):
+                # ValueError: the response was closed underneath us
+                read = 0
+                interrupted = not self.closed
+
+            if read:
+                self.position += read
+                return read
+
+            truncated = self.length is not None and self.position < self.length
+            if not (interrupted or truncated) or not self.accepts_ranges:
+                return 0
+
+            if not self._resume():
+                return 0
+
+    def close(self: RangedHTTPStream) -> None:
+        # (there's no response if opening the URL failed)
+        with suppress(AttributeError):
+            self.response.close()
+        super().close()
+
+
+def is_private_address(address: str) -> bool:
+    """
+    Whether `address` is an IP address that isn't on the public internet,
+    such as a loopback, private network or link-local address.
+    """
+    try:
+        ip = ipaddress.ip_address(address.partition("%")[0])  # (without IPv6 zones)
+    except ValueError:
+        return False
+
+    return not ip.is_global or ip.is_multicast
+
+
+def is_private_host(host: str) -> bool:
+    """
+    Whether `host` is a private address or a name for one, without looking it up.
+    """
+    host = host.lower().rstrip(".")
+    return (
+        host in {"", "localhost"}
+        or host.endswith(".localhost")
+        or (is_private_address(host))
+    )
+
+
+def resolves_to_private_address(host: str) -> bool:
+    """
+    Whether any of the addresses `host` resolves to is private, so that links
+    can't be used to reach services on the bot's own network.
+    """
+    try:
+        addresses = socket.getaddrinfo(host, None)
+    except OSError:
+        # ffprobe won't be able to resolve it either
+        return False
+
+    return any(is_private_address(str(address[4][0])) for address in addresses)
+
+
+def refuse_private_url(url: str) -> None:
+    host = urlparse(url).hostname or ""
+    if is_private_host(host) or resolves_to_private_address(host):
+        msg = "I can't play links to private network addresses."
+        raise UnplayableSource(msg)
+
+
+def resolve_public_url(url: str) -> str:
+    """
+    Where `url` ends up after redirects, refusing private addresses along the
+    way. ffprobe, ffmpeg and yt-dlp follow redirects without asking, so they
+    should be given this instead.
+    """
+    refuse_private_url(url)
+    try:
+        with opener.open(url, timeout=HTTP_TIMEOUT) as response:
+            return response.geturl()
+    except (OSError, HTTPException) as e:
+        msg = f"Couldn't download {url!r}: {e}"
+        raise UnplayableSource(msg) from e
+
+
+def is_url(song: str) -> bool:
+    return urlparse(song.strip()).scheme in {"http", "https"}
+
+
+def is_audio_url(song: str) -> bool:
+    path = PurePosixPath(urlparse(song.strip()).path)
+    return is_url(song) and path.suffix.lower() in AUDIO_EXTENSIONS
+
+
+def probe(source: str) -> dict[str, Any]:
+    probe_process = processes.spawn(
+        [
+            "ffprobe",
+            "-v",
+            "error",
+            "-select_streams",
+            "a:0",
+            "-show_format",
+            "-show_streams",
+            "-of",
+            "json",
+            source,
+        ],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        output, _ = probe_process.communicate(timeout=PROBE_TIMEOUT)
+    except subprocess.TimeoutExpired:
+        output = b""
+    finally:
+        processes.release(probe_process)
+
+    try:
+        info = json.loads(output)
+    except json.JSONDecodeError:
+        info = {}
+
+    if not info.get("streams"):
+        msg = "That doesn't seem to be an audio file."
+        raise UnplayableSource(msg)
+
+    return info
+
+
+def describe(info: dict[str, Any], fallback_title: str) -> Description:
+    media_format = info.get("format", {})
+    stream = info["streams"][0]
+    # Ogg keeps its tags on the stream, most other containers on the format
+    tags = {
+        name.lower(): value
+        for source in (stream, media_format)
+        for name, value in source.get("tags", {}).items()
+    }
+
+    try:
+        duration = float(media_format.get("duration") or stream.get("duration") or 0)
+    except ValueError:
+        duration = 0.0
+
+    return Description(
+        title=tags.get("title") or fallback_title,
+        artist=tags.get("artist") or tags.get("album_artist") or "Unknown artist",
+        album=tags.get("album", ""),
+        duration=duration,
+        is_ogg_opus=(
+            stream.get("codec_name") == "opus"
+            and "ogg" in media_format.get("format_name", "").split(",")
+        ),
+    )
+
+
+_index_lock = threading.Lock()
+_index: dict[str, LibraryEntry] | None = None
+_indexer: threading.Thread | None = None
+
+
+def _load_index() -> dict[str, LibraryEntry]:
+    global _index  # noqa: PLW0603
+
+    if _index is None:
+        _index = {}
+        with suppress(FileNotFoundError, json.JSONDecodeError, TypeError, KeyError):
+            entries = json.loads(LIBRARY_INDEX_FILE.read_text())
+            _index = {entry["path"]: LibraryEntry(**entry) for entry in entries}
+
+    return _index
+
+
+def library_index() -> dict[str, LibraryEntry]:
+    """
+    The library as of the last refresh. The first call also starts
+    refreshing it in the background, to pick up files added since then.
+    """
+    global _indexer  # noqa: PLW0603
+
+    with _index_lock:
+        index = _load_index()
+        if _indexer is None and music_library_directory:
+            _indexer = threading.Thread(
+                target=refresh_index,
+                args=(Path(music_library_directory),),
+                name="library indexer",
+                daemon=True,
+            )
+            _indexer.start()
+
+    return index
+
+
+def refresh_index(directory: Path) -> int:
+    """
+    Probes new and changed files, forgets deleted ones, and saves the index.
+    Returns the number of files probed.
+    """
+    global _index  # noqa: PLW0603
+
+    with _index_lock:
+        previous = _load_index()
+
+    index: dict[str, LibraryEntry] = {}
+    probed = 0
+    for file in sorted(directory.rglob("*")):
+        if file.suffix.lower() not in AUDIO_EXTENSIONS or not file.is_file():
+            continue
+
+        path = file.relative_to(directory).as_posix()
+        stat = file.stat()
+        entry = previous.get(path)
+        if entry and (entry.size, entry.modified_at) == (stat.st_size, stat.st_mtime):
+            index[path] = entry
+            continue
+
+        try:
+            description = describe(probe(str(file)), fallback_title=file.stem)
+        except UnplayableSource:
+            continue
+
+        probed += 1
+        index[path] = LibraryEntry(
+            **asdict(description),
+            path=path,
+            size=stat.st_size,
+            modified_at=stat.st_mtime,
+        )
+
+    with _index_lock:
+        _index = index
+
+        entries = [asdict(entry) for entry in index.values()]
+        temporary_file = LIBRARY_INDEX_FILE.with_suffix(".tmp")
+        temporary_file.write_text(json.dumps(entries))
+        os.replace(temporary_file, LIBRARY_INDEX_FILE)
+
+    print(f"Indexed the music library: {len(index)} files, {probed} newly probed")
+    return probed
+
+
+def search_library(query: str, limit: int = SEARCH_RESULTS) -> list[LibraryEntry]:
+    words = query.lower().split()
+    matches = [
+        entry
+        for entry in library_index().values()
+        if all(word in entry.search_text for word in words)
+    ]
+    matches.sort(
+        key=lambda entry: (
+            entry.artist.lower(),
+            entry.album.lower(),
+            entry.title.lower(),
+        )
+    )
+    return matches[:limit]
+
+
+def open_song(source: str, description: Description, url: str) -> Song:
+    """
+    Starts streaming `source`, which is a URL or a path.
+    """
+    loudness_key = f"file:{url or source}"
+    if description.is_ogg_opus:
+        # already what Discord wants, so there's nothing for ffmpeg to do
+        stream = (
+            RangedHTTPStream(source)
+            if source.startswith(("http://", "https://"))
+            else open(source, "rb")  # noqa: SIM115
+        )
+        broadcast = Broadcast(stream)
+    else:
+        with span("start ffmpeg"):
+            encoded_audio_stream, transmuxing_process = transmux_to_ogg_opus(
+                source,
+                measure_loudness_of=(
+                    loudness_key if measured_loudness(loudness_key) is None else None
+                ),
+                gain_db=normalization_gain(loudness_key),
+            )
+        broadcast = Broadcast(encoded_audio_stream, [transmuxing_process])
+
+    return Song(
+        title=description.title,
+        artist=description.artist,
+        artist_url="",
+        url=url,
+        image_url="",
+        duration=ceil(description.duration),
+        album=description.album,
+        source=source,
+        stream=broadcast.source(),
+    )
+
+
+def fetch_url_synchronously(url: str) -> Song:
+    url = url.strip()
+    source = resolve_public_url(url)
+
+    with span("ffprobe"):
+        info = probe(source)
+
+    fallback_title = unquote(PurePosixPath(urlparse(url).path).stem)
+    return open_song(source, describe(info, fallback_title), url)
+
+
+def fetch_from_library_synchronously(query: str) -> Song:
+    if not music_library_directory:
+        msg = "This bot doesn't have a music library."
+        raise UnplayableSource(msg)
+
+    # autocomplete suggests paths, but anything else is searched for
+    entry = library_index().get(query) or next(iter(search_library(query, 1)), None)
+    file = Path(music_library_directory) / entry.path if entry else None
+    if not entry or not file or not file.is_file():
+        msg = f"Couldn't find {query!r} in the music library."
+        raise UnplayableSource(msg)
+
+    return open_song(str(file), entry, "")
+
+
+async def fetch_url(url: str) -> Song:
+    started_at = time.perf_counter()
+    song = await asyncio.to_thread(fetch_url_synchronously, url)
+    fetch_histogram.observe(time.perf_counter() - started_at)
+    return song
+
+
+async def fetch_from_library(query: str) -> Song:
+    started_at = time.perf_counter()
+    song = await asyncio.to_thread(fetch_from_library_synchronously, query)
+    fetch_histogram.observe(time.perf_counter() - started_at)
+    return song
@@ -0,0 +1,310 @@
+"""
+Real-time audio effects, applied to decoded PCM in 20 millisecond blocks.
+
+Every effect carries its state (filter memory, envelopes, resampling position)
+from one block to the next, so that block boundaries are inaudible.
+"""
+
+from __future__ import annotations
+
+import time
+from abc import ABC, abstractmethod
+from dataclasses import dataclass
+from math import cos, exp, pi, sin, sqrt
+
+import numpy as np
+from scipy.signal import sosfilt
+
+import metrics
+
+from .common import (
+    OPUS_CHANNELS,
+    OPUS_FRAME_DURATION,
+    OPUS_FRAME_SIZE,
+    OPUS_SAMPLE_RATE,
+)
+
+# If the chain takes longer than this for CONSECUTIVE_OVERRUNS blocks in a row,
+# it's bypassed for BYPASS_BLOCKS blocks instead of causing underruns.
+CPU_BUDGET = 0.005  # seconds per 20ms block
+CONSECUTIVE_OVERRUNS = 3
+BYPASS_BLOCKS = 250  # 5 seconds
+
+MINIMUM_SPEED = 0.5
+MAXIMUM_SPEED = 2.0
+
+bypass_counter = metrics.counter(
+    "audio_effects_bypassed_total",
+    "Number of times an effects chain went over its CPU budget and was bypassed.",
+)
+
+
+class Effect(ABC):
+    @abstractmethod
+    def process(self: Effect, block: np.ndarray) -> np.ndarray:
+        """
+        `block` has shape (samples, channels) and values from -1 to 1.
+        """
+
+
+class Equalizer(Effect):
+    """
+    A cascade of biquad filters (RBJ Audio EQ Cookbook) run through
+    `scipy.signal.sosfilt`, which keeps each section's state between blocks.
+    """
+
+    def __init__(self: Equalizer, sections: list[list[float]]) -> None:
+        self.sos = np.array(sections)
+        self.state = np.zeros((len(sections), 2, OPUS_CHANNELS))
+
+    @staticmethod
+    def _normalize(b: list[float], a: list[float]) -> list[float]:
+        return [b[0] / a[0], b[1] / a[0], b[2] / a[0], 1, a[1] / a[0], a[2] / a[0]]
+
+    @classmethod
+    def low_shelf(
+        cls: type[Equalizer],
+        frequency: float,
+        gain_db: float,
+    ) -> list[float]:
+        a_ = 10 ** (gain_db / 40)
+        w0 = 2 * pi * frequency / OPUS_SAMPLE_RATE
+        alpha = sin(w0) / 2 * sqrt(2)
+        cos_w0, root = cos(w0), 2 * sqrt(a_) * alpha
+        return cls._normalize(
+            [
+                a_ * ((a_ + 1) - (a_ - 1) * cos_w0 + root),
+                2 * a_ * ((a_ - 1) - (a_ + 1) * cos_w0),
+                a_ * ((a_ + 1) - (a_ - 1) * cos_w0 - root),
+            ],
+            [
+                (a_ + 1) + (a_ - 1) * cos_w0 + root,
+                -2 * ((a_ - 1) + (a_ + 1) * cos_w0),
+                (a_ + 1) + (a_ - 1) * cos_w0 - root,
+            ],
+        )
+
+    @classmethod
+    def high_shelf(
+        cls: type[Equalizer],
+        frequency: float,
+        gain_db: float,
+    ) -> list[float]:
+        a_ = 10 ** (gain_db / 40)
+        w0 = 2 * pi * frequency / OPUS_SAMPLE_RATE
+        alpha = sin(w0) / 2 * sqrt(2)
+        cos_w0, root = cos(w0), 2 * sqrt(a_) * alpha
+        return cls._normalize(
+            [
+                a_ * ((a_ + 1) + (a_ - 1) * cos_w0 + root),
+                -2 * a_ * ((a_ - 1) + (a_ + 1) * cos_w0),
+                a_ * ((a_ + 1) + (a_ - 1) * cos_w0 - root),
+            ],
+            [
+                (a_ + 1) - (a_ - 1) * cos_w0 + root,
+                2 * ((a_ - 1) - (a_ + 1) * cos_w0),
+                (a_ + 1) - (a_ - 1) * cos_w0 - root,
+            ],
+        )
+
+    @classmethod
+    def peaking(
+        cls: type[Equalizer],
+        frequency: float,
+        gain_db: float,
+        q: float = 1.0,
+    ) -> list[float]:
+        a_ = 10 ** (gain_db / 40)
+        w0 = 2 * pi * frequency / OPUS_SAMPLE_RATE
+        alpha = sin(w0) / (2 * q)
+        return cls._normalize(
+            [1 + alpha * a_, -2 * cos(w0), 1 - alpha * a_],
+            [1 + alpha / a_, -2 * cos(w0), 1 - alpha / a_],
+        )
+
+    def process(self: Equalizer, block: np.ndarray) -> np.ndarray:
+        output, self.state = sosfilt(self.sos, block, axis=0, zi=self.state)
+        return output
+
+
+class Compressor(Effect):
+    """
+    A feed-forward compressor whose gain is computed once per block from the
+    block's RMS level and ramped across the block to avoid zipper noise.
+    """
+
+    def __init__(
+        self: Compressor,
+        threshold_db: float = -18.0,
+        ratio: float = 4.0,
+        attack: float = 0.01,  # seconds
+        release: float = 0.2,  # seconds
+        makeup_db: float = 6.0,
+    ) -> None:
+        self.threshold_db = threshold_db
+        self.ratio = ratio
+        self.attack_coefficient = 1 - exp(-OPUS_FRAME_DURATION / 1000 / attack)
+        self.release_coefficient = 1 - exp(-OPUS_FRAME_DURATION / 1000 / release)
+        self.makeup_db = makeup_db
+        self.gain_db = 0.0
+
+    def process(self: Compressor, block: np.ndarray) -> np.ndarray:
+        rms = float(np.sqrt(np.mean(np.square(block))))
+        level_db = 20 * np.log10(rms + 1e-9)
+        overshoot = level_db - self.threshold_db
+        target_db = -overshoot * (1 - 1 / self.ratio) if overshoot > 0 else 0.0
+
+        coefficient = (
+            self.attack_coefficient
+            if target_db < self.gain_db
+            else self.release_coefficient
+        )
+        previous_db = self.gain_db
+        self.gain_db += (target_db - self.gain_db) * coefficient
+
+        ramp = np.linspace(previous_db, self.gain_db, len(block), dtype=block.dtype)
+        return block * (10 ** ((ramp + self.makeup_db) / 20))[:, np.newaxis]
+
+
+class Speed(Effect):
+    """
+    Changes speed (and pitch, like a turntable) by resampling with linear
+    interpolation. The fractional read position and the last sample of each
+    block carry over, so the output is continuous but varies in length.
+    """
+
+    def __init__(self: Speed, factor: float) -> None:
+        self.factor = factor
+        self.position = 0.0
+        self.tail: np.ndarray | None = None
+
+    def process(self: Speed, block: np.ndarray) -> np.ndarray:
+        samples = block if self.tail is None else np.concatenate((self.tail, block))
+        positions = np.arange(self.position, len(samples) - 1, self.factor)
+        indices = positions.astype(np.intp)
+        fractions = (positions - indices)[:, np.newaxis]
+
+        output = samples[indices] * (1 - fractions) + samples[indices + 1] * fractions
+
+        next_position = positions[-1] + self.factor if len(positions) else self.position
+        self.position = next_position - (len(samples) - 1)
+        self.tail = samples[-1:]
+        return output
+
+
+@dataclass(frozen=True)
+class EffectSettings:
+    bass_db: float = 0.0
+    mid_db: float = 0.0
+    treble_db: float = 0.0
+    compressor: bool = False
+    speed: float = 1.0
+
+    @property
+    def enabled(self: EffectSettings) -> bool:
+        return self != EffectSettings()
+
+    def describe(self: EffectSettings) -> list[str]:
+        descriptions = [
+            f"{name} {gain:+.1f} dB"
+            for name, gain in (
+                ("Bass", self.bass_db),
+                ("Mid", self.mid_db),
+                ("Treble", self.treble_db),
+            )
+            if gain
+        ]
+        if self.compressor:
+            descriptions.append("Compressor")
+        if self.speed != 1:
+            descriptions.append(f"Speed {self.speed:g}x")
+
+        return descriptions
+
+    def build_chain(self: EffectSettings) -> EffectsChain | None:
+        if not self.enabled:
+            return None
+
+        effects: list[Effect] = []
+        if self.speed != 1:
+            effects.append(Speed(self.speed))
+
+        sections = [
+            section
+            for gain, section in (
+                (self.bass_db, Equalizer.low_shelf(120, self.bass_db)),
+                (self.mid_db, Equalizer.peaking(1000, self.mid_db)),
+                (self.treble_db, Equalizer.high_shelf(6000, self.treble_db)),
+            )
+            if gain
+        ]
+        if sections:
+            effects.append(Equalizer(sections))
+
+        if self.compressor:
+            effects.append(Compressor())
+
+        return EffectsChain(effects)
+
+
+class EffectsChain:
+    """
+    Runs decoded PCM through each effect and hands it back out in whole
+    Opus frames, since effects like `Speed` change the number of samples.
+    """
+
+    def __init__(self: EffectsChain, effects: list[Effect]) -> None:
+        self.effects = effects
+        self.pending = np.zeros((0, OPUS_CHANNELS), dtype=np.float32)
+        self.consecutive_overruns = 0
+        self.bypassed_blocks = 0
+
+    def feed(self: EffectsChain, pcm: bytes) -> None:
+        block = (
+            np.frombuffer(pcm, dtype=np.int16).reshape(-1, OPUS_CHANNELS) / 32768
+        ).astype(np.float32)
+
+        if self.bypassed_blocks:
+            self.bypassed_blocks -= 1
+        else:
+            started_at = time.perf_counter()
+            for effect in self.effects:
+                block = effect.process(block)
+
+            if time.perf_counter() - started_at <= CPU_BUDGET:
+                self.consecutive_overruns = 0
+            else:
+                self.consecutive_overruns += 1
+                if self.consecutive_overruns >= CONSECUTIVE_OVERRUNS:
+                    self.consecutive_overruns = 0
+                    self.bypassed_blocks = BYPASS_BLOCKS
+                    bypass_counter.inc()
+
+        self.pending = np.concatenate((self.pending, block))
+
+    def has_frame(self: EffectsChain) -> bool:
+        return len(self.pending) >= OPUS_FRAME_SIZE
+
+    def flush(self: EffectsChain) -> bool:
+        """
+        Pads the leftover samples out to a whole frame with silence,
+        once the stream has ended. Returns whether there were any.
+        """
+        leftover = len(self.pending) % OPUS_FRAME_SIZE
+        if not leftover:
+            return self.has_frame()
+
+        padding = np.zeros((OPUS_FRAME_SIZE - leftover, OPUS_CHANNELS), np.float32)
+        self.pending = np.concatenate((self.pending, padding))
+        return True
+
+    def pop_frame(self: EffectsChain, gain: float) -> bytes:
+        """
+        Removes one frame of audio, scaled by `gain` and hard limited,
+        as 16 bit PCM ready for the Opus encoder.
+        """
+        frame, self.pending = (
+            self.pending[:OPUS_FRAME_SIZE],
+            self.pending[OPUS_FRAME_SIZE:],
+        )
+        return np.clip(frame * (gain * 32768), -32768, 32767).astype(np.int16).tobytes()
@@ -0,0 +1,175 @@
+from __future__ import annotations
+
+import os
+import time
+from dataclasses import dataclass
+
+import metrics
+from config import (
+    opus_max_bitrate,
+    opus_max_complexity,
+    opus_min_bitrate,
+    opus_min_complexity,
+)
+
+OPUS_AUTO = -1000  # `opuslib.constants.AUTO`, lets libopus pick the bitrate
+LEVEL_COUNT = 5
+
+# Fraction of each 20ms frame that postprocessing one packet may use before we
+# consider the stream to be under pressure. Every stream shares the same CPU,
+# so this is much less than 100%.
+PRESSURE_FRACTION = 0.25
+RELIEF_FRACTION = 0.05
+HOST_LOAD_PRESSURE = 0.9  # load average per CPU
+HOST_LOAD_RELIEF = 0.6
+
+SMOOTHING = 0.05  # weight of the newest sample in the moving average
+PACKETS_BETWEEN_CHANGES = 250  # 5 seconds of audio
+
+streams_per_level = metrics.gauge(
+    "opus_encoder_streams",
+    "Number of audio streams at each encoder level (0 is the highest quality).",
+    label_name="level",
+)
+
+
+@dataclass(frozen=True)
+class EncoderLevel:
+    complexity: int
+    bitrate: int  # bits per second, or OPUS_AUTO
+
+    def ffmpeg_arguments(self: EncoderLevel) -> list[str]:
+        arguments = ["-compression_level", str(self.complexity)]
+        if self.bitrate != OPUS_AUTO:
+            arguments += ["-b:a", str(self.bitrate)]
+
+        return arguments
+
+
+def build_levels() -> list[EncoderLevel]:
+    """
+    Interpolates from the configured ceiling (level 0) to the floor.
+    """
+    top_bitrate = opus_max_bitrate or 128000
+    levels = [EncoderLevel(opus_max_complexity, opus_max_bitrate or OPUS_AUTO)]
+    for step in range(1, LEVEL_COUNT):
+        fraction = step / (LEVEL_COUNT - 1)
+        levels.append(
+            EncoderLevel(
+                complexity=round(
+                    opus_max_complexity
+                    - (opus_max_complexity - opus_min_complexity) * fraction,
+                ),
+                bitrate=round(
+                    top_bitrate - (top_bitrate - opus_min_bitrate) * fraction,
+                ),
+            ),
+        )
+
+    return levels
+
+
+LEVELS = build_levels()
+
+_host_load: tuple[float, float] = (0.0, 0.0)  # (measured at, load per CPU)
+
+
+def host_load() -> float:
+    """
+    The 1 minute load average per CPU, sampled at most once per second.
+    Always 0 on platforms without `os.getloadavg` (Windows).
+    """
+    global _host_load  # noqa: PLW0603
+
+    measured_at, load = _host_load
+    now = time.monotonic()
+    if now - measured_at > 1:
+        try:
+            load = os.getloadavg()[0] / (os.cpu_count() or 1)
+        except (AttributeError, OSError):
+            load = 0.0
+        _host_load = (now, load)
+
+    return load
+
+
+def global_level() -> EncoderLevel:
+    """
+    The level new pipelines should start at, based only on the host's load.
+    """
+    return LEVELS[-1] if host_load() > HOST_LOAD_PRESSURE else LEVELS[0]
+
+
+class AdaptiveEncoderSettings:
+    """
+    Tracks how long a stream takes to postprocess each packet and chooses
+    its encoder level, stepping down a level at a time under pressure and
+    back up once things have been calm for a while.
+    """
+
+    def __init__(self: AdaptiveEncoderSettings, frame_duration: float) -> None:
+        self.frame_duration = frame_duration
+        self.average_processing_time = 0.0
+        self.level_index = 0
+        self.packets_since_change = 0
+        # counted in `streams_per_level` (see `start`)
+        self.started = False
+        self.closed = False
+
+    @property
+    def level(self: AdaptiveEncoderSettings) -> EncoderLevel:
+        return LEVELS[self.level_index]
+
+    def start(self: AdaptiveEncoderSettings) -> None:
+        """
+        Counts the stream in `streams_per_level` once it first encodes, since
+        streams that pass their packets through untouched don't encode at all.
+        """
+        if not self.started and not self.closed:
+            self.started = True
+            streams_per_level.inc(label=str(self.level_index))
+
+    def record(
+        self: AdaptiveEncoderSettings,
+        processing_time: float,
+    ) -> EncoderLevel | None:
+        """
+        Records how long a packet took to process.
+        Returns the new level if it changed.
+        """
+        self.average_processing_time += SMOOTHING * (
+            processing_time - self.average_processing_time
+        )
+        self.packets_since_change += 1
+        if self.packets_since_change < PACKETS_BETWEEN_CHANGES:
+            return None
+
+        budget_used = self.average_processing_time / self.frame_duration
+        load = host_load()
+
+        if budget_used > PRESSURE_FRACTION or load > HOST_LOAD_PRESSURE:
+            new_index = min(self.level_index + 1, len(LEVELS) - 1)
+        elif budget_used < RELIEF_FRACTION and load < HOST_LOAD_RELIEF:
+            new_index = max(self.level_index - 1, 0)
+        else:
+            new_index = self.level_index
+
+        if new_index == self.level_index:
+            return None
+
+        self._set_level_index(new_index)
+        return self.level
+
+    def _set_level_index(self: AdaptiveEncoderSettings, index: int) -> None:
+        if self.started and not self.closed:
+            streams_per_level.dec(label=str(self.level_index))
+            streams_per_level.inc(label=str(index))
+
+        self.level_index = index
+        self.packets_since_change = 0
+
+    def close(self: AdaptiveEncoderSettings) -> None:
+        if not self.closed:
+            self.closed = True
+            if self.started:
+                streams_per_level.dec(label=str(self.level_index))
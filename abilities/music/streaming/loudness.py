@@ -0,0 +1,104 @@
+"""
+Loudness normalization.
+
+The first time a video is transcoded, ffmpeg's `ebur128` filter measures its
+integrated loudness along the way. The measurement is saved to a persistent
+index, and every later play of that video is turned up or down to
+`loudness_target` by a fixed gain that ffmpeg applies while transcoding it.
+"""
+
+from __future__ import annotations
+
+import json
+import os
+import re
+import sys
+import threading
+from contextlib import suppress
+from pathlib import Path
+from typing import IO
+
+from config import loudness_target
+
+LOUDNESS_INDEX_FILE = Path("loudness_index.json")
+MAXIMUM_BOOST = 6.0  # decibels, quiet tracks aren't boosted further to avoid clipping
+MAXIMUM_CUT = 20.0  # decibels
+
+# ffmpeg's `ebur128` summary contains a line like "    I:         -19.5 LUFS"
+INTEGRATED_LOUDNESS_REGEX = re.compile(rb"\bI:\s*(-?\d+(?:\.\d+)?) LUFS")
+FFMPEG_ERROR_REGEX = re.compile(rb"\[(?:error|fatal|panic)\]")
+
+# ffmpeg prints the `ebur128` summary at the info level once it reaches the end of
+# the input. `level` prefixes lines with their level so that errors can be told apart.
+# `framelog=quiet` hides the per-frame measurements.
+FFMPEG_LOGLEVEL = "level+info"
+FFMPEG_FILTER = "ebur128=framelog=quiet"
+
+_index_lock = threading.Lock()
+_index: dict[str, float] | None = None
+
+
+def _load_index() -> dict[str, float]:
+    global _index  # noqa: PLW0603
+
+    if _index is None:
+        _index = {}
+        with suppress(FileNotFoundError, json.JSONDecodeError):
+            _index = json.loads(LOUDNESS_INDEX_FILE.read_text())
+
+    return _index
+
+
+def measured_loudness(video_id: str) -> float | None:
+    with _index_lock:
+        return _load_index().get(video_id)
+
+
+def measured_videos() -> list[str]:
+    with _index_lock:
+        return list(_load_index())
+
+
+def record_loudness(video_id: str, loudness: float) -> None:
+    with _index_lock:
+        index = _load_index()
+        index[video_id] = loudness
+
+        temporary_file = LOUDNESS_INDEX_FILE.with_suffix(".tmp")
+        temporary_file.write_text(json.dumps(index))
+        os.replace(temporary_file, LOUDNESS_INDEX_FILE)
+
+
+def normalization_gain(video_id: str) -> float:
+    """
+    The gain (in decibels) that brings `video_id` to the target loudness,
+    or 0 if it hasn't been measured yet.
+    """
+    loudness = measured_loudness(video_id)
+    if loudness is None:
+        return 0.0
+
+    return max(-MAXIMUM_CUT, min(MAXIMUM_BOOST, loudness_target - loudness))
+
+
+def measure_in_background(video_id: str, ffmpeg_stderr: IO[bytes]) -> None:
+    """
+    Watches the output of an ffmpeg process run with FFMPEG_LOGLEVEL and FFMPEG_FILTER.
+    Errors are passed through to our stderr and the loudness is recorded once
+    the summary is printed. Nothing is recorded if ffmpeg is killed first.
+    """
+
+    def watch() -> None:
+        loudness = None
+        # ValueError: the pipe was closed by `processes.reap` after ffmpeg was killed
+        with ffmpeg_stderr, suppress(ValueError):
+            for line in ffmpeg_stderr:
+                if FFMPEG_ERROR_REGEX.search(line):
+                    sys.stderr.write(line.decode(errors="replace"))
+                elif match := INTEGRATED_LOUDNESS_REGEX.search(line):
+                    loudness = float(match.group(1))
+
+        if loudness is not None:
+            record_loudness(video_id, loudness)
+
+    threading.Thread(target=watch, name=f"loudness:{video_id}", daemon=True).start()
@@ -0,0 +1,118 @@
+from __future__ import annotations
+
+from contextlib import suppress
+from typing import IO, Iterator
+
+OGG_CAPTURE_PATTERN = b"OggS"
+OGG_PAGE_HEADER_SIZE = 27
+OGG_SEGMENT_COUNT_OFFSET = 26
+OGG_MAX_PAGE_SIZE = OGG_PAGE_HEADER_SIZE + 255 + 255 * 255
+
+READ_SIZE = 64 * 1024
+PIPE_SIZE = 1024 * 1024
+
+
+class OggError(ValueError):
+    """Raised when the stream is not valid Ogg."""
+
+
+class OggPacketReader:
+    """
+    Demultiplexes packets from an Ogg stream.
+
+    Unlike `discord.oggparse.OggStream`, which makes three small reads (and
+    allocations) per page, this reads large chunks into one reusable buffer
+    and parses pages in place through a `memoryview`. Only each page's body
+    is copied out, and packets are sliced from it.
+    """
+
+    def __init__(
+        self: OggPacketReader,
+        stream: IO[bytes],
+        read_size: int = READ_SIZE,
+    ) -> None:
+        self.stream = stream
+        self.read_size = read_size
+
+        # Always large enough to hold a whole page plus one read
+        self.buffer = bytearray(max(read_size, OGG_MAX_PAGE_SIZE) + read_size)
+        self.view = memoryview(self.buffer)
+        self.start = 0  # first unparsed byte
+        self.end = 0  # one past the last byte read
+
+    def _fill(self: OggPacketReader, minimum: int) -> bool:
+        """
+        Reads until at least `minimum` unparsed bytes are buffered.
+        Returns False if the stream ends first.
+        """
+        while self.end - self.start < minimum:
+            if self.end + self.read_size > len(self.buffer):
+                # move the unparsed tail to the front to make room
+                # (copied through `bytes` because the regions may overlap)
+                remaining = self.end - self.start
+                self.buffer[:remaining] = bytes(self.view[self.start : self.end])
+                self.start, self.end = 0, remaining
+
+            target = self.view[self.end : self.end + self.read_size]
+            read = self.stream.readinto(target)  # type: ignore[attr-defined]
+            if not read:
+                return False
+
+            self.end += read
+
+        return True
+
+    def iter_packets(self: OggPacketReader) -> Iterator[bytes]:
+        partial = b""  # a packet that continues onto the next page
+        buffer = self.buffer
+
+        while self._fill(OGG_PAGE_HEADER_SIZE):
+            capture_pattern = bytes(buffer[self.start : self.start + 4])
+            if capture_pattern != OGG_CAPTURE_PATTERN:
+                msg = f"Expected an Ogg page but found {capture_pattern!r}"
+                raise OggError(msg)
+
+            segment_count = buffer[self.start + OGG_SEGMENT_COUNT_OFFSET]
+            if not self._fill(OGG_PAGE_HEADER_SIZE + segment_count):
+                return
+
+            body_start = self.start + OGG_PAGE_HEADER_SIZE + segment_count
+            body_size = sum(self.view[body_start - segment_count : body_start])
+            if not self._fill(OGG_PAGE_HEADER_SIZE + segment_count + body_size):
+                return
+
+            # `_fill` may have moved the page to the front of the buffer
+            body_start = self.start + OGG_PAGE_HEADER_SIZE + segment_count
+            lacing_values = buffer[body_start - segment_count : body_start]
+            # One copy of the whole body, which packets are then sliced from.
+            # This is much faster than creating a memoryview per packet.
+            body = bytes(self.view[body_start : body_start + body_size])
+            self.start = body_start + body_size
+
+            packet_start = packet_end = 0
+            for lacing_value in lacing_values:
+                packet_end += lacing_value
+                if lacing_value == 255:
+                    continue
+
+                if partial:
+                    yield partial + body[packet_start:packet_end]
+                    partial = b""
+                else:
+                    yield body[packet_start:packet_end]
+
+                packet_start = packet_end
+
+            if packet_start != packet_end:
+                partial += body[packet_start:packet_end]
+
+
+def enlarge_pipe(pipe: IO[bytes], size: int = PIPE_SIZE) -> None:
+    """
+    Grows a pipe's kernel buffer (64 KiB by default on Linux) so that the
+    writing process can run further ahead of us. Does nothing elsewhere.
+    """
+    with suppress(ImportError, AttributeError, OSError, ValueError):
+        import fcntl
+
+        fcntl.fcntl(pipe.fileno(), fcntl.F_SETPIPE_SZ, size)
@@ -0,0 +1,169 @@
+"""
+Keeps track of every `yt-dlp` and `ffmpeg` process started for a song.
+
+Processes are released (killed) by whatever owns them once it's done with
+them. A background thread then reaps them, collecting their exit status and
+closing our ends of their pipes, so that neither zombies nor file descriptors
+pile up. Processes whose owner is garbage collected without releasing them
+are released at that point and counted as leaks.
+"""
+
+from __future__ import annotations
+
+import os
+import subprocess
+import threading
+import time
+import weakref
+from collections import Counter
+from contextlib import suppress
+from dataclasses import dataclass
+from pathlib import Path
+
+import metrics
+
+REAP_INTERVAL = 10  # seconds
+
+live_processes = metrics.gauge(
+    "subprocesses_live",
+    "Number of tracked subprocesses that haven't been reaped yet, by program.",
+    label_name="program",
+)
+leaked_counter = metrics.counter(
+    "subprocesses_leaked_total",
+    "Number of subprocesses whose owner was garbage collected without releasing them.",
+)
+
+
+@dataclass
+class TrackedProcess:
+    process: subprocess.Popen
+    name: str
+    started_at: float
+    released: bool = False
+
+
+# reentrant, since a leaked owner can be garbage collected while it's held
+_lock = threading.RLock()
+_tracked: dict[int, TrackedProcess] = {}  # by process ID
+_reaper: threading.Thread | None = None
+
+
+def spawn(arguments: list[str], **popen_arguments: object) -> subprocess.Popen:
+    """
+    `subprocess.Popen`, but tracked until it's released and reaped.
+    """
+    global _reaper  # noqa: PLW0603
+
+    process = subprocess.Popen(arguments, **popen_arguments)  # type: ignore[call-overload]
+    name = Path(arguments[0]).name
+
+    with _lock:
+        _tracked[process.pid] = TrackedProcess(process, name, time.monotonic())
+        if _reaper is None:
+            _reaper = threading.Thread(target=_reap_forever, name="reaper", daemon=True)
+            _reaper.start()
+
+    live_processes.inc(label=name)
+    return process
+
+
+def release(*processes: subprocess.Popen) -> None:
+    """
+    Kills the processes. Doesn't wait for them to exit, so it's safe to call
+    from the event loop or the audio thread; the reaper takes care of the rest.
+    """
+    for process in processes:
+        with _lock:
+            if tracked := _tracked.get(process.pid):
+                tracked.released = True
+
+        with suppress(OSError):
+            process.kill()
+
+
+def _release_leaked(*processes: subprocess.Popen) -> None:
+    with _lock:
+        leaked = [
+            process
+            for process in processes
+            if (tracked := _tracked.get(process.pid)) and not tracked.released
+        ]
+
+    if leaked:
+        leaked_counter.inc(len(leaked))
+        release(*leaked)
+
+
+def release_with(owner: object, processes: list[subprocess.Popen]) -> None:
+    """
+    Makes sure that `processes` are released once `owner` is garbage collected,
+    in case it's dropped without being cleaned up.
+    """
+    weakref.finalize(owner, _release_leaked, *processes)
+
+
+def _close_pipes(process: subprocess.Popen) -> None:
+    for pipe in (process.stdin, process.stdout, process.stderr):
+        if pipe:
+            with suppress(OSError, ValueError):
+                pipe.close()
+
+
+def reap() -> int:
+    """
+    Collects every released process that has exited and closes its pipes.
+    Processes that exited on their own keep their pipes until they're
+    released, since there may still be output waiting to be read.
+    Returns the number of processes reaped.
+    """
+    with _lock:
+        reapable = [
+            tracked
+            for tracked in _tracked.values()
+            if tracked.released and tracked.process.poll() is not None
+        ]
+        for tracked in reapable:
+            del _tracked[tracked.process.pid]
+
+    for tracked in reapable:
+        _close_pipes(tracked.process)
+        live_processes.dec(label=tracked.name)
+
+    return len(reapable)
+
+
+def _reap_forever() -> None:
+    while True:
+        time.sleep(REAP_INTERVAL)
+        reap()
+
+
+def tracked_processes() -> list[TrackedProcess]:
+    with _lock:
+        return list(_tracked.values())
+
+
+def process_counts() -> Counter[str]:
+    """
+    Number of tracked processes by program and state.
+    """
+    counts: Counter[str] = Counter()
+    for tracked in tracked_processes():
+        if tracked.process.poll() is None:
+            state = "killed, exiting" if tracked.released else "running"
+        else:
+            state = "exited, unreaped" if tracked.released else "exited, unreleased"
+        counts[f"{tracked.name} ({state})"] += 1
+
+    return counts
+
+
+def open_file_descriptor_count() -> int | None:
+    """
+    Number of file descriptors this process has open. Only available on Linux.
+    """
+    try:
+        return len(os.listdir("/proc/self/fd"))
+    except OSError:
+        return None
@@ -1,15 +1,26 @@
 from __future__ import annotations
 
 import asyncio
+import heapq
+import itertools
 import re
+import time
 from dataclasses import dataclass
 from datetime import datetime, timezone
-from typing import ClassVar
+from enum import IntEnum
+from functools import cache
+from typing import Any, ClassVar, Mapping
 
+import aiohttp
 from cachetools import TTLCache
-from spotipy import MemoryCacheHandler, Spotify, SpotifyClientCredentials
 
-from config import spotify_client_id, spotify_client_secret
+import metrics
+from config import (
+    spotify_client_id,
+    spotify_client_secret,
+    spotify_requests_per_second,
+)
+from tracing import span
 
 from . import youtube
 from .common import Song as BaseSong
@@ -19,6 +30,139 @@ class InvalidTrack(Exception):
     pass
 
 
+class RateLimited(Exception):
+    """Raised when a low priority request would have to wait too long."""
+
+
+class Priority(IntEnum):
+    """Lower values are served first."""
+
+    PLAYBACK = 0
+    IMPORT = 1
+    AUTOCOMPLETE = 2
+
+
+API_URL = "https://api.spotify.com/v1"
+TOKEN_URL = "https://accounts.spotify.com/api/token"
+# refresh the access token this long before it expires
+TOKEN_REFRESH_MARGIN = 5 * 60  # seconds
+MAXIMUM_CONNECTIONS = 10
+KEEPALIVE_TIMEOUT = 60  # seconds
+REQUEST_TIMEOUT = 10  # seconds
+TRACKS_PER_REQUEST = 50  # the most Spotify allows
+PLAYLIST_PAGE_SIZE = 100  # likewise
+
+DEFAULT_RETRY_AFTER = 1.0  # seconds, if a 429 response doesn't say
+MAXIMUM_RETRIES = 3  # per request, after a 429 response
+# Discord only waits 3 seconds for autocomplete suggestions, so there's no
+# point in waiting longer than this for Spotify to allow one more request
+AUTOCOMPLETE_MAXIMUM_WAIT = 1.0  # seconds
+
+queue_wait_histograms = {
+    priority: metrics.histogram(
+        f"spotify_queue_wait_seconds_{priority.name.lower()}",
+        f"Time {priority.name.lower()} requests spent waiting for the rate limiter.",
+    )
+    for priority in Priority
+}
+throttled_counter = metrics.counter(
+    "spotify_throttled_requests_total",
+    "Number of Spotify requests that were answered with 429 Too Many Requests.",
+    label_name="priority",
+)
+shed_counter = metrics.counter(
+    "spotify_shed_requests_total",
+    "Number of Spotify requests given up on because the rate limiter was too busy.",
+    label_name="priority",
+)
+metadata_cache_counter = metrics.counter(
+    "spotify_metadata_cache_total",
+    "Lookups of cached track metadata, by result (hit or miss).",
+    label_name="result",
+)
+fetch_histogram = metrics.histogram(
+    "spotify_fetch_seconds",
+    "Time from fetching a Spotify song to its stream having started.",
+)
+
+
+class RateLimiter:
+    """
+    A token bucket shared by every Spotify request. Requests that can't be
+    made right away wait in a priority queue, so that a burst of autocomplete
+    traffic never delays a `/play` lookup. When Spotify responds with 429,
+    nothing is sent until its Retry-After has passed.
+    """
+
+    def __init__(self: RateLimiter, rate: float, burst: float) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.refilled_at = time.monotonic()
+        self.blocked_until = 0.0
+        self.waiters: list[tuple[Priority, int, asyncio.Future[None]]] = []
+        self.order = itertools.count()  # first come first served within a priority
+        self.dispatcher: asyncio.Task | None = None
+
+    def _refill(self: RateLimiter, now: float) -> None:
+        self.tokens = min(
+            self.burst,
+            self.tokens + (now - self.refilled_at) * self.rate,
+        )
+        self.refilled_at = now
+
+    async def acquire(
+        self: RateLimiter,
+        priority: Priority,
+        maximum_wait: float | None = None,
+    ) -> None:
+        """
+        Waits until a request may be sent. Raises `RateLimited` instead if
+        that would take longer than `maximum_wait` seconds.
+        """
+        started_at = time.monotonic()
+        if maximum_wait is not None and self.blocked_until - started_at > maximum_wait:
+            shed_counter.inc(label=priority.name.lower())
+            msg = "Spotify is rate limiting us."
+            raise RateLimited(msg)
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiters, (priority, next(self.order), future))
+        if self.dispatcher is None or self.dispatcher.done():
+            self.dispatcher = asyncio.create_task(self._dispatch())
+
+        try:
+            await asyncio.wait_for(future, maximum_wait)
+        except asyncio.TimeoutError as e:
+            shed_counter.inc(label=priority.name.lower())
+            msg = "Too many Spotify requests are queued."
+            raise RateLimited(msg) from e
+        finally:
+            queue_wait_histograms[priority].observe(time.monotonic() - started_at)
+
+    async def _dispatch(self: RateLimiter) -> None:
+        while self.waiters:
+            now = time.monotonic()
+            self._refill(now)
+
+            delay = max(self.blocked_until - now, (1 - self.tokens) / self.rate)
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+
+            *_, future = heapq.heappop(self.waiters)
+            if not future.done():  # it may have given up waiting
+                self.tokens -= 1
+                future.set_result(None)
+
+    def back_off(self: RateLimiter, retry_after: float) -> None:
+        self.blocked_until = max(self.blocked_until, time.monotonic() + retry_after)
+        self.tokens = 0
+
+
+rate_limiter = RateLimiter(spotify_requests_per_second, 2 * spotify_requests_per_second)
+
+
 @dataclass
 class SpotifyTrackMetadata:
     cache: ClassVar[TTLCache] = TTLCache(100, 15 * 60)  # 100 songs for up to 15 minutes
@@ -31,6 +175,7 @@ class SpotifyTrackMetadata:
     artist_name: str
     artist_url: str
     released_at: int  # unix timestamp
+    duration: float  # seconds
 
     @classmethod
     def from_track_dict(
@@ -52,6 +197,7 @@ class SpotifyTrackMetadata:
             artist_name = track_dict["artists"][0]["name"]
             artist_url = track_dict["artists"][0]["external_urls"]["spotify"]
             release_date = track_dict["album"]["release_date"]
+            duration = track_dict["duration_ms"] / 1000
 
             artist_names = [artist["name"] for artist in track_dict["artists"]]
         except KeyError as e:
@@ -82,6 +228,7 @@ class SpotifyTrackMetadata:
                 .replace(tzinfo=timezone.utc)
                 .timestamp(),
             ),
+            duration=duration,
         )
 
         cls.cache[track_id] = track
@@ -97,13 +244,288 @@ class Song(BaseSong):
     released_at: int  # unix timestamp
 
 
-spotify_client = Spotify(
-    auth_manager=SpotifyClientCredentials(
-        client_id=spotify_client_id,
-        client_secret=spotify_client_secret,
-        cache_handler=MemoryCacheHandler(),
-    ),
-)
+class SpotifyError(Exception):
+    def __init__(
+        self: SpotifyError,
+        http_status: int,
+        message: str,
+        headers: Mapping[str, str] | None = None,
+    ) -> None:
+        super().__init__(f"Spotify responded with {http_status}: {message}")
+        self.http_status = http_status
+        self.headers = headers or {}
+
+
+def retry_after(error: SpotifyError) -> float | None:
+    """
+    How long Spotify asked us to wait, if `error` is a 429 response.
+    """
+    if error.http_status != 429:
+        return None
+
+    try:
+        return float(error.headers.get("Retry-After", DEFAULT_RETRY_AFTER))
+    except ValueError:
+        return DEFAULT_RETRY_AFTER
+
+
+class SpotifyClient:
+    """
+    The parts of the Spotify Web API that we use, on a single aiohttp session
+    so that requests reuse pooled keep-alive connections.
+
+    Every request waits for `rate_limiter` and is retried after 429 responses.
+    The access token is refreshed in the background shortly before it
+    expires, so requests only ever wait for the very first one.
+    """
+
+    def __init__(
+        self: SpotifyClient,
+        client_id: str,
+        client_secret: str,
+        api_url: str = API_URL,
+        token_url: str = TOKEN_URL,
+        rate_limiter: RateLimiter | None = None,
+    ) -> None:
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.api_url = api_url
+        self.token_url = token_url
+        self.rate_limiter = rate_limiter
+
+        self._session: aiohttp.ClientSession | None = None
+        self._access_token: str | None = None
+        self._token_expires_at = 0.0  # time.monotonic()
+        self._token_refresh: asyncio.Task[str] | None = None
+
+    @property
+    def session(self: SpotifyClient) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    limit=MAXIMUM_CONNECTIONS,
+                    keepalive_timeout=KEEPALIVE_TIMEOUT,
+                ),
+                timeout=aiohttp.ClientTimeout(total=REQUEST_TIMEOUT),
+            )
+
+        return self._session
+
+    async def close(self: SpotifyClient) -> None:
+        if self._session:
+            await self._session.close()
+
+    async def _refresh_token(self: SpotifyClient) -> str:
+        async with self.session.post(
+            self.token_url,
+            data={"grant_type": "client_credentials"},
+            auth=aiohttp.BasicAuth(self.client_id, self.client_secret),
+        ) as response:
+            if response.status != 200:
+                raise SpotifyError(
+                    response.status,
+                    await response.text(),
+                    response.headers,
+                )
+
+            token = await response.json()
+
+        self._access_token = token["access_token"]
+        self._token_expires_at = time.monotonic() + token["expires_in"]
+        return token["access_token"]
+
+    @staticmethod
+    def _report_failed_refresh(task: asyncio.Task[str]) -> None:
+        if not task.cancelled() and (e := task.exception()):
+            print(f"Couldn't refresh the Spotify access token: {e!r}")
+
+    async def access_token(self: SpotifyClient) -> str:
+        remaining = self._token_expires_at - time.monotonic()
+        if self._access_token and remaining > TOKEN_REFRESH_MARGIN:
+            return self._access_token
+
+        if self._token_refresh is None or self._token_refresh.done():
+            self._token_refresh = asyncio.create_task(self._refresh_token())
+            self._token_refresh.add_done_callback(self._report_failed_refresh)
+
+        if self._access_token and remaining > 0:
+            # still valid for a while, so don't wait for the new one
+            return self._access_token
+
+        return await asyncio.shield(self._token_refresh)
+
+    async def _get_once(
+        self: SpotifyClient,
+        url: str,
+        params: Mapping[str, str | int] | None,
+    ) -> dict[str, Any]:
+        for attempt in range(2):
+            token = await self.access_token()
+            async with self.session.get(
+                url,
+                params=params,
+                headers={"Authorization": f"Bearer {token}"},
+            ) as response:
+                if response.status == 401 and attempt == 0:
+                    # the token was revoked early, get a new one and try again
+                    self._access_token = None
+                    continue
+
+                if response.status != 200:
+                    raise SpotifyError(
+                        response.status,
+                        await response.text(),
+                        response.headers,
+                    )
+
+                return await response.json()
+
+        raise AssertionError  # unreachable
+
+    async def get(
+        self: SpotifyClient,
+        path: str,
+        params: Mapping[str, str | int] | None = None,
+        priority: Priority = Priority.PLAYBACK,
+        maximum_wait: float | None = None,
+    ) -> dict[str, Any]:
+        """
+        `path` is relative to the API (e.g. "tracks/{id}"), or a full URL
+        such as the `next` page of a paginated response.
+        """
+        url = path if path.startswith("http") else f"{self.api_url}/{path}"
+
+        for attempt in range(MAXIMUM_RETRIES + 1):
+            if self.rate_limiter:
+                await self.rate_limiter.acquire(priority, maximum_wait)
+
+            try:
+                return await self._get_once(url, params)
+            except SpotifyError as e:
+                delay = retry_after(e)
+                if delay is None:
+                    raise
+
+                throttled_counter.inc(label=priority.name.lower())
+                if self.rate_limiter:
+                    self.rate_limiter.back_off(delay)
+                if attempt == MAXIMUM_RETRIES:
+                    raise
+
+        raise AssertionError  # unreachable
+
+    async def _paginate(
+        self: SpotifyClient,
+        page: dict[str, Any],
+        priority: Priority,
+    ) -> list[dict[str, Any]]:
+        items = list(page["items"])
+        while page.get("next"):
+            page = await self.get(page["next"], priority=priority)
+            items.extend(page["items"])
+
+        return items
+
+    async def search(
+        self: SpotifyClient,
+        query: str,
+        limit: int = 10,
+        priority: Priority = Priority.PLAYBACK,
+        maximum_wait: float | None = None,
+    ) -> list[SpotifyTrackMetadata]:
+        result = await self.get(
+            "search",
+            {"q": query, "type": "track", "limit": limit},
+            priority,
+            maximum_wait,
+        )
+        return [
+            SpotifyTrackMetadata.from_track_dict(track_dict)
+            for track_dict in result.get("tracks", {}).get("items", [])
+            if track_dict
+        ]
+
+    async def track(
+        self: SpotifyClient,
+        track_id: str,
+        priority: Priority = Priority.PLAYBACK,
+    ) -> SpotifyTrackMetadata:
+        track_dict = await self.get(f"tracks/{track_id}", priority=priority)
+        return SpotifyTrackMetadata.from_track_dict(track_dict)
+
+    async def tracks(
+        self: SpotifyClient,
+        track_ids: list[str],
+        priority: Priority = Priority.IMPORT,
+    ) -> list[SpotifyTrackMetadata]:
+        """
+        Looks up many tracks in as few requests as possible.
+        Tracks that don't exist are left out.
+        """
+        results = await asyncio.gather(
+            *(
+                self.get(
+                    "tracks",
+                    {"ids": ",".join(track_ids[i : i + TRACKS_PER_REQUEST])},
+                    priority,
+                )
+                for i in range(0, len(track_ids), TRACKS_PER_REQUEST)
+            ),
+        )
+        return [
+            SpotifyTrackMetadata.from_track_dict(track_dict)
+            for result in results
+            for track_dict in result["tracks"]
+            if track_dict
+        ]
+
+    async def playlist(
+        self: SpotifyClient,
+        playlist_id: str,
+        priority: Priority = Priority.IMPORT,
+    ) -> list[SpotifyTrackMetadata]:
+        """
+        Every track in the playlist, skipping podcast episodes and local files.
+        """
+        page = await self.get(
+            f"playlists/{playlist_id}/tracks",
+            {"limit": PLAYLIST_PAGE_SIZE},
+            priority,
+        )
+        return [
+            SpotifyTrackMetadata.from_track_dict(item["track"])
+            for item in await self._paginate(page, priority)
+            if item.get("track")
+            and item["track"].get("type") == "track"
+            and item["track"].get("id")
+        ]
+
+    async def album(
+        self: SpotifyClient,
+        album_id: str,
+        priority: Priority = Priority.IMPORT,
+    ) -> list[SpotifyTrackMetadata]:
+        album = await self.get(f"albums/{album_id}", priority=priority)
+        # an album's tracks don't repeat the album they're on
+        return [
+            SpotifyTrackMetadata.from_track_dict({**track_dict, "album": album})
+            for track_dict in await self._paginate(album["tracks"], priority)
+        ]
+
+
+@cache
+def get_spotify_client() -> SpotifyClient:
+    return SpotifyClient(
+        spotify_client_id,
+        spotify_client_secret,
+        rate_limiter=rate_limiter,
+    )
+
+
+async def close_spotify_client() -> None:
+    if get_spotify_client.cache_info().currsize:
+        await get_spotify_client().close()
+
 
 TRACK_ID_REGEX = re.compile(r"spotify.com/track/(\w+)")
 
@@ -113,18 +535,20 @@ def extract_track_id(song: str) -> str | None:
     return result.group(1) if result else None
 
 
-async def search(query: str) -> list[SpotifyTrackMetadata]:
+async def search(
+    query: str,
+    priority: Priority = Priority.PLAYBACK,
+) -> list[SpotifyTrackMetadata]:
     """
-    Returns a dictionary mapping matched track IDs to f"{track title} by {track author(s)}"
+    Returns the tracks that match `query`, without duplicates.
     """
-    result = await asyncio.to_thread(spotify_client.search, query)
-    if not result or "tracks" not in result or "items" not in result["tracks"]:
-        return []
-
-    tracks = [
-        SpotifyTrackMetadata.from_track_dict(track_dict)
-        for track_dict in result["tracks"]["items"]
-    ]
+    tracks = await get_spotify_client().search(
+        query,
+        priority=priority,
+        maximum_wait=(
+            AUTOCOMPLETE_MAXIMUM_WAIT if priority == Priority.AUTOCOMPLETE else None
+        ),
+    )
 
     # Remove duplicate search results (which appear surprisingly often??)
     seen_youtube_search_terms = set()
@@ -145,20 +569,17 @@ async def search(query: str) -> list[SpotifyTrackMetadata]:
 
 async def get_metadata_by_track_id(track_id: str) -> SpotifyTrackMetadata:
     if track := SpotifyTrackMetadata.cache.get(track_id):
+        metadata_cache_counter.inc(label="hit")
         return track
 
+    metadata_cache_counter.inc(label="miss")
+
     try:
-        track_dict = await asyncio.to_thread(spotify_client.track, track_id)
-    except Exception as e:
+        return await get_spotify_client().track(track_id)
+    except (SpotifyError, aiohttp.ClientError, asyncio.TimeoutError) as e:
         msg = f"Spotify raised API error. {e!r}"
         raise InvalidTrack(msg) from e
 
-    if not track_dict:
-        msg = f"Invalid track ID {track_id}"
-        raise InvalidTrack(msg)
-
-    return SpotifyTrackMetadata.from_track_dict(track_dict)
-
 
 async def get_metadata(query: str) -> SpotifyTrackMetadata:
     tracks = await search(query)
@@ -170,12 +591,16 @@ async def get_metadata(query: str) -> SpotifyTrackMetadata:
 
 
 async def fetch(song: str) -> Song:
-    if track_id := extract_track_id(song):
-        meta = await get_metadata_by_track_id(track_id)
-    else:
-        meta = await get_metadata(song)
+    started_at = time.perf_counter()
+    with span("spotify metadata"):
+        if track_id := extract_track_id(song):
+            meta = await get_metadata_by_track_id(track_id)
+        else:
+            meta = await get_metadata(song)
 
-    youtube_song = await youtube.fetch(meta.youtube_search_term)
+    # the duration avoids e.g. hour-long loops of the song
+    youtube_song = await youtube.fetch(meta.youtube_search_term, meta.duration)
+    fetch_histogram.observe(time.perf_counter() - started_at)
     return Song(
         youtube_song=youtube_song,
         track_id=meta.track_id,
@@ -1,14 +1,67 @@
 from __future__ import annotations
 
 import asyncio
+import json
+import os
+import re
 import subprocess
-from dataclasses import dataclass
+import threading
+import time
+from contextlib import suppress
+from dataclasses import asdict, dataclass, replace
 from datetime import datetime, timezone
 from math import ceil
-from typing import Callable, ClassVar, TypeVar
+from pathlib import Path
+from typing import IO, Callable, ClassVar, TypeVar
+from urllib.error import HTTPError, URLError
+from urllib.parse import parse_qs, urlparse
+from urllib.request import Request, urlopen
 
-from .common import BufferedOpusAudioSource, transmux_to_ogg_opus
+import metrics
+from tracing import span
+
+from . import processes
+from .broadcast import Broadcast, BroadcastAudioSource, Restart
 from .common import Song as BaseSong
+from .common import transmux_to_ogg_opus
+from .direct import UnplayableSource, is_url, resolve_public_url
+from .loudness import measured_loudness, normalization_gain
+
+EXTRACTION_TIMEOUT = 30  # seconds
+STREAM_URL_PROBE_TIMEOUT = 3  # seconds
+STREAM_URL_EXPIRY_MARGIN = 60  # seconds
+DEFAULT_STREAM_URL_LIFETIME = 60 * 60  # seconds, if the URL doesn't say
+SEARCH_INDEX_FILE = Path("youtube_search_index.json")
+# after this, a query is searched again in case something better has been uploaded
+SEARCH_RESULT_LIFETIME = 7 * 24 * 60 * 60  # seconds
+SEARCH_TIMEOUT = 15  # seconds
+SEARCH_CANDIDATES = 5
+# when the expected duration is known, the first candidate this close to it wins
+DURATION_TOLERANCE = 15  # seconds
+
+stream_url_cache_counter = metrics.counter(
+    "youtube_stream_url_cache_total",
+    "Lookups of cached stream URLs, by result (hit, miss or expired).",
+    label_name="result",
+)
+search_cache_counter = metrics.counter(
+    "youtube_search_cache_total",
+    "Lookups of cached search results, by result (hit or miss).",
+    label_name="result",
+)
+live_song_counter = metrics.counter(
+    "youtube_live_song_reuse_total",
+    "Fetches answered by a song that was already streaming, by result (hit or miss).",
+    label_name="result",
+)
+fetch_histogram = metrics.histogram(
+    "youtube_fetch_seconds",
+    "Time from fetching a YouTube song to its stream having started.",
+)
+
+
+class ExtractionError(Exception):
+    pass
 
 
 @dataclass
@@ -21,6 +74,57 @@ class Song(BaseSong):
     subscribers: int
 
 
+VIDEO_ID_REGEX = re.compile(
+    r"(?:youtube\.com/(?:watch\?v=|shorts/)|youtu\.be/)([\w-]{11})",
+)
+
+# Songs which are currently being streamed, by video ID and by the query that
+# found them, so that the same song playing in several guilds shares one pipeline.
+live_songs: dict[str, Song] = {}
+
+
+def extract_video_id(song: str) -> str | None:
+    result = VIDEO_ID_REGEX.search(song)
+    return result.group(1) if result else None
+
+
+def live_song_key(song: str) -> str:
+    return extract_video_id(song) or song.strip().lower()
+
+
+def find_live_song(key: str) -> Song | None:
+    """
+    Returns a copy of a song that is already being streamed, with its own
+    audio source sharing the existing pipeline, if there is one that still
+    has the start of the song.
+    """
+    for live_key, live_song in list(live_songs.items()):
+        assert isinstance(live_song.stream, BroadcastAudioSource)
+        if live_song.stream.broadcast.closed:
+            del live_songs[live_key]
+
+    live_song = live_songs.get(key)
+    if not live_song:
+        return None
+
+    assert isinstance(live_song.stream, BroadcastAudioSource)
+    try:
+        stream = live_song.stream.broadcast.source()
+    except ValueError:
+        # closed in the meantime
+        return None
+
+    # (checked after joining, since the new reader stops any further trimming)
+    if live_song.stream.broadcast.first_index > 0:
+        # the start has been trimmed, so this would join mid-song;
+        # the caller starts a fresh pipeline, which replaces this one here
+        stream.cleanup()
+        return None
+
+    # (already normalized by the pipeline's ffmpeg)
+    return replace(live_song, stream=stream)
+
+
 T = TypeVar("T")
 D = TypeVar("D")
 
@@ -32,35 +136,141 @@ def convert(data: D, converter: Callable[[D], T], default: T) -> T:
         return default
 
 
-def fetch_synchronously(song: str) -> Song:
+@dataclass
+class Extraction:
     """
-    Assumes that `yt-dlp` and `ffmpeg` are installed on your PATH.
+    What yt-dlp found for a video, including a direct URL to its audio.
+    """
+
+    video_id: str
+    title: str
+    thumbnail: str
+    upload_date: str
+    duration: str
+    view_count: str
+    uploader: str
+    channel_url: str
+    channel_follower_count: str
+    stream_url: str
+    http_headers: dict[str, str]
+    expires_at: float  # unix timestamp
+
+    def usable_for(self: Extraction, seconds: float) -> bool:
+        """
+        Whether the stream URL will still be valid in `seconds`
+        (plus a margin), so it doesn't expire in the middle of a song.
+        """
+        return time.time() + seconds + STREAM_URL_EXPIRY_MARGIN < self.expires_at
+
+
+# Direct stream URLs by video ID, so that playing a video again skips extraction
+extractions: dict[str, Extraction] = {}
+
+
+def stream_url_expiry(stream_url: str) -> float:
+    """
+    YouTube's stream URLs say when they expire (`expire=<unix timestamp>`).
+    """
+    expire = parse_qs(urlparse(stream_url).query).get("expire")
+    return convert(
+        expire[0] if expire else "",
+        float,
+        time.time() + DEFAULT_STREAM_URL_LIFETIME,
+    )
+
+
+def stream_url_is_live(extraction: Extraction) -> bool:
     """
-    download_process = subprocess.Popen(
+    Checks that a cached stream URL still works, since YouTube can revoke
+    them early. Network errors are left for ffmpeg's reconnects to deal with.
+    """
+    request = Request(
+        extraction.stream_url,
+        headers=extraction.http_headers,
+        method="HEAD",
+    )
+    try:
+        with urlopen(request, timeout=STREAM_URL_PROBE_TIMEOUT):
+            return True
+    except HTTPError as e:
+        return e.code not in {403, 404, 410}
+    except (URLError, OSError):
+        return True
+
+
+def cached_extraction(video_id: str) -> Extraction | None:
+    for cached_video_id, extraction in list(extractions.items()):
+        if not extraction.usable_for(0):
+            extractions.pop(cached_video_id, None)
+
+    extraction = extractions.get(video_id)
+    if not extraction:
+        stream_url_cache_counter.inc(label="miss")
+        return None
+
+    duration = convert(extraction.duration, float, 0.0)
+    if not extraction.usable_for(duration) or not stream_url_is_live(extraction):
+        extractions.pop(video_id, None)
+        stream_url_cache_counter.inc(label="expired")
+        return None
+
+    stream_url_cache_counter.inc(label="hit")
+    return extraction
+
+
+def extraction_error_reason(errors: bytes) -> str | None:
+    """
+    The last of yt-dlp's `ERROR:` lines, without its prefixes, if there is one.
+    e.g. "ERROR: [youtube] dQw4w9WgXcQ: Video unavailable" -> "Video unavailable"
+    """
+    reasons = [
+        line.removeprefix("ERROR:").strip()
+        for line in errors.decode(errors="replace").splitlines()
+        if line.startswith("ERROR:")
+    ]
+    if not reasons:
+        return None
+
+    return re.sub(r"^\[[\w:]+\] [\w-]+: ", "", reasons[-1])
+
+
+def extract(song: str) -> Extraction:
+    if is_url(song) and not extract_video_id(song):
+        # yt-dlp's generic extractor would fetch anything, following redirects
+        try:
+            song = resolve_public_url(song)
+        except UnplayableSource as e:
+            raise ExtractionError(str(e)) from e
+
+    extraction_process = processes.spawn(
         [
             "yt-dlp",
             # Video information
             "--print",
-            "before_dl:id",
+            "id",
             "--print",
-            "before_dl:title",
+            "title",
             "--print",
-            "before_dl:thumbnail",
+            "thumbnail",
             "--print",
-            "before_dl:upload_date",
+            "upload_date",
             "--print",
-            "before_dl:duration",
+            "duration",
             "--print",
-            "before_dl:view_count",
+            "view_count",
             # Uploader information
             "--print",
-            "before_dl:uploader",
+            "uploader",
+            "--print",
+            "channel_url",
+            "--print",
+            "channel_follower_count",
+            # Stream information, ffmpeg downloads the audio itself
             "--print",
-            "before_dl:channel_url",
+            "url",
             "--print",
-            "before_dl:channel_follower_count",
-            # Download options
-            "--no-simulate",
+            "%(http_headers)j",
+            "--simulate",
             "--default-search",
             "ytsearch",
             "--format",
@@ -68,56 +278,281 @@ def fetch_synchronously(song: str) -> Song:
             "--max-downloads",
             "1",
             song,
-            "-o",
-            "-",
         ],
         stdout=subprocess.PIPE,
         stderr=subprocess.PIPE,
-        bufsize=-1,
     )
-    assert download_process.stdout
-    assert download_process.stderr
-    printed_info_stream = download_process.stderr
+    try:
+        output, errors = extraction_process.communicate(timeout=EXTRACTION_TIMEOUT)
+    except subprocess.TimeoutExpired:
+        output, errors = b"", b"timed out"
+    finally:
+        processes.release(extraction_process)
+
+    lines = output.decode().splitlines()
+    if len(lines) < 11 or not lines[9].startswith("http"):
+        print(f"yt-dlp failed for {song!r}: {errors.decode(errors='replace').strip()}")
+        msg = f"yt-dlp couldn't find a stream for {song!r}."
+        if reason := extraction_error_reason(errors):
+            msg += f" ({reason})"
+        raise ExtractionError(msg)
+
+    *info, stream_url, http_headers = lines[:11]
+    return Extraction(
+        *info,
+        stream_url=stream_url,
+        http_headers=convert(http_headers, json.loads, {}),
+        expires_at=stream_url_expiry(stream_url),
+    )
+
+
+@dataclass
+class SearchResult:
+    video_id: str
+    searched_at: float  # unix timestamp
+
+
+_search_index_lock = threading.Lock()
+_search_index: dict[str, SearchResult] | None = None
+
+
+def search_key(query: str) -> str:
+    return " ".join(query.lower().split())
+
+
+def _load_search_index() -> dict[str, SearchResult]:
+    global _search_index  # noqa: PLW0603
+
+    if _search_index is None:
+        _search_index = {}
+        with suppress(FileNotFoundError, json.JSONDecodeError, TypeError, KeyError):
+            results = json.loads(SEARCH_INDEX_FILE.read_text())
+            _search_index = {
+                query: SearchResult(**result) for query, result in results.items()
+            }
+
+    return _search_index
+
+
+def cached_search(query: str) -> str | None:
+    """
+    The video that `query` found last time, if it was recently enough.
+    """
+    with _search_index_lock:
+        result = _load_search_index().get(search_key(query))
+
+    if not result or time.time() - result.searched_at > SEARCH_RESULT_LIFETIME:
+        search_cache_counter.inc(label="miss")
+        return None
+
+    search_cache_counter.inc(label="hit")
+    return result.video_id
+
+
+def record_search(query: str, video_id: str | None) -> None:
+    """
+    Remembers which video `query` found, or forgets it if `video_id` is None.
+    """
+    with _search_index_lock:
+        index = _load_search_index()
+        for key, result in list(index.items()):
+            if time.time() - result.searched_at > SEARCH_RESULT_LIFETIME:
+                del index[key]
+
+        if video_id:
+            index[search_key(query)] = SearchResult(video_id, time.time())
+        else:
+            index.pop(search_key(query), None)
+
+        results = {key: asdict(result) for key, result in index.items()}
+        temporary_file = SEARCH_INDEX_FILE.with_suffix(".tmp")
+        temporary_file.write_text(json.dumps(results))
+        os.replace(temporary_file, SEARCH_INDEX_FILE)
+
+
+@dataclass
+class Candidate:
+    video_id: str
+    duration: float | None  # seconds, unknown for live streams
+
+
+def search(query: str, count: int = SEARCH_CANDIDATES) -> list[Candidate]:
+    """
+    The top `count` results for `query`, without extracting any of them.
+    """
+    search_process = processes.spawn(
+        [
+            "yt-dlp",
+            "--flat-playlist",
+            "--print",
+            "%(id)s %(duration)s",
+            f"ytsearch{count}:{query}",
+        ],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        output, _ = search_process.communicate(timeout=SEARCH_TIMEOUT)
+    except subprocess.TimeoutExpired:
+        output = b""
+    finally:
+        processes.release(search_process)
+
+    candidates = []
+    for line in output.decode().splitlines():
+        video_id, _, duration = line.partition(" ")
+        if re.fullmatch(r"[\w-]{11}", video_id):
+            candidates.append(Candidate(video_id, convert(duration, float, None)))
+
+    return candidates
 
-    encoded_audio_stream, transmuxing_process = transmux_to_ogg_opus(
-        download_process.stdout,
+
+def choose_candidate(candidates: list[Candidate], duration: float) -> Candidate | None:
+    """
+    The best ranked candidate that's about `duration` seconds long, or else the
+    one closest to it, so that e.g. hour-long compilations aren't downloaded.
+    """
+    timed = [candidate for candidate in candidates if candidate.duration]
+    if not timed:
+        return candidates[0] if candidates else None
+
+    for candidate in timed:
+        assert candidate.duration is not None
+        if abs(candidate.duration - duration) <= DURATION_TOLERANCE:
+            return candidate
+
+    return min(timed, key=lambda candidate: abs(candidate.duration - duration))
+
+
+def find_video_id(query: str, duration: float | None) -> str | None:
+    """
+    Searches for the video that's closest to `duration` seconds long. Without a
+    duration there's nothing to choose by, so nothing is searched for (extracting
+    the query plays its first result, all in one request).
+    """
+    if not duration:
+        return None
+
+    with span("youtube search"):
+        candidate = choose_candidate(search(query), duration)
+
+    return candidate.video_id if candidate else None
+
+
+def fetch_synchronously(song: str, duration: float | None = None) -> Song:
+    """
+    Assumes that `yt-dlp` and `ffmpeg` are installed on your PATH.
+
+    `duration` is how long the song is expected to be (in seconds), if known,
+    for choosing between search results.
+    """
+    if live_song := find_live_song(live_song_key(song)):
+        live_song_counter.inc(label="hit")
+        return live_song
+
+    query = None if extract_video_id(song) else song
+    remembered_video_id = cached_search(query) if query else None
+    video_id = (
+        extract_video_id(song)
+        or remembered_video_id
+        or (query and find_video_id(query, duration))
     )
+    extraction = cached_extraction(video_id) if video_id else None
+    if not extraction:
+        with span("yt-dlp extraction"):
+            try:
+                extraction = extract(
+                    f"https://www.youtube.com/watch?v={video_id}" if video_id else song,
+                )
+            except ExtractionError:
+                if not query or not video_id:
+                    raise
+
+                # e.g. the video has been taken down since it was found
+                extraction = extract(query)
+
+        if extraction.video_id:
+            extractions[extraction.video_id] = extraction
+
+    if query and extraction.video_id and extraction.video_id != remembered_video_id:
+        record_search(query, extraction.video_id)
+
+    video_id = extraction.video_id
+    if video_id and (live_song := find_live_song(video_id)):
+        # A different query found a song that's already streaming
+        live_songs[live_song_key(song)] = live_song
+        live_song_counter.inc(label="hit")
+        return live_song
+
+    live_song_counter.inc(label="miss")
+
+    gain_db = normalization_gain(video_id)
+    with span("start ffmpeg"):
+        encoded_audio_stream, transmuxing_process = transmux_to_ogg_opus(
+            extraction.stream_url,
+            measure_loudness_of=(
+                video_id if video_id and measured_loudness(video_id) is None else None
+            ),
+            http_headers=extraction.http_headers,
+            gain_db=gain_db,
+        )
 
-    (
-        video_id,
-        title,
-        thumbnail,
-        upload_date,
-        duration,
-        view_count,
-        uploader,
-        channel_url,
-        channel_follower_count,
-    ) = (printed_info_stream.readline().decode().strip() for _ in range(9))
-
-    return Song(
-        artist=uploader,
-        artist_url=channel_url,
+    youtube_song = Song(
+        artist=extraction.uploader,
+        artist_url=extraction.channel_url,
         video_id=video_id,
         url=f"https://www.youtube.com/watch?v={video_id}",
-        title=title,
-        image_url=thumbnail,
-        duration=ceil(convert(duration, float, 0.0)),
-        view_count=convert(view_count, int, 0),
+        title=extraction.title,
+        image_url=extraction.thumbnail,
+        duration=ceil(convert(extraction.duration, float, 0.0)),
+        view_count=convert(extraction.view_count, int, 0),
         uploaded_at=convert(
-            upload_date,
+            extraction.upload_date,
             lambda d: int(
                 datetime.strptime(d, "%Y%m%d").replace(tzinfo=timezone.utc).timestamp(),
             ),
             0,
         ),
-        subscribers=convert(channel_follower_count, int, 0),
-        stream=BufferedOpusAudioSource(
+        subscribers=convert(extraction.channel_follower_count, int, 0),
+        stream=Broadcast(
             encoded_audio_stream,
-            [download_process, transmuxing_process],
-        ),
+            [transmuxing_process],
+            duration=convert(extraction.duration, float, None),
+            restart=restart_from(extraction, gain_db),
+        ).source(),
     )
 
+    live_songs[live_song_key(song)] = youtube_song
+    if video_id:
+        live_songs[video_id] = youtube_song
+    return youtube_song
+
+
+def restart_from(extraction: Extraction, gain_db: float = 0) -> Restart:
+    """
+    Restarts a song's pipeline part way through, with a fresh stream URL,
+    since the old one has presumably expired or been revoked. `gain_db` is
+    the normalization the song started with, so its loudness doesn't jump.
+    """
+
+    def restart(seconds: float) -> tuple[IO[bytes], subprocess.Popen]:
+        extractions.pop(extraction.video_id, None)
+        fresh_extraction = extract(
+            f"https://www.youtube.com/watch?v={extraction.video_id}",
+        )
+        extractions[fresh_extraction.video_id] = fresh_extraction
+        return transmux_to_ogg_opus(
+            fresh_extraction.stream_url,
+            http_headers=fresh_extraction.http_headers,
+            start_at=seconds,
+            gain_db=gain_db,
+        )
+
+    return restart
+
 
-async def fetch(song: str) -> Song:
-    return await asyncio.to_thread(fetch_synchronously, song)
+async def fetch(song: str, duration: float | None = None) -> Song:
+    started_at = time.perf_counter()
+    youtube_song = await asyncio.to_thread(fetch_synchronously, song, duration)
+    fetch_histogram.observe(time.perf_counter() - started_at)
+    return youtube_song
@@ -4,6 +4,8 @@ from typing import TYPE_CHECKING
 
 import discord
 
+from .streaming.broadcast import StationSong
+from .streaming.direct import Song as DirectSong
 from .streaming.spotify import Song as SpotifySong
 from .streaming.youtube import Song as YoutubeSong
 
@@ -19,19 +21,20 @@ def embed_song(
 ) -> discord.Embed:
     e = discord.Embed(
         title=f"{title_prefix}{song.title}",
-        url=song.url,
+        url=song.url or None,
         color=song.platform_color,
     )
-    e.set_thumbnail(url=song.image_url)
-
-    e.add_field(
-        name="Duration",
-        value=(
-            f"{song.duration // 60:d}:{song.duration % 60:02d}"
-            if song.duration < 3600
-            else f"{song.duration // 3600:d}:{song.duration // 60 % 60:02d}:{song.duration % 60:02d}"
-        ),
-    )
+    e.set_thumbnail(url=song.image_url or None)
+
+    if song.duration:
+        e.add_field(
+            name="Duration",
+            value=(
+                f"{song.duration // 60:d}:{song.duration % 60:02d}"
+                if song.duration < 3600
+                else f"{song.duration // 3600:d}:{song.duration // 60 % 60:02d}:{song.duration % 60:02d}"
+            ),
+        )
 
     if isinstance(song, YoutubeSong):
         e.insert_field_at(
@@ -59,5 +62,41 @@ def embed_song(
             name="Release Date",
             value=f"<t:{song.released_at}:D> (<t:{song.released_at}:R>)",
         )
+    elif isinstance(song, DirectSong):
+        e.insert_field_at(index=0, name="Artist", value=song.artist)
+
+        if song.album:
+            e.add_field(name="Album", value=song.album)
+    elif isinstance(song, StationSong):
+        e.insert_field_at(
+            index=0,
+            name="Station",
+            value=f"{song.station.name}, hosted by {song.artist}",
+        )
 
     return e
+
+
+def embed_queued_songs(
+    songs: list[BaseSong],
+    maximum_listed: int = 20,
+) -> discord.Embed:
+    """
+    One message for several songs that were added to the queue together.
+    """
+    lines = [
+        (
+            f"{i}. [{song.title}]({song.url}) by {song.artist}"
+            if song.url
+            else f"{i}. {song.title} by {song.artist}"
+        )
+        for i, song in enumerate(songs[:maximum_listed], start=1)
+    ]
+    if len(songs) > maximum_listed:
+        lines.append(f"...and {len(songs) - maximum_listed} more")
+
+    return discord.Embed(
+        title=f"Added to Queue: {len(songs)} Songs",
+        description="\n".join(lines)[:4096],
+        color=BLUE,
+    )
@@ -0,0 +1,133 @@
+"""
+Generates local audio fixtures so that benchmarks don't need the network.
+"""
+
+from __future__ import annotations
+
+import math
+import os
+import struct
+import sys
+from array import array
+from pathlib import Path
+
+repository_directory = Path(__file__).parent.parent
+sys.path.insert(0, str(repository_directory))
+
+# `config` refuses to load without these, but their values don't matter here
+for environment_variable in ("API_TOKEN", "SPOTIFY_CLIENT_ID", "SPOTIFY_CLIENT_SECRET"):
+    os.environ.setdefault(environment_variable, "benchmark")
+os.environ.setdefault("DEV_GUILD_ID", "0")
+
+from abilities.music.streaming.common import (  # noqa: E402
+    OPUS_APPLICATION,
+    OPUS_CHANNELS,
+    OPUS_FRAME_SIZE,
+    OPUS_SAMPLE_RATE,
+    load_opuslib,
+)
+
+FIXTURES_DIRECTORY = Path(__file__).parent / "fixtures"
+PACKETS_PER_PAGE = 50  # about what ffmpeg writes (one page per second)
+
+
+def _crc_table() -> list[int]:
+    table = []
+    for i in range(256):
+        crc = i << 24
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x04C11DB7) if crc & 0x80000000 else crc << 1
+        table.append(crc & 0xFFFFFFFF)
+
+    return table
+
+
+CRC_TABLE = _crc_table()
+
+
+def ogg_crc(data: bytes) -> int:
+    crc = 0
+    for byte in data:
+        crc = ((crc << 8) & 0xFFFFFFFF) ^ CRC_TABLE[(crc >> 24) ^ byte]
+
+    return crc
+
+
+def ogg_page(
+    packets: list[bytes],
+    sequence: int,
+    granule_position: int,
+    header_type: int = 0,
+) -> bytes:
+    lacing_values = bytearray()
+    for packet in packets:
+        lacing_values += b"\xff" * (len(packet) // 255) + bytes([len(packet) % 255])
+
+    header = struct.pack(
+        "<4sBBqIIIB",
+        b"OggS",
+        0,
+        header_type,
+        granule_position,
+        1,  # serial number
+        sequence,
+        0,  # checksum, filled in below
+        len(lacing_values),
+    )
+    page = bytearray(header + lacing_values + b"".join(packets))
+    struct.pack_into("<I", page, 22, ogg_crc(page))
+    return bytes(page)
+
+
+def sine_pcm_frames(seconds: int, frequency: int = 440) -> list[bytes]:
+    """
+    A whole number of cycles fit in one second, so one second is generated and repeated.
+    """
+    frames_per_second = OPUS_SAMPLE_RATE // OPUS_FRAME_SIZE
+    one_second = []
+    for frame_index in range(frames_per_second):
+        samples = array("h")
+        for i in range(OPUS_FRAME_SIZE):
+            t = (frame_index * OPUS_FRAME_SIZE + i) / OPUS_SAMPLE_RATE
+            value = int(8000 * math.sin(2 * math.pi * frequency * t))
+            samples.extend([value] * OPUS_CHANNELS)
+        one_second.append(samples.tobytes())
+
+    return one_second * seconds
+
+
+def make_ogg_opus(seconds: int) -> bytes:
+    opuslib = load_opuslib()
+    encoder = opuslib.Encoder(OPUS_SAMPLE_RATE, OPUS_CHANNELS, OPUS_APPLICATION)
+
+    head = struct.pack("<8sBBHIhB", b"OpusHead", 1, OPUS_CHANNELS, 312, 48000, 0, 0)
+    vendor = b"pax-virtuoso benchmarks"
+    tags = struct.pack("<8sI", b"OpusTags", len(vendor)) + vendor + b"\x00" * 4
+
+    pages = [ogg_page([head], 0, 0, header_type=0x02), ogg_page([tags], 1, 0)]
+
+    packets = [encoder.encode(pcm, OPUS_FRAME_SIZE) for pcm in sine_pcm_frames(seconds)]
+    for start in range(0, len(packets), PACKETS_PER_PAGE):
+        end = min(start + PACKETS_PER_PAGE, len(packets))
+        pages.append(
+            ogg_page(
+                packets[start:end],
+                sequence=len(pages),
+                granule_position=end * OPUS_FRAME_SIZE,
+                header_type=0x04 if end == len(packets) else 0,
+            ),
+        )
+
+    return b"".join(pages)
+
+
+def ogg_opus_fixture(seconds: int = 60) -> Path:
+    """
+    Returns the path to a `seconds` long Ogg Opus sine wave, generating it if needed.
+    """
+    path = FIXTURES_DIRECTORY / f"sine-{seconds}s.opus"
+    if not path.exists():
+        FIXTURES_DIRECTORY.mkdir(exist_ok=True)
+        path.write_bytes(make_ogg_opus(seconds))
+
+    return path
@@ -0,0 +1,91 @@
+"""
+Profiles how long it takes to import the bot's abilities, using `python -X importtime`.
+
+Usage: python benchmarks/import_time.py [top_n]
+
+Exits with a non-zero status when the total import time exceeds IMPORT_BUDGET.
+"""
+
+from __future__ import annotations
+
+import os
+import subprocess
+import sys
+from dataclasses import dataclass
+from pathlib import Path
+
+repository_directory = Path(__file__).parent.parent
+
+IMPORT_BUDGET = 0.5  # seconds
+RUNS = 5
+
+
+@dataclass
+class ImportTiming:
+    module: str
+    self_us: int
+    cumulative_us: int
+
+
+def profile_imports() -> list[ImportTiming]:
+    # `config` refuses to load without these, but their values don't matter here
+    environment = {
+        "API_TOKEN": "benchmark",
+        "SPOTIFY_CLIENT_ID": "benchmark",
+        "SPOTIFY_CLIENT_SECRET": "benchmark",
+        "DEV_GUILD_ID": "0",
+        **os.environ,
+    }
+
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import abilities"],
+        cwd=repository_directory,
+        env=environment,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+
+    timings: list[ImportTiming] = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+
+        self_us, cumulative_us, module = line.removeprefix("import time:").split("|")
+        timings.append(
+            ImportTiming(
+                module=module.strip(),
+                self_us=int(self_us),
+                cumulative_us=int(cumulative_us),
+            ),
+        )
+
+    return timings
+
+
+def main() -> None:
+    top_n = int(sys.argv[1]) if len(sys.argv) > 1 else 15
+
+    # the first run warms up the bytecode and filesystem caches
+    runs = [profile_imports() for _ in range(RUNS + 1)][1:]
+    totals = sorted(
+        next(t.cumulative_us for t in timings if t.module == "abilities") / 1e6
+        for timings in runs
+    )
+    median_total = totals[len(totals) // 2]
+
+    print(f"Slowest imports (cumulative, from the last of {RUNS} runs):")
+    for timing in sorted(runs[-1], key=lambda t: t.cumulative_us, reverse=True)[:top_n]:
+        print(f"  {timing.cumulative_us / 1000:8.1f} ms  {timing.module}")
+
+    print(
+        f"Median total import time: {median_total * 1000:.1f} ms (budget: {IMPORT_BUDGET * 1000:.0f} ms)",
+    )
+
+    if median_total > IMPORT_BUDGET:
+        print("Import time is over budget!")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
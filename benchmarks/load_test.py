@@ -0,0 +1,430 @@
+"""
+Simulates many guilds playing at once, without Discord or the network.
+
+Each guild gets a `SongPlayer` connected to a stand-in voice client, which
+reads packets on the same 20 ms schedule as discord.py's `AudioPlayer`.
+Songs are fetched through the real `youtube.fetch`, with a stand-in `yt-dlp`
+on the PATH whose stream URLs point at a fixture served from localhost.
+
+Usage: python benchmarks/load_test.py [--guilds 1 5 10 25] [--seconds 30]
+    [--volume 100] [--effects] [--shared] [--stub-ffmpeg]
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import hashlib
+import os
+import re
+import resource
+import shutil
+import stat
+import sys
+import tempfile
+import threading
+import time
+from dataclasses import dataclass, field
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Any, Callable
+from urllib.request import urlopen
+
+FRAME_DURATION = 0.02  # seconds, `discord.player.AudioPlayer.DELAY`
+READ_SIZE = 64 * 1024
+STARTUP_ALLOWANCE = 10  # seconds
+FIXTURE_ENVIRONMENT_VARIABLE = "LOAD_TEST_FIXTURE_URL"
+STREAM_URL_LIFETIME = 6 * 60 * 60  # seconds, like YouTube's
+
+
+def stand_in_yt_dlp(arguments: list[str]) -> None:
+    """
+    Prints the video info that `youtube.extract` asks for,
+    with the fixture's URL as the stream URL.
+    """
+    query = arguments[-1]
+    # searches remembered by `youtube` come back as watch URLs
+    video_url = re.search(r"[?&]v=([\w-]{11})", query)
+    video_id = (
+        video_url.group(1)
+        if video_url
+        else hashlib.sha256(query.encode()).hexdigest()[:11]
+    )
+    info = [
+        video_id,
+        f"Load test: {query}",
+        "https://example.com/thumbnail.jpg",
+        "20240101",
+        "0",
+        "0",
+        "Load Test",
+        "https://example.com/channel",
+        "0",
+        f"{os.environ[FIXTURE_ENVIRONMENT_VARIABLE]}?expire={time.time() + STREAM_URL_LIFETIME:.0f}",
+        "{}",
+    ]
+    print("\n".join(info))
+
+
+def stand_in_ffmpeg(arguments: list[str]) -> None:
+    """
+    Copies the input to stdout. The fixture is already Ogg Opus, so this
+    leaves out the cost of transcoding and measures only the bot itself.
+    """
+    source = arguments[arguments.index("-i") + 1]
+    if source == "pipe:0":
+        shutil.copyfileobj(sys.stdin.buffer, sys.stdout.buffer, READ_SIZE)
+    else:
+        with urlopen(source) as response:
+            shutil.copyfileobj(response, sys.stdout.buffer, READ_SIZE)
+
+
+STAND_INS: dict[str, Callable[[list[str]], None]] = {
+    "yt-dlp": stand_in_yt_dlp,
+    "ffmpeg": stand_in_ffmpeg,
+}
+
+
+class QuietRequestHandler(SimpleHTTPRequestHandler):
+    def log_message(self: QuietRequestHandler, *_: Any) -> None:  # noqa: ANN401
+        pass
+
+
+def serve_directory(directory: Path) -> ThreadingHTTPServer:
+    """
+    Serves `directory` over HTTP on localhost, in the background.
+    """
+    server = ThreadingHTTPServer(
+        ("127.0.0.1", 0),
+        partial(QuietRequestHandler, directory=str(directory)),
+    )
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def install_stand_ins(directory: Path, names: list[str]) -> None:
+    """
+    Puts executables called `names` at the front of the PATH, each of
+    which runs the matching function in this file.
+    """
+    for name in names:
+        executable = directory / name
+        executable.write_text(
+            f'#!/bin/sh\nexec "{sys.executable}" "{Path(__file__).resolve()}" --stand-in {name} -- "$@"\n',
+        )
+        executable.chmod(executable.stat().st_mode | stat.S_IEXEC)
+
+    os.environ["PATH"] = f"{directory}{os.pathsep}{os.environ['PATH']}"
+
+
+@dataclass
+class StreamStats:
+    packets: int = 0
+    deadline_misses: int = 0
+    worst_lateness: float = 0.0  # seconds
+    first_packet_latency: float = 0.0  # seconds
+    read_times: list[float] = field(default_factory=list)
+
+
+def make_voice_client_class() -> type:
+    import discord
+
+    class StandInVoiceClient(discord.VoiceClient):
+        """
+        Just enough of `discord.VoiceClient` for `SongPlayer`. Packets are
+        read (and dropped) on a thread with the same timing as `AudioPlayer`.
+        """
+
+        def __init__(
+            self: StandInVoiceClient,
+            channel: Any,
+            loop: asyncio.AbstractEventLoop,
+            stats: StreamStats,
+        ) -> None:
+            self.channel = channel
+            self.loop = loop
+            self.stats = stats
+            self.connected = True
+            self.playing = threading.Event()
+            self.stopping = threading.Event()
+
+        def is_connected(self: StandInVoiceClient) -> bool:
+            return self.connected
+
+        def is_playing(self: StandInVoiceClient) -> bool:
+            return self.playing.is_set()
+
+        def is_paused(self: StandInVoiceClient) -> bool:
+            return False
+
+        def play(
+            self: StandInVoiceClient,
+            source: discord.AudioSource,
+            *,
+            after: Callable[[Exception | None], Any] | None = None,
+            **_: Any,
+        ) -> None:
+            self.stopping.clear()
+            self.playing.set()
+            threading.Thread(
+                target=self._run,
+                args=(source, after),
+                name=f"stand-in player {self.channel.guild.id}",
+                daemon=True,
+            ).start()
+
+        def _run(
+            self: StandInVoiceClient,
+            source: discord.AudioSource,
+            after: Callable[[Exception | None], Any] | None,
+        ) -> None:
+            error = None
+            stats = self.stats
+            loops = 0
+            try:
+                requested_at = time.perf_counter()
+                packet = source.read()
+                # Startup (waiting for the pipeline) isn't a deadline miss
+                started_at = time.perf_counter()
+                stats.first_packet_latency = started_at - requested_at
+
+                while packet and not self.stopping.is_set():
+                    loops += 1
+                    stats.packets += 1
+                    next_time = started_at + FRAME_DURATION * loops
+                    time.sleep(max(0, next_time - time.perf_counter()))
+
+                    read_started_at = time.perf_counter()
+                    packet = source.read()
+                    stats.read_times.append(time.perf_counter() - read_started_at)
+
+                    # `AudioPlayer` sends each packet as soon as `read` returns.
+                    # If that's a whole frame late, there's a gap in the audio.
+                    lateness = time.perf_counter() - next_time
+                    if lateness > FRAME_DURATION:
+                        stats.deadline_misses += 1
+                    stats.worst_lateness = max(stats.worst_lateness, lateness)
+            except Exception as e:
+                error = e
+            finally:
+                self.playing.clear()
+                if after:
+                    after(error)
+                source.cleanup()
+
+        def stop(self: StandInVoiceClient) -> None:
+            self.stopping.set()
+
+        async def disconnect(
+            self: StandInVoiceClient,
+            *,
+            force: bool = False,  # noqa: ARG002
+        ) -> None:
+            self.stop()
+            self.connected = False
+            self.channel.guild.voice_client = None
+
+    return StandInVoiceClient
+
+
+class StandInWebhook:
+    token = "load-test"
+
+    async def send(self: StandInWebhook, *_: Any, **__: Any) -> None:
+        pass
+
+
+def resident_memory() -> int:
+    with open("/proc/self/status") as status:
+        for line in status:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) * 1024
+
+    return 0
+
+
+async def run_round(
+    guild_count: int,
+    seconds: int,
+    options: argparse.Namespace,
+) -> dict[str, float]:
+    from abilities.music.song_player import SongPlayer
+    from abilities.music.streaming import processes, youtube
+    from abilities.music.streaming.effects import EffectSettings
+
+    voice_client_class = make_voice_client_class()
+    loop = asyncio.get_running_loop()
+    me = SimpleNamespace(id=0)
+    stats = [StreamStats() for _ in range(guild_count)]
+
+    async def start_guild(index: int) -> None:
+        guild = SimpleNamespace(id=index + 1, voice_client=None, me=me)
+        # someone has to be listening, or the bot leaves after the grace period
+        listener = SimpleNamespace(id=index + 1000)
+        channel = SimpleNamespace(
+            guild=guild,
+            mention="#load-test",
+            members=[listener],
+        )
+
+        async def connect() -> None:
+            guild.voice_client = voice_client_class(channel, loop, stats[index])
+
+        channel.connect = connect
+
+        song_player = SongPlayer.get_or_create(guild)  # type: ignore[arg-type]
+        song_player.volume = options.volume / 100
+        if options.effects:
+            song_player.effects = EffectSettings(bass_db=6, compressor=True)
+
+        query = "shared song" if options.shared else f"song {index}"
+        song = await youtube.fetch(query)
+        await song_player.play_or_queue(
+            song,
+            channel,  # type: ignore[arg-type]
+            SimpleNamespace(mention="@load-test"),  # type: ignore[arg-type]
+            StandInWebhook(),  # type: ignore[arg-type]
+        )
+
+    memory_samples = [resident_memory()]
+    usage_before = resource.getrusage(resource.RUSAGE_SELF)
+    # children are only counted once they've exited and been reaped
+    children_before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    started_at = time.perf_counter()
+
+    await asyncio.gather(*(start_guild(index) for index in range(guild_count)))
+    # leave time for slow starts, but not forever in case a stream is stuck
+    while time.perf_counter() - started_at < seconds + STARTUP_ALLOWANCE:
+        memory_samples.append(resident_memory())
+        # (players stay connected for a while after their last song)
+        if not any(
+            player.currently_playing
+            for player in SongPlayer.song_player_by_guild.values()
+        ):
+            break
+        await asyncio.sleep(0.5)
+
+    wall_time = time.perf_counter() - started_at
+    usage_after = resource.getrusage(resource.RUSAGE_SELF)
+
+    for song_player in list(SongPlayer.song_player_by_guild.values()):
+        await song_player.stop()
+    SongPlayer.song_player_by_guild.clear()
+    await asyncio.sleep(0.1)
+    deadline = time.monotonic() + 5
+    while processes.tracked_processes() and time.monotonic() < deadline:
+        processes.reap()
+        await asyncio.sleep(0.05)
+    children_after = resource.getrusage(resource.RUSAGE_CHILDREN)
+    youtube.live_songs.clear()
+
+    packets = sum(stream.packets for stream in stats)
+    read_times = sorted(time for stream in stats for time in stream.read_times)
+    cpu = (usage_after.ru_utime + usage_after.ru_stime) - (
+        usage_before.ru_utime + usage_before.ru_stime
+    )
+    children_cpu = (children_after.ru_utime + children_after.ru_stime) - (
+        children_before.ru_utime + children_before.ru_stime
+    )
+    return {
+        "guilds": guild_count,
+        "packets": packets,
+        "miss_percent": 100 * sum(s.deadline_misses for s in stats) / max(packets, 1),
+        "worst_stream_misses": max(s.deadline_misses for s in stats),
+        "first_packet_ms": 1000 * max(s.first_packet_latency for s in stats),
+        "worst_lateness_ms": 1000 * max(s.worst_lateness for s in stats),
+        "read_p99_ms": (
+            1000 * read_times[int(len(read_times) * 0.99)] if read_times else 0.0
+        ),
+        "bot_cpu_percent": 100 * cpu / wall_time,
+        "children_cpu_percent": 100 * children_cpu / wall_time,
+        "peak_rss_mib": max(memory_samples) / 1024 / 1024,
+    }
+
+
+def print_report(rows: list[dict[str, float]]) -> None:
+    columns = [
+        ("guilds", "Guilds", "{:.0f}"),
+        ("packets", "Packets", "{:,.0f}"),
+        ("miss_percent", "Misses", "{:.2f}%"),
+        ("worst_stream_misses", "Worst stream", "{:.0f}"),
+        ("worst_lateness_ms", "Worst late", "{:.1f} ms"),
+        ("first_packet_ms", "First packet", "{:.0f} ms"),
+        ("read_p99_ms", "read() p99", "{:.2f} ms"),
+        ("bot_cpu_percent", "Bot CPU", "{:.0f}%"),
+        ("children_cpu_percent", "Child CPU", "{:.0f}%"),
+        ("peak_rss_mib", "Peak RSS", "{:.0f} MiB"),
+    ]
+    cells = [[header for _, header, _ in columns]] + [
+        [template.format(row[key]) for key, _, template in columns] for row in rows
+    ]
+    widths = [max(len(row[i]) for row in cells) for i in range(len(columns))]
+    for row in cells:
+        print("  ".join(cell.rjust(width) for cell, width in zip(row, widths)))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--guilds", type=int, nargs="+", default=[1, 5, 10, 25])
+    parser.add_argument("--seconds", type=int, default=30, help="length of each round")
+    parser.add_argument("--volume", type=float, default=100, help="percent")
+    parser.add_argument(
+        "--effects", action="store_true", help="bass boost and compressor"
+    )
+    parser.add_argument(
+        "--shared",
+        action="store_true",
+        help="every guild plays the same song (one shared pipeline)",
+    )
+    parser.add_argument(
+        "--stub-ffmpeg",
+        action="store_true",
+        help="copy the fixture through instead of transcoding it",
+    )
+    parser.add_argument("--stand-in", choices=STAND_INS, help=argparse.SUPPRESS)
+    options, arguments = parser.parse_known_args()
+
+    if options.stand_in:
+        STAND_INS[options.stand_in](
+            arguments[1:] if arguments[:1] == ["--"] else arguments
+        )
+        return
+
+    stand_ins = ["yt-dlp"]
+    if options.stub_ffmpeg:
+        stand_ins.append("ffmpeg")
+    elif not shutil.which("ffmpeg"):
+        parser.error("ffmpeg isn't installed, use --stub-ffmpeg to run without it")
+
+    # Only imported now, so that the stand-ins start quickly
+    from fixtures import ogg_opus_fixture
+
+    import abilities  # noqa: F401
+
+    fixture = ogg_opus_fixture(options.seconds).resolve()
+    server = serve_directory(fixture.parent)
+    host, port = server.server_address[:2]
+    os.environ[FIXTURE_ENVIRONMENT_VARIABLE] = f"http://{host}:{port}/{fixture.name}"
+
+    with tempfile.TemporaryDirectory() as directory:
+        # loudness measurements are written to the working directory
+        os.chdir(directory)
+        install_stand_ins(Path(directory), stand_ins)
+
+        print(
+            f"{options.seconds}s rounds, volume {options.volume:g}%"
+            f"{', effects' if options.effects else ''}"
+            f"{', shared pipeline' if options.shared else ''}"
+            f"{', stub ffmpeg' if options.stub_ffmpeg else ''}",
+        )
+        rows = [
+            asyncio.run(run_round(guild_count, options.seconds, options))
+            for guild_count in options.guilds
+        ]
+        print_report(rows)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+"""
+Compares `OggPacketReader` against discord.py's `OggStream` on a local fixture.
+
+Usage: python benchmarks/ogg_reader.py [fixture_seconds]
+"""
+
+from __future__ import annotations
+
+import io
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from typing import IO, Callable, Iterator
+
+from fixtures import ogg_opus_fixture
+
+from abilities.music.streaming.ogg import OggPacketReader
+from discord.oggparse import OggStream
+
+ROUNDS = 5
+
+
+def from_pipe(data: bytes, buffering: int) -> IO[bytes]:
+    """
+    Feeds `data` through an OS pipe, like ffmpeg's stdout.
+    """
+    read_fd, write_fd = os.pipe()
+
+    def write() -> None:
+        with os.fdopen(write_fd, "wb") as f:
+            f.write(data)
+
+    threading.Thread(target=write, daemon=True).start()
+    return os.fdopen(read_fd, "rb", buffering=buffering)
+
+
+def measure(
+    name: str,
+    iter_packets: Callable[[IO[bytes]], Iterator[bytes]],
+    open_stream: Callable[[], IO[bytes]],
+) -> list[bytes]:
+    durations = []
+    for _ in range(ROUNDS):
+        stream = open_stream()
+        started_at = time.perf_counter()
+        packets = list(iter_packets(stream))
+        durations.append(time.perf_counter() - started_at)
+
+    tracemalloc.start()
+    list(iter_packets(open_stream()))
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    best = min(durations)
+    print(
+        f"  {name:<16} {best * 1000:8.1f} ms  {len(packets) / best:>10,.0f} packets/s  peak {peak / 1024:,.0f} KiB",
+    )
+    return packets
+
+
+def main() -> None:
+    seconds = int(sys.argv[1]) if len(sys.argv) > 1 else 600
+    data = ogg_opus_fixture(seconds).read_bytes()
+    print(f"Fixture: {seconds}s, {len(data) / 1024:,.0f} KiB (best of {ROUNDS})")
+
+    print("From bytes:")
+    expected = measure(
+        "OggStream",
+        lambda stream: OggStream(stream).iter_packets(),
+        lambda: io.BytesIO(data),
+    )
+    actual = measure(
+        "OggPacketReader",
+        lambda stream: OggPacketReader(stream).iter_packets(),
+        lambda: io.BytesIO(data),
+    )
+    assert actual == expected, "OggPacketReader returned different packets!"
+
+    # OggStream needs a buffered pipe (it assumes reads are never short),
+    # whereas OggPacketReader does its own buffering.
+    print("From a pipe:")
+    measure(
+        "OggStream",
+        lambda stream: OggStream(stream).iter_packets(),
+        lambda: from_pipe(data, buffering=-1),
+    )
+    actual = measure(
+        "OggPacketReader",
+        lambda stream: OggPacketReader(stream).iter_packets(),
+        lambda: from_pipe(data, buffering=0),
+    )
+    assert actual == expected, "OggPacketReader returned different packets!"
+
+
+if __name__ == "__main__":
+    main()
@@ -1,17 +1,123 @@
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import json
+import time
+from contextlib import suppress
+from pathlib import Path
+from typing import Awaitable, Callable
+
 import discord
 
-from config import dev_guild_id
+from config import dev_guild_id, metrics_port
+from loop_monitor import monitor as loop_monitor
+from metrics_exporter import exporter as metrics_exporter
+
+COMMAND_TREE_HASHES_FILE = Path("command_tree_hashes.json")
+STARTUP_BUDGET = 5.0  # seconds from launch until ready
 
 intents = discord.Intents.none()
 
 intents.guilds = True
 intents.voice_states = True
 
-client = discord.Client(intents=intents)
+# Run as the bot shuts down, e.g. to close HTTP sessions
+shutdown_callbacks: list[Callable[[], Awaitable[None]]] = []
+
+
+class Client(discord.Client):
+    async def close(self: Client) -> None:
+        for callback in shutdown_callbacks:
+            try:
+                await callback()
+            except Exception as e:
+                print(f"Error while shutting down: {e!r}")
+
+        await super().close()
+
+
+client = Client(intents=intents)
 tree = discord.app_commands.CommandTree(client)
 
 
+class StartupTimer:
+    def __init__(self: StartupTimer) -> None:
+        self.launched_at = self.phase_started_at = time.perf_counter()
+        self.finished = False
+
+    def start(self: StartupTimer, launched_at: float) -> None:
+        self.launched_at = self.phase_started_at = launched_at
+
+    def phase(self: StartupTimer, name: str) -> None:
+        now = time.perf_counter()
+        print(f"Startup phase {name!r} took {now - self.phase_started_at:.3f}s")
+        self.phase_started_at = now
+
+    def finish(self: StartupTimer) -> float:
+        self.finished = True
+        total = time.perf_counter() - self.launched_at
+        print(f"Bot was ready {total:.3f}s after launch")
+        if total > STARTUP_BUDGET:
+            print(
+                f"Startup took longer than its {STARTUP_BUDGET:.1f}s budget! See ./benchmarks/README.md",
+            )
+        return total
+
+
+startup_timer = StartupTimer()
+
+
+def command_tree_hash(guild: discord.abc.Snowflake | None) -> str:
+    """
+    A stable hash of every command registered for `guild` (or globally),
+    in the same form they're uploaded to Discord.
+    """
+    payload = sorted(
+        (command.to_dict(tree) for command in tree.get_commands(guild=guild)),
+        key=lambda command: (command["type"], command["name"]),
+    )
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+
+
+async def sync_command_tree(force: bool = False) -> list[str]:
+    """
+    Syncs the global and dev guild commands whose definitions changed since
+    the last sync. Returns the scopes that were synced.
+    """
+    stored_hashes: dict[str, str] = {}
+    with suppress(FileNotFoundError, json.JSONDecodeError):
+        stored_hashes = json.loads(COMMAND_TREE_HASHES_FILE.read_text())
+
+    synced: list[str] = []
+    for guild in (None, discord.Object(dev_guild_id)):
+        scope = f"{client.application_id}:{guild.id if guild else 'global'}"
+        current_hash = command_tree_hash(guild)
+        if not force and stored_hashes.get(scope) == current_hash:
+            continue
+
+        await tree.sync(guild=guild)
+        stored_hashes[scope] = current_hash
+        synced.append(scope)
+
+    COMMAND_TREE_HASHES_FILE.write_text(json.dumps(stored_hashes, indent=4))
+    return synced
+
+
 @client.event
 async def on_ready() -> None:
-    await tree.sync()
-    await tree.sync(guild=discord.Object(dev_guild_id))
+    loop_monitor.start(asyncio.get_running_loop())
+    metrics_exporter.start(metrics_port)
+
+    if startup_timer.finished:
+        # `on_ready` is also dispatched after reconnects,
+        # but the commands can't have changed since we started.
+        return
+
+    startup_timer.phase("connect")
+
+    synced = await sync_command_tree()
+    print(f"Synced commands for {synced}" if synced else "Commands are up to date")
+    startup_timer.phase("command sync")
+
+    startup_timer.finish()
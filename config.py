@@ -13,10 +13,23 @@ def getenv_string(environment_variable: str) -> str:
     raise OSError(msg)
 
 
-def getenv_int(environment_variable: str) -> int:
+def getenv_int(environment_variable: str, default: int | None = None) -> int:
     if s := os.getenv(environment_variable):
         with suppress(ValueError):
             return int(s)
+    elif default is not None:
+        return default
+
+    msg = f"Required environment variable {environment_variable!r} is not set. Please read ./ENVIRONMENT.md"
+    raise OSError(msg)
+
+
+def getenv_float(environment_variable: str, default: float | None = None) -> float:
+    if s := os.getenv(environment_variable):
+        with suppress(ValueError):
+            return float(s)
+    elif default is not None:
+        return default
 
     msg = f"Required environment variable {environment_variable!r} is not set. Please read ./ENVIRONMENT.md"
     raise OSError(msg)
@@ -25,4 +38,32 @@ def getenv_int(environment_variable: str) -> int:
 api_token = getenv_string("API_TOKEN")
 spotify_client_id = getenv_string("SPOTIFY_CLIENT_ID")
 spotify_client_secret = getenv_string("SPOTIFY_CLIENT_SECRET")
+spotify_requests_per_second = getenv_int("SPOTIFY_REQUESTS_PER_SECOND", 5)
 dev_guild_id = getenv_int("DEV_GUILD_ID")
+empty_channel_grace_period = getenv_int("EMPTY_CHANNEL_GRACE_PERIOD", 30)
+# how long to stay connected (silently) after the queue runs out
+voice_linger_period = getenv_int("VOICE_LINGER_PERIOD", 60)
+# then the song is paused for this long, in case they come back (0 stops right away)
+empty_channel_pause_limit = getenv_int("EMPTY_CHANNEL_PAUSE_LIMIT", 15 * 60)
+
+# Opus encoder quality is lowered towards these floors when the CPU is struggling
+opus_max_complexity = getenv_int("OPUS_MAX_COMPLEXITY", 10)
+opus_min_complexity = getenv_int("OPUS_MIN_COMPLEXITY", 3)
+opus_max_bitrate = getenv_int("OPUS_MAX_BITRATE", 0)  # 0 lets libopus decide
+opus_min_bitrate = getenv_int("OPUS_MIN_BITRATE", 48000)
+
+loudness_target = getenv_float("LOUDNESS_TARGET", -14)  # LUFS
+
+# Where Prometheus can scrape `/metrics` from, on localhost (0 turns it off)
+metrics_port = getenv_int("METRICS_PORT", 9464)
+
+# Where `/play` looks for songs on the "Music library" platform, if anywhere
+music_library_directory = os.getenv("MUSIC_LIBRARY_DIRECTORY")
+
+# `/play` is refused once any of these are reached, to protect the host
+max_resolutions = getenv_int("MAX_RESOLUTIONS", 10)
+max_resolutions_per_guild = getenv_int("MAX_RESOLUTIONS_PER_GUILD", 3)
+max_queued_songs = getenv_int("MAX_QUEUED_SONGS", 1000)
+max_queued_songs_per_guild = getenv_int("MAX_QUEUED_SONGS_PER_GUILD", 100)
+max_pipelines = getenv_int("MAX_PIPELINES", 100)
+max_pipelines_per_guild = getenv_int("MAX_PIPELINES_PER_GUILD", 20)
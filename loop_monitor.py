@@ -0,0 +1,122 @@
+from __future__ import annotations
+
+import asyncio
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+from dataclasses import dataclass
+
+import metrics
+
+SAMPLE_INTERVAL = 0.5  # seconds between lag measurements
+SLOW_CALLBACK_THRESHOLD = 0.1  # seconds blocked before sampling the stack
+
+lag_histogram = metrics.histogram(
+    "event_loop_lag_seconds",
+    "Delay between scheduling a callback on the event loop and it running.",
+)
+slow_callback_counter = metrics.counter(
+    "event_loop_slow_callbacks_total",
+    "Number of times the event loop was blocked for longer than the threshold.",
+)
+
+
+@dataclass
+class SlowCallback:
+    started_at: float  # unix timestamp
+    duration: float  # seconds
+    stack: str
+
+
+class LoopMonitor:
+    """
+    Measures event loop lag from a watchdog thread.
+
+    Every `SAMPLE_INTERVAL` seconds the watchdog schedules a no-op callback on the
+    loop and times how long it takes to run. If the loop doesn't get to it within
+    `SLOW_CALLBACK_THRESHOLD`, the loop thread's stack is captured so that the
+    offending blocking call can be found. When stopped, the thread exits entirely.
+    """
+
+    def __init__(
+        self: LoopMonitor,
+        sample_interval: float = SAMPLE_INTERVAL,
+        slow_callback_threshold: float = SLOW_CALLBACK_THRESHOLD,
+    ) -> None:
+        self.sample_interval = sample_interval
+        self.slow_callback_threshold = slow_callback_threshold
+        self.slow_callbacks: deque[SlowCallback] = deque(maxlen=20)
+
+        # replaced on every start, so that a thread which hasn't noticed
+        # the last stop yet can't be revived by clearing it
+        self._stopping = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    @property
+    def running(self: LoopMonitor) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self: LoopMonitor, loop: asyncio.AbstractEventLoop) -> None:
+        if self.running:
+            return
+
+        assert loop.is_running()
+        loop_thread_id = threading.get_ident()
+
+        self._stopping = threading.Event()
+        self._thread = threading.Thread(
+            target=self._watch,
+            args=(loop, loop_thread_id, self._stopping),
+            name="loop-monitor",
+            daemon=True,
+        )
+        self._thread.start()
+
+    def stop(self: LoopMonitor) -> None:
+        self._stopping.set()
+        self._thread = None
+
+    def _watch(
+        self: LoopMonitor,
+        loop: asyncio.AbstractEventLoop,
+        loop_thread_id: int,
+        stopping: threading.Event,
+    ) -> None:
+        while not stopping.wait(self.sample_interval):
+            if loop.is_closed():
+                return
+
+            ran = threading.Event()
+            scheduled_at = time.perf_counter()
+            try:
+                loop.call_soon_threadsafe(ran.set)
+            except RuntimeError:
+                # the loop was closed between our check and the call
+                return
+
+            stack = None
+            if not ran.wait(self.slow_callback_threshold):
+                frame = sys._current_frames().get(loop_thread_id)  # noqa: SLF001
+                stack = "".join(traceback.format_stack(frame)) if frame else ""
+
+                while not ran.wait(self.sample_interval):
+                    if stopping.is_set() or loop.is_closed():
+                        return
+
+            lag = time.perf_counter() - scheduled_at
+            lag_histogram.observe(lag)
+
+            if stack is not None:
+                slow_callback_counter.inc()
+                self.slow_callbacks.append(
+                    SlowCallback(
+                        started_at=time.time() - lag,
+                        duration=lag,
+                        stack=stack,
+                    ),
+                )
+
+
+monitor = LoopMonitor()
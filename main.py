@@ -1,5 +1,12 @@
+import time
+
+launched_at = time.perf_counter()
+
 import abilities  # noqa
-from bot import client
-from config import api_token
+from bot import client, startup_timer  # noqa: E402
+from config import api_token  # noqa: E402
+
+startup_timer.start(launched_at)
+startup_timer.phase("imports")
 
 client.run(api_token)
@@ -0,0 +1,209 @@
+from __future__ import annotations
+
+import threading
+from collections import deque
+from typing import Callable, ClassVar
+
+PERCENTILES = (50, 90, 99)
+
+# Called before every scrape, to update gauges that are cheaper to compute on
+# demand (e.g. by counting queues) than to keep up to date all the time
+scrape_callbacks: list[Callable[[], None]] = []
+
+
+class Metric:
+    registry: ClassVar[dict[str, Metric]] = {}
+    prometheus_type: ClassVar[str]
+
+    def __init__(self: Metric, name: str, description: str) -> None:
+        self.name = name
+        self.description = description
+        self._lock = threading.Lock()
+
+    @classmethod
+    def get_or_create(
+        cls: type[Metric],
+        name: str,
+        description: str,
+        **kwargs: int | str,
+    ) -> Metric:
+        if name not in cls.registry:
+            cls.registry[name] = cls(name, description, **kwargs)
+
+        metric = cls.registry[name]
+        if not isinstance(metric, cls):
+            msg = f"Metric {name!r} is already registered as a {type(metric).__name__}."
+            raise TypeError(msg)
+
+        return metric
+
+
+class Counter(Metric):
+    """
+    A monotonically increasing count, such as the number of throttled requests.
+    """
+
+    prometheus_type = "counter"
+
+    def __init__(
+        self: Counter,
+        name: str,
+        description: str,
+        label_name: str = "label",
+    ) -> None:
+        super().__init__(name, description)
+        self.label_name = label_name
+        self.values: dict[str, float] = {}
+
+    def inc(self: Counter, amount: float = 1, label: str = "") -> None:
+        with self._lock:
+            self.values[label] = self.values.get(label, 0) + amount
+
+    def value(self: Counter, label: str = "") -> float:
+        return self.values.get(label, 0)
+
+
+class Gauge(Metric):
+    """
+    A value that can go up and down, such as the number of active pipelines.
+    """
+
+    prometheus_type = "gauge"
+
+    def __init__(
+        self: Gauge,
+        name: str,
+        description: str,
+        label_name: str = "label",
+    ) -> None:
+        super().__init__(name, description)
+        self.label_name = label_name
+        self.values: dict[str, float] = {}
+
+    def set(self: Gauge, value: float, label: str = "") -> None:
+        self.values[label] = value
+
+    def inc(self: Gauge, amount: float = 1, label: str = "") -> None:
+        with self._lock:
+            self.values[label] = self.values.get(label, 0) + amount
+
+    def dec(self: Gauge, amount: float = 1, label: str = "") -> None:
+        self.inc(-amount, label)
+
+    def remove(self: Gauge, label: str) -> None:
+        self.values.pop(label, None)
+
+    def value(self: Gauge, label: str = "") -> float:
+        return self.values.get(label, 0)
+
+
+class Histogram(Metric):
+    """
+    Keeps the most recent `window` observations so that percentiles can be
+    reported without storing every sample forever.
+    """
+
+    # the percentiles are reported as quantiles, like a Prometheus summary
+    prometheus_type = "summary"
+
+    def __init__(
+        self: Histogram,
+        name: str,
+        description: str,
+        window: int = 1024,
+    ) -> None:
+        super().__init__(name, description)
+        self.samples: deque[float] = deque(maxlen=window)
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self: Histogram, value: float) -> None:
+        with self._lock:
+            self.samples.append(value)
+            self.count += 1
+            self.total += value
+
+    def percentile(self: Histogram, percent: float) -> float:
+        with self._lock:
+            ordered = sorted(self.samples)
+
+        if not ordered:
+            return 0.0
+
+        index = min(len(ordered) - 1, int(len(ordered) * percent / 100))
+        return ordered[index]
+
+    def summary(self: Histogram) -> dict[str, float]:
+        return {f"p{p}": self.percentile(p) for p in PERCENTILES}
+
+
+def counter(name: str, description: str, label_name: str = "label") -> Counter:
+    metric = Counter.get_or_create(name, description, label_name=label_name)
+    assert isinstance(metric, Counter)
+    return metric
+
+
+def gauge(name: str, description: str, label_name: str = "label") -> Gauge:
+    metric = Gauge.get_or_create(name, description, label_name=label_name)
+    assert isinstance(metric, Gauge)
+    return metric
+
+
+def histogram(name: str, description: str, window: int = 1024) -> Histogram:
+    metric = Histogram.get_or_create(name, description, window=window)
+    assert isinstance(metric, Histogram)
+    return metric
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n")
+
+
+def _labels(label_name: str, label: str) -> str:
+    if not label:
+        return ""
+
+    value = _escape(label).replace('"', '\\"')
+    return f'{{{label_name}="{value}"}}'
+
+
+def _samples(metric: Metric) -> list[tuple[str, str, float]]:
+    """
+    (name suffix, labels, value) for every sample of `metric`.
+    """
+    if isinstance(metric, (Counter, Gauge)):
+        with metric._lock:
+            values = list(metric.values.items())
+
+        return [
+            ("", _labels(metric.label_name, label), value) for label, value in values
+        ] or [("", "", 0)]
+
+    assert isinstance(metric, Histogram)
+    return [
+        *(
+            ("", f'{{quantile="{p / 100:g}"}}', metric.percentile(p))
+            for p in PERCENTILES
+        ),
+        ("_sum", "", metric.total),
+        ("_count", "", metric.count),
+    ]
+
+
+def render_prometheus() -> str:
+    """
+    Every registered metric, in Prometheus's text exposition format.
+    """
+    for callback in scrape_callbacks:
+        callback()
+
+    lines = []
+    for name, metric in sorted(Metric.registry.items()):
+        lines.append(f"# HELP {name} {_escape(metric.description)}")
+        lines.append(f"# TYPE {name} {metric.prometheus_type}")
+        lines.extend(
+            f"{name}{suffix}{labels} {value}"
+            for suffix, labels, value in _samples(metric)
+        )
+
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,76 @@
+"""
+Serves every registered metric at `http://127.0.0.1:<METRICS_PORT>/metrics`,
+in Prometheus's text format.
+
+The server runs on its own thread rather than the event loop, so that it can
+still be scraped (and report the lag) while the event loop is blocked.
+"""
+
+from __future__ import annotations
+
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import metrics
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self: MetricsRequestHandler) -> None:
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+
+        body = metrics.render_prometheus().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self: MetricsRequestHandler, *_: object) -> None:
+        # scraped every few seconds, which would drown out everything else
+        pass
+
+
+class MetricsExporter:
+    def __init__(self: MetricsExporter) -> None:
+        self._server: ThreadingHTTPServer | None = None
+
+    @property
+    def running(self: MetricsExporter) -> bool:
+        return self._server is not None
+
+    @property
+    def port(self: MetricsExporter) -> int | None:
+        return self._server.server_address[1] if self._server else None
+
+    def start(self: MetricsExporter, port: int, host: str = "127.0.0.1") -> None:
+        """
+        Port 0 means the exporter is turned off, so nothing is started.
+        """
+        if self.running or not port:
+            return
+
+        try:
+            self._server = ThreadingHTTPServer((host, port), MetricsRequestHandler)
+        except OSError as e:
+            print(f"Couldn't serve metrics on {host}:{port}: {e}")
+            return
+
+        self._server.daemon_threads = True
+        threading.Thread(
+            target=self._server.serve_forever,
+            name="metrics-exporter",
+            daemon=True,
+        ).start()
+
+    def stop(self: MetricsExporter) -> None:
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+
+exporter = MetricsExporter()
@@ -0,0 +1,54 @@
+from __future__ import annotations
+
+import sys
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+
+repository_directory = Path(__file__).parent.parent.parent
+sys.path.insert(0, str(repository_directory))
+
+from abilities.music import admission  # noqa
+from abilities.music.song_player import SongPlayer  # noqa
+
+
+@pytest.fixture(autouse=True)
+def song_players(monkeypatch: pytest.MonkeyPatch) -> dict[int, SongPlayer]:
+    players: dict[int, SongPlayer] = {}
+    monkeypatch.setattr(SongPlayer, "song_player_by_guild", players)
+    return players
+
+
+def test_guild_resolutions_are_limited(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(admission, "max_resolutions_per_guild", 2)
+    rejected_before = admission.rejected_counter.value("guild_resolutions")
+
+    with admission.admit(1), admission.admit(1):
+        with pytest.raises(admission.OverCapacity):
+            admission.admit(1)
+
+        # other guilds have their own limit
+        with admission.admit(2):
+            pass
+
+    assert admission.rejected_counter.value("guild_resolutions") == rejected_before + 1
+    assert admission.resolutions_by_guild == {}
+
+    # the places were given back
+    with admission.admit(1), admission.admit(1):
+        pass
+
+
+def test_pending_resolutions_count_towards_the_queue(
+    monkeypatch: pytest.MonkeyPatch,
+    song_players: dict[int, SongPlayer],
+) -> None:
+    monkeypatch.setattr(admission, "max_queued_songs_per_guild", 2)
+    song_player = SongPlayer(SimpleNamespace(id=1))  # type: ignore[arg-type]
+    song_player.queued_songs.append(SimpleNamespace(song=SimpleNamespace(stream=None)))  # type: ignore[arg-type]
+    song_players[1] = song_player
+
+    with admission.admit(1):
+        with pytest.raises(admission.OverCapacity, match="queue is full"):
+            admission.admit(1)
@@ -0,0 +1,224 @@
+from __future__ import annotations
+
+import io
+import struct
+import sys
+import threading
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+
+repository_directory = Path(__file__).parent.parent.parent
+sys.path.insert(0, str(repository_directory))
+
+from abilities.music.streaming import broadcast  # noqa
+from abilities.music.streaming.broadcast import Broadcast, Station  # noqa
+from abilities.music.streaming.common import Song  # noqa
+
+PACKETS = [bytes([i]) * 3 for i in range(100)]
+HEADERS = [b"OpusHead\x01\x02", b"OpusTags\x00"]
+
+
+def ogg_stream(packets: list[bytes]) -> io.BytesIO:
+    """
+    One (single segment) packet per page.
+    """
+    pages = b""
+    for sequence, packet in enumerate(packets):
+        pages += struct.pack("<4sBBqIIIB", b"OggS", 0, 0, 0, 1, sequence, 0, 1)
+        pages += bytes([len(packet)]) + packet
+
+    return io.BytesIO(pages)
+
+
+def test_fan_out() -> None:
+    shared = Broadcast(ogg_stream(PACKETS))
+    first = shared.source()
+    second = shared.source()
+
+    # interleaved, so that each reads some packets from the pipe itself
+    assert [next(first.packets_iterator) for _ in range(10)] == PACKETS[:10]
+    assert [next(second.packets_iterator) for _ in range(20)] == PACKETS[:20]
+    assert list(first.packets_iterator) == PACKETS[10:]
+    assert list(second.packets_iterator) == PACKETS[20:]
+
+    first.cleanup()
+    second.cleanup()
+
+
+def test_late_joiner_hears_the_start() -> None:
+    shared = Broadcast(ogg_stream(PACKETS))
+    first = shared.source()
+    assert list(first.packets_iterator) == PACKETS
+    assert shared.finished
+
+    late = shared.source()
+    assert list(late.packets_iterator) == PACKETS
+
+    first.cleanup()
+    late.cleanup()
+
+
+def test_history_is_trimmed(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(broadcast, "HISTORY_LIMIT", 10)
+    monkeypatch.setattr(broadcast, "TRIM_INTERVAL", 5)
+
+    shared = Broadcast(ogg_stream(PACKETS))
+    leader = shared.source()
+    straggler = shared.source()
+
+    assert [next(leader.packets_iterator) for _ in range(50)] == PACKETS[:50]
+    # not past the straggler, which hasn't read anything yet
+    assert shared.first_index == 0
+
+    assert [next(straggler.packets_iterator) for _ in range(30)] == PACKETS[:30]
+    assert next(leader.packets_iterator) == PACKETS[50]
+    assert shared.first_index == 29  # where the straggler is up to
+    assert shared.packets == PACKETS[29:51]
+
+    straggler.cleanup()
+    assert list(leader.packets_iterator) == PACKETS[51:]
+    assert shared.first_index > 29
+    assert len(shared.packets) <= 10 + 5
+
+    # a late joiner starts from the oldest packet still kept
+    late = shared.source()
+    assert list(late.packets_iterator) == PACKETS[shared.first_index :]
+
+    leader.cleanup()
+    late.cleanup()
+
+
+def test_last_unsubscribe_tears_down() -> None:
+    stream = ogg_stream(PACKETS)
+    shared = Broadcast(stream)
+    first = shared.source()
+    second = shared.source()
+    assert next(first.packets_iterator) == PACKETS[0]
+
+    first.cleanup()
+    first.cleanup()  # only unsubscribes once
+    assert not shared.closed
+    assert shared.subscriber_count == 1
+
+    second.cleanup()
+    assert shared.closed
+    assert shared.packets == []
+    assert not shared.pipeline_active
+    assert stream.closed
+
+    with pytest.raises(ValueError, match="closed"):
+        shared.source()
+
+
+def hosted_song() -> Song:
+    stream = Broadcast(ogg_stream(PACKETS)).source()
+    return Song("title", "artist", "url", "url", "image", 2, stream)
+
+
+def test_station_listeners_follow_the_host() -> None:
+    station = Station("test", 1)
+    first, second = hosted_song(), hosted_song()
+    station.set_current(first)
+
+    listener = station.source()
+    assert next(listener.packets_iterator) == PACKETS[0]
+    assert next(listener.packets_iterator) == PACKETS[1]
+
+    station.set_current(second)
+    assert next(listener.packets_iterator) == PACKETS[0]
+
+    station.close()
+    assert list(listener.packets_iterator) == []
+    first.stream.cleanup()
+    second.stream.cleanup()
+    assert first.stream.broadcast.closed
+    assert second.stream.broadcast.closed
+
+
+def test_station_listeners_hear_silence_while_the_host_is_idle() -> None:
+    station = Station("test", 1)
+    listener = station.source()
+    # nothing is playing yet
+    assert next(listener.packets_iterator) == broadcast.SILENCE_PACKET
+
+    song = hosted_song()
+    station.set_current(song)
+    assert [next(listener.packets_iterator) for _ in PACKETS] == PACKETS
+
+    # the song's over, and nothing's been queued after it
+    assert next(listener.packets_iterator) == broadcast.SILENCE_PACKET
+
+    station.close()
+    assert list(listener.packets_iterator) == []
+    song.stream.cleanup()
+
+
+def test_cleaning_up_a_listener_stops_it() -> None:
+    station = Station("test", 1)
+    song = hosted_song()
+    station.set_current(song)
+    listener = station.source()
+
+    packets: list[bytes] = []
+
+    def play() -> None:
+        while packet := listener.read():
+            packets.append(packet)
+
+    # like the voice client's thread, which keeps reading after the song ends
+    player = threading.Thread(target=play)
+    player.start()
+    while len(packets) < len(PACKETS) + 5:
+        player.join(0.01)
+
+    assert packets[: len(PACKETS)] == PACKETS
+    assert set(packets[len(PACKETS) :]) == {broadcast.SILENCE_PACKET}
+
+    listener.cleanup()
+    player.join(1)
+    assert not player.is_alive()
+    assert listener.read() == b""
+
+    song.stream.cleanup()
+    station.close()
+
+
+def test_pipelines_that_end_early_are_restarted(
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    monkeypatch.setattr(broadcast, "EARLY_END_TOLERANCE", 0.5)
+    restarted_at = []
+
+    def restart(seconds: float) -> tuple[io.BytesIO, SimpleNamespace]:
+        restarted_at.append(seconds)
+        return ogg_stream(HEADERS + PACKETS[50:]), SimpleNamespace(
+            pid=-1,
+            kill=lambda: None,
+        )
+
+    # 100 packets of 20 ms, but the first pipeline dies halfway through
+    shared = Broadcast(ogg_stream(HEADERS + PACKETS[:50]), duration=2, restart=restart)
+    source = shared.source()
+
+    # without the second set of headers
+    assert list(source.packets_iterator) == HEADERS + PACKETS
+    assert restarted_at == [1.0]
+    assert shared.finished
+    source.cleanup()
+
+
+def test_failed_restarts_end_the_song(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(broadcast, "EARLY_END_TOLERANCE", 0.5)
+
+    def restart(seconds: float) -> tuple[io.BytesIO, SimpleNamespace]:
+        msg = "yt-dlp couldn't find a stream"
+        raise RuntimeError(msg)
+
+    shared = Broadcast(ogg_stream(PACKETS[:50]), duration=2, restart=restart)
+    source = shared.source()
+    assert list(source.packets_iterator) == PACKETS[:50]
+    assert shared.restarts == 1
+    assert shared.finished
+    source.cleanup()
@@ -0,0 +1,48 @@
+from __future__ import annotations
+
+import asyncio
+import sys
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+
+repository_directory = Path(__file__).parent.parent.parent
+sys.path.insert(0, str(repository_directory))
+
+from abilities.music import commands  # noqa
+from abilities.music.streaming import youtube  # noqa
+
+
+def test_playmany_queues_in_order_despite_failures(
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    # later songs are found first
+    delays = {"one": 0.05, "two": 0.04, "missing": 0.03, "broken": 0.02, "five": 0}
+
+    async def fetch_song(query: str, platform: str) -> SimpleNamespace:
+        assert platform == "youtube"
+        await asyncio.sleep(delays[query])
+        if query == "missing":
+            msg = "yt-dlp couldn't find a stream for 'missing'."
+            raise youtube.ExtractionError(msg)
+        if query == "broken":
+            msg = "a bug"
+            raise RuntimeError(msg)
+
+        return SimpleNamespace(title=query)
+
+    monkeypatch.setattr(commands, "fetch_song", fetch_song)
+    queued: list[str] = []
+
+    async def queue(audio: SimpleNamespace) -> None:
+        queued.append(audio.title)
+
+    failures = asyncio.run(
+        commands.queue_in_order(1, list(delays), "youtube", queue),  # type: ignore[arg-type]
+    )
+    assert queued == ["one", "two", "five"]
+    assert failures == [
+        "`missing`: yt-dlp couldn't find a stream for 'missing'.",
+        "`broken`: Something went wrong.",
+    ]
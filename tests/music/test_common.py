@@ -4,12 +4,14 @@ import io
 import sys
 from math import log
 from pathlib import Path
+from types import SimpleNamespace
 
 import pytest
 
 repository_directory = Path(__file__).parent.parent.parent
 sys.path.insert(0, str(repository_directory))
 
+from abilities.music.streaming import common  # noqa
 from abilities.music.streaming.common import BufferedOpusAudioSource  # noqa
 
 OPUS_HEADERS = [
@@ -110,3 +112,56 @@ def test_postprocess_packet(
     assert (
         output == expected_output
     ), f"{message}. Output length: {len(output)}, Expected length: {len(expected_output)}"
+
+
+def test_suspended_sources_resume_where_they_stopped() -> None:
+    source = BufferedOpusAudioSource(iter(FULL_VOLUME_PACKETS[:2]))
+    assert source.read() == FULL_VOLUME_PACKETS[0]
+
+    # the voice client lets go of the source without sending the packet
+    source.suspend()
+    source.cleanup()
+    assert not source.encoder_settings.closed
+
+    assert source.read() == FULL_VOLUME_PACKETS[0]
+    assert source.read() == FULL_VOLUME_PACKETS[1]
+    assert not source.ended
+    assert source.read() == b""
+    assert source.ended
+
+    source.cleanup()
+    assert source.encoder_settings.closed
+
+
+@pytest.mark.parametrize(
+    ("measure_loudness_of", "gain_db", "expected_filter"),
+    [
+        (None, 0, None),
+        (None, -3.5, "volume=-3.50dB"),
+        ("dQw4w9WgXcQ", 0, "ebur128=framelog=quiet"),
+    ],
+)
+def test_normalization_is_applied_by_ffmpeg(
+    monkeypatch: pytest.MonkeyPatch,
+    measure_loudness_of: str | None,
+    gain_db: float,
+    expected_filter: str | None,
+) -> None:
+    spawned = []
+
+    def spawn(arguments: list[str], **_: object) -> SimpleNamespace:
+        spawned.append(arguments)
+        return SimpleNamespace(stdout=io.BytesIO(), stderr=io.BytesIO())
+
+    monkeypatch.setattr(common.processes, "spawn", spawn)
+    common.transmux_to_ogg_opus(
+        "song.mp3",
+        measure_loudness_of=measure_loudness_of,
+        gain_db=gain_db,
+    )
+
+    [arguments] = spawned
+    if expected_filter is None:
+        assert "-af" not in arguments
+    else:
+        assert arguments[arguments.index("-af") + 1] == expected_filter
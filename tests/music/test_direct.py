@@ -0,0 +1,172 @@
+from __future__ import annotations
+
+import socket
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Iterator
+
+import pytest
+
+repository_directory = Path(__file__).parent.parent.parent
+sys.path.insert(0, str(repository_directory))
+
+from abilities.music.streaming import direct  # noqa
+
+CONTENT = bytes(range(256)) * 400
+
+
+class FlakyHandler(BaseHTTPRequestHandler):
+    """
+    Serves `CONTENT`, but hangs up partway through the first response.
+    """
+
+    requests: list[str | None] = []
+
+    def do_GET(self: FlakyHandler) -> None:
+        self.requests.append(self.headers.get("Range"))
+        start = int(self.headers["Range"][6:-1]) if self.headers["Range"] else 0
+
+        self.send_response(206 if start else 200)
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Content-Length", str(len(CONTENT) - start))
+        self.end_headers()
+
+        if len(self.requests) == 1:
+            self.wfile.write(CONTENT[: len(CONTENT) // 3])
+            self.close_connection = True
+        else:
+            self.wfile.write(CONTENT[start:])
+
+    def log_message(self: FlakyHandler, *_: object) -> None:
+        pass
+
+
+@pytest.fixture
+def flaky_url() -> Iterator[str]:
+    FlakyHandler.requests = []
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FlakyHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    host, port = server.server_address[:2]
+    yield f"http://{host}:{port}/song.opus"
+    server.shutdown()
+
+
+def test_ranged_streams_resume_after_the_connection_drops(flaky_url: str) -> None:
+    stream = direct.RangedHTTPStream(flaky_url)
+    assert stream.read() == CONTENT
+    assert FlakyHandler.requests == [None, f"bytes={len(CONTENT) // 3}-"]
+    stream.close()
+
+
+@pytest.mark.parametrize(
+    ("song", "expected"),
+    [
+        ("https://example.com/music/song.MP3", True),
+        ("http://example.com/song.opus?token=abc", True),
+        ("https://www.youtube.com/watch?v=dQw4w9WgXcQ", False),
+        ("ftp://example.com/song.mp3", False),
+        ("song.mp3", False),
+        # private ones too, so that they're refused rather than searched for
+        ("http://127.0.0.1:8080/song.mp3", True),
+    ],
+)
+def test_is_audio_url(song: str, expected: bool) -> None:
+    assert direct.is_audio_url(song) == expected
+
+
+@pytest.mark.parametrize(
+    "url",
+    [
+        "http://127.0.0.1:8080/song.mp3",
+        "http://localhost/song.mp3",
+        "http://admin.localhost./song.mp3",
+        "http://192.168.1.1/song.mp3",
+        "http://10.0.0.5/song.mp3",
+        "http://169.254.169.254/song.mp3",
+        "http://[::1]/song.mp3",
+        "http://[fe80::1%25eth0]/song.mp3",
+    ],
+)
+def test_private_urls_are_refused(url: str) -> None:
+    with pytest.raises(direct.UnplayableSource, match="private"):
+        direct.fetch_url_synchronously(url)
+
+
+def test_urls_that_resolve_to_private_addresses_are_refused(
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    monkeypatch.setattr(
+        direct.socket,
+        "getaddrinfo",
+        lambda *_: [(0, 0, 0, "", ("10.1.2.3", 0))],
+    )
+    assert direct.is_audio_url("http://intranet.example.com/song.mp3")
+    with pytest.raises(direct.UnplayableSource, match="private"):
+        direct.fetch_url_synchronously("http://intranet.example.com/song.mp3")
+
+
+class RedirectHandler(BaseHTTPRequestHandler):
+    def do_GET(self: RedirectHandler) -> None:
+        self.send_response(302)
+        self.send_header("Location", "http://169.254.169.254/song.opus")
+        self.end_headers()
+
+    def log_message(self: RedirectHandler, *_: object) -> None:
+        pass
+
+
+def test_redirects_to_private_addresses_are_refused() -> None:
+    server = ThreadingHTTPServer(("127.0.0.1", 0), RedirectHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    host, port = server.server_address[:2]
+
+    with pytest.raises(direct.UnplayableSource, match="private"):
+        direct.RangedHTTPStream(f"http://{host}:{port}/song.opus")
+    server.shutdown()
+
+
+def test_unreachable_urls_are_unplayable() -> None:
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        port = probe.getsockname()[1]
+
+    # nothing is listening there anymore
+    with pytest.raises(direct.UnplayableSource, match="Couldn't download"):
+        direct.RangedHTTPStream(f"http://127.0.0.1:{port}/song.opus")
+
+
+def test_describe() -> None:
+    info = {
+        "format": {"format_name": "ogg", "duration": "61.5", "tags": {}},
+        "streams": [
+            {"codec_name": "opus", "tags": {"TITLE": "Song", "ARTIST": "Artist"}},
+        ],
+    }
+    description = direct.describe(info, fallback_title="file name")
+    assert description == direct.Description("Song", "Artist", "", 61.5, True)
+
+    info = {"format": {"format_name": "mp3"}, "streams": [{"codec_name": "mp3"}]}
+    description = direct.describe(info, fallback_title="file name")
+    assert description == direct.Description(
+        "file name",
+        "Unknown artist",
+        "",
+        0.0,
+        False,
+    )
+
+
+def test_search_library(monkeypatch: pytest.MonkeyPatch) -> None:
+    entries = [
+        direct.LibraryEntry("Blue", "B Band", "Colors", 60, False, "b/blue.mp3", 1, 0),
+        direct.LibraryEntry("Red", "A Band", "Colors", 60, True, "a/red.opus", 1, 0),
+        direct.LibraryEntry("Green", "C Band", "Plants", 60, False, "green.mp3", 1, 0),
+    ]
+    monkeypatch.setattr(direct, "_index", {entry.path: entry for entry in entries})
+    monkeypatch.setattr(direct, "music_library_directory", None)
+
+    assert [entry.title for entry in direct.search_library("colors")] == ["Red", "Blue"]
+    assert [entry.title for entry in direct.search_library("band GREEN")] == ["Green"]
+    assert direct.search_library("purple") == []
@@ -0,0 +1,106 @@
+from __future__ import annotations
+
+import sys
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+repository_directory = Path(__file__).parent.parent.parent
+sys.path.insert(0, str(repository_directory))
+
+from abilities.music.streaming import effects  # noqa
+from abilities.music.streaming.common import (  # noqa
+    OPUS_CHANNELS,
+    OPUS_FRAME_SIZE,
+    BufferedOpusAudioSource,
+)
+from abilities.music.streaming.effects import (  # noqa
+    Effect,
+    EffectsChain,
+    EffectSettings,
+    Equalizer,
+    Speed,
+)
+
+SILENCE_PACKET = b"\xfc\xff\xfe"
+
+
+def blocks_of(signal: np.ndarray) -> list[np.ndarray]:
+    return [
+        signal[start : start + OPUS_FRAME_SIZE]
+        for start in range(0, len(signal), OPUS_FRAME_SIZE)
+    ]
+
+
+def test_effects_must_process() -> None:
+    with pytest.raises(TypeError):
+        Effect()  # type: ignore[abstract]
+
+
+def test_equalizer_state_carries_across_blocks() -> None:
+    sections = [
+        Equalizer.low_shelf(120, 6),
+        Equalizer.peaking(1000, -3),
+        Equalizer.high_shelf(6000, 4),
+    ]
+    signal = np.random.default_rng(0).uniform(-1, 1, (5 * OPUS_FRAME_SIZE, 2))
+
+    in_one_go = Equalizer(sections).process(signal)
+    equalizer = Equalizer(sections)
+    in_blocks = np.concatenate([equalizer.process(b) for b in blocks_of(signal)])
+    np.testing.assert_allclose(in_blocks, in_one_go, atol=1e-9)
+
+
+@pytest.mark.parametrize("factor", [0.5, 0.75, 1.5, 2.0])
+def test_speed_is_continuous_across_blocks(factor: float) -> None:
+    # a ramp of sample indices, so every output sample is its input position
+    length = 5 * OPUS_FRAME_SIZE
+    signal = np.repeat(np.arange(length, dtype=float)[:, np.newaxis], 2, axis=1)
+
+    speed = Speed(factor)
+    output = np.concatenate([speed.process(b) for b in blocks_of(signal)])
+    expected = np.arange(0, length - 1, factor)
+    np.testing.assert_allclose(output[:, 0], expected, atol=1e-9)
+    np.testing.assert_allclose(output[:, 1], expected, atol=1e-9)
+
+
+def test_no_effects_means_no_chain() -> None:
+    assert not EffectSettings().enabled
+    assert EffectSettings().build_chain() is None
+    assert EffectSettings(speed=1.5).build_chain() is not None
+
+    # so packets pass through untouched
+    source = BufferedOpusAudioSource(iter([b"\xfc\x01\x02", b"\xfc\x03\x04"]))
+    source.effects = EffectSettings().build_chain()
+    assert source.read() == b"\xfc\x01\x02"
+    assert source.read() == b"\xfc\x03\x04"
+    assert source.read() == b""
+
+
+def test_chain_is_bypassed_when_over_budget(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(effects, "CPU_BUDGET", -1)
+    chain = EffectsChain([Speed(2.0)])
+    pcm = bytes(OPUS_FRAME_SIZE * OPUS_CHANNELS * 2)
+
+    for _ in range(effects.CONSECUTIVE_OVERRUNS):
+        chain.feed(pcm)
+    assert chain.bypassed_blocks == effects.BYPASS_BLOCKS
+
+    # played as is, at normal speed
+    pending = len(chain.pending)
+    chain.feed(pcm)
+    assert len(chain.pending) == pending + OPUS_FRAME_SIZE
+
+
+def test_leftover_audio_is_played_at_the_end() -> None:
+    # 3 frames slowed down to 4 (less the one sample Speed holds back)
+    source = BufferedOpusAudioSource(iter([SILENCE_PACKET] * 3))
+    source.effects = EffectSettings(speed=0.75).build_chain()
+
+    packets = []
+    while packet := source.read():
+        packets.append(packet)
+
+    assert len(packets) == 4
+    assert source.ended
@@ -0,0 +1,80 @@
+from __future__ import annotations
+
+import sys
+from pathlib import Path
+
+import pytest
+
+repository_directory = Path(__file__).parent.parent.parent
+sys.path.insert(0, str(repository_directory))
+
+from abilities.music.streaming import encoder_settings  # noqa
+from abilities.music.streaming.encoder_settings import (  # noqa
+    LEVELS,
+    PACKETS_BETWEEN_CHANGES,
+    AdaptiveEncoderSettings,
+    streams_per_level,
+)
+
+FRAME_DURATION = 0.02
+
+
+def record_for_a_while(
+    settings: AdaptiveEncoderSettings,
+    processing_time: float,
+) -> list[encoder_settings.EncoderLevel]:
+    changes = []
+    for _ in range(PACKETS_BETWEEN_CHANGES):
+        if level := settings.record(processing_time):
+            changes.append(level)
+
+    return changes
+
+
+def test_record_steps_down_and_back_up(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(encoder_settings, "host_load", lambda: 0.0)
+    settings = AdaptiveEncoderSettings(FRAME_DURATION)
+    settings.start()
+    at_top = streams_per_level.value("0")
+
+    # using the whole frame to process each packet
+    assert record_for_a_while(settings, FRAME_DURATION) == [LEVELS[1]]
+    assert record_for_a_while(settings, FRAME_DURATION) == [LEVELS[2]]
+    assert streams_per_level.value("0") == at_top - 1
+    assert streams_per_level.value("2") >= 1
+
+    # calm again, first while the average catches up, then a level at a time
+    changes = []
+    for _ in range(4):
+        changes += record_for_a_while(settings, 0.0)
+    assert changes == [LEVELS[1], LEVELS[0]]
+    assert streams_per_level.value("0") == at_top
+
+    settings.close()
+    settings.close()
+    assert streams_per_level.value("0") == at_top - 1
+
+
+def test_host_load_steps_down(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(encoder_settings, "host_load", lambda: 1.0)
+    settings = AdaptiveEncoderSettings(FRAME_DURATION)
+    assert record_for_a_while(settings, 0.0) == [LEVELS[1]]
+    settings.close()
+
+
+def test_only_counted_once_encoding() -> None:
+    before = streams_per_level.value("0")
+    settings = AdaptiveEncoderSettings(FRAME_DURATION)
+    assert streams_per_level.value("0") == before
+
+    settings.start()
+    settings.start()
+    assert streams_per_level.value("0") == before + 1
+
+    settings.close()
+    settings.start()
+    assert streams_per_level.value("0") == before
+
+    # never started, so never counted
+    AdaptiveEncoderSettings(FRAME_DURATION).close()
+    assert streams_per_level.value("0") == before
@@ -0,0 +1,72 @@
+from __future__ import annotations
+
+import io
+import sys
+import threading
+from pathlib import Path
+
+import pytest
+
+repository_directory = Path(__file__).parent.parent.parent
+sys.path.insert(0, str(repository_directory))
+
+from abilities.music.streaming import loudness  # noqa
+
+EBUR128_SUMMARY = b"""[info] Stream mapping:
+[info]   Stream #0:0 -> #0:0 (aac (native) -> opus (libopus))
+[Parsed_ebur128_0 @ 0x5581] [info] Summary:
+[info]
+[info]   Integrated loudness:
+[info]     I:          -9.5 LUFS
+[info]     Threshold: -19.7 LUFS
+"""
+
+
+@pytest.fixture(autouse=True)
+def loudness_index(monkeypatch: pytest.MonkeyPatch, tmp_path: Path) -> Path:
+    index_file = tmp_path / "loudness_index.json"
+    monkeypatch.setattr(loudness, "LOUDNESS_INDEX_FILE", index_file)
+    monkeypatch.setattr(loudness, "_index", None)
+    return index_file
+
+
+def wait_for_measurement() -> None:
+    for thread in threading.enumerate():
+        if thread.name.startswith("loudness:"):
+            thread.join()
+
+
+def test_measure_in_background(loudness_index: Path) -> None:
+    loudness.measure_in_background("dQw4w9WgXcQ", io.BytesIO(EBUR128_SUMMARY))
+    wait_for_measurement()
+
+    assert loudness.measured_loudness("dQw4w9WgXcQ") == -9.5
+    assert loudness.normalization_gain("dQw4w9WgXcQ") == loudness.loudness_target + 9.5
+
+    # persisted for the next run
+    loudness._index = None
+    assert loudness.measured_loudness("dQw4w9WgXcQ") == -9.5
+
+
+def test_interrupted_measurement_is_not_recorded() -> None:
+    loudness.measure_in_background(
+        "dQw4w9WgXcQ",
+        io.BytesIO(b"[info] Stream mapping:\n"),
+    )
+    wait_for_measurement()
+
+    assert loudness.measured_loudness("dQw4w9WgXcQ") is None
+    assert loudness.normalization_gain("dQw4w9WgXcQ") == 0
+
+
+@pytest.mark.parametrize(
+    ("measured", "expected_gain"),
+    [
+        (loudness.loudness_target, 0),
+        (-70.0, loudness.MAXIMUM_BOOST),
+        (10.0, -loudness.MAXIMUM_CUT),
+    ],
+)
+def test_normalization_gain_is_clamped(measured: float, expected_gain: float) -> None:
+    loudness.record_loudness("dQw4w9WgXcQ", measured)
+    assert loudness.normalization_gain("dQw4w9WgXcQ") == expected_gain
@@ -0,0 +1,102 @@
+from __future__ import annotations
+
+import asyncio
+import sys
+from pathlib import Path
+from types import SimpleNamespace
+
+import discord
+import pytest
+
+repository_directory = Path(__file__).parent.parent.parent
+sys.path.insert(0, str(repository_directory))
+
+from abilities.music import notifications  # noqa
+from abilities.music.notifications import Destination, Notification, Notifier  # noqa
+
+
+class StandInWebhook:
+    def __init__(self: StandInWebhook, token: str, expired: bool = False) -> None:
+        self.token = token
+        self.expired = expired
+        self.sent: list[discord.Embed] = []
+
+    async def send(self: StandInWebhook, embed: discord.Embed) -> None:
+        if self.expired:
+            response = SimpleNamespace(status=401, reason="Unauthorized")
+            raise discord.HTTPException(response, {"code": 50027, "message": ""})  # type: ignore[arg-type]
+
+        self.sent.append(embed)
+
+
+class StandInChannel:
+    def __init__(self: StandInChannel) -> None:
+        self.sent: list[discord.Embed] = []
+
+    async def send(self: StandInChannel, embed: discord.Embed) -> None:
+        self.sent.append(embed)
+
+
+@pytest.fixture(autouse=True)
+def short_coalesce_window(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(notifications, "COALESCE_WINDOW", 0.01)
+
+
+def queued(destination: Destination, title: str) -> Notification:
+    song = SimpleNamespace(title=title, artist="Artist", url="")
+    embed = discord.Embed(title=f"Added to Queue: {title}")
+    embed.add_field(name="Duration", value="3:00")
+    embed.add_field(name="Requested By", value="@someone")
+    return Notification(destination, embed, queued_song=song)  # type: ignore[arg-type]
+
+
+def test_bursts_are_summarized() -> None:
+    playmany = StandInWebhook("playmany")
+    play = StandInWebhook("play")
+
+    async def main() -> None:
+        notifier = Notifier()
+        for title in ("a", "b", "c"):
+            notifier.notify(queued(Destination(playmany), title))  # type: ignore[arg-type]
+        # a different interaction needs its own message
+        notifier.notify(queued(Destination(play), "d"))  # type: ignore[arg-type]
+
+        assert notifier._dispatcher
+        await notifier._dispatcher
+
+    asyncio.run(main())
+    [summary] = playmany.sent
+    assert summary.title == "Added to Queue: 3 Songs"
+    assert summary.description == "1. a by Artist\n2. b by Artist\n3. c by Artist"
+    assert [(f.name, f.value) for f in summary.fields] == [("Requested By", "@someone")]
+    assert [embed.title for embed in play.sent] == ["Added to Queue: d"]
+
+
+def test_expired_webhooks_fall_back_to_the_channel() -> None:
+    expired = StandInWebhook("expired", expired=True)
+    old = StandInWebhook("old")
+    channel = StandInChannel()
+    sent: list[str] = []
+
+    async def main() -> None:
+        notifier = Notifier()
+        for webhook, title in ((expired, "a"), (expired, "b"), (old, "c")):
+            destination = Destination(webhook, channel)  # type: ignore[arg-type]
+            if webhook is old:
+                destination.expires_at = 0
+
+            notifier.notify(
+                Notification(
+                    destination,
+                    discord.Embed(title=title),
+                    on_sent=lambda title=title: sent.append(title),
+                ),
+            )
+
+        assert notifier._dispatcher
+        await notifier._dispatcher
+
+    asyncio.run(main())
+    assert [embed.title for embed in channel.sent] == ["a", "b", "c"]
+    assert not old.sent
+    assert sent == ["a", "b", "c"]
@@ -0,0 +1,82 @@
+from __future__ import annotations
+
+import io
+import struct
+import sys
+from pathlib import Path
+
+import pytest
+
+repository_directory = Path(__file__).parent.parent.parent
+sys.path.insert(0, str(repository_directory))
+
+from abilities.music.streaming.ogg import OggError, OggPacketReader  # noqa
+from discord.oggparse import OggStream  # noqa
+
+PACKETS = [
+    b"OpusHead\x01\x028\x01\x80\xbb\x00\x00\x00\x00\x00",
+    b"",
+    b"\xfc\xff\xfe",
+    bytes(range(255)),  # exactly one full segment, terminated by a 0 lacing value
+    bytes(256),
+    bytes(range(256)) * 4,  # spans several segments
+    b"\xfc" * 3000,
+]
+
+
+def ogg_pages(packets: list[bytes], segments_per_page: int) -> bytes:
+    """
+    Lays `packets` out into pages of at most `segments_per_page` segments,
+    so that small values force packets to continue onto the next page.
+    """
+    segments: list[bytes] = []
+    for packet in packets:
+        segments += [packet[i : i + 255] for i in range(0, len(packet) - 254, 255)]
+        segments.append(packet[len(packet) - len(packet) % 255 :])
+
+    pages = b""
+    for sequence, start in enumerate(range(0, len(segments), segments_per_page)):
+        page_segments = segments[start : start + segments_per_page]
+        pages += struct.pack(
+            "<4sBBqIIIB",
+            b"OggS",
+            0,
+            0,
+            0,
+            1,
+            sequence,
+            0,
+            len(page_segments),
+        )
+        pages += bytes(len(segment) for segment in page_segments)
+        pages += b"".join(page_segments)
+
+    return pages
+
+
+@pytest.mark.parametrize("segments_per_page", [1, 2, 5, 255])
+@pytest.mark.parametrize("read_size", [1, 100, 64 * 1024])
+def test_iter_packets(segments_per_page: int, read_size: int) -> None:
+    data = ogg_pages(PACKETS, segments_per_page)
+    reader = OggPacketReader(io.BytesIO(data), read_size=read_size)
+
+    packets = list(reader.iter_packets())
+
+    assert packets == PACKETS, "Packets should survive being split across pages"
+    assert packets == list(
+        OggStream(io.BytesIO(data)).iter_packets(),
+    ), "Packets should match discord.py's OggStream"
+
+
+def test_truncated_stream() -> None:
+    data = ogg_pages(PACKETS, 255)
+    reader = OggPacketReader(io.BytesIO(data[:-10]))
+
+    assert list(reader.iter_packets()) == [], "A partial page should not be parsed"
+
+
+def test_invalid_capture_pattern() -> None:
+    reader = OggPacketReader(io.BytesIO(b"RIFF" + bytes(100)))
+
+    with pytest.raises(OggError):
+        list(reader.iter_packets())
@@ -0,0 +1,72 @@
+from __future__ import annotations
+
+import gc
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+repository_directory = Path(__file__).parent.parent.parent
+sys.path.insert(0, str(repository_directory))
+
+from abilities.music.streaming import processes  # noqa
+
+SLEEP = [sys.executable, "-c", "import time; time.sleep(60)"]
+
+
+def wait_until_reaped(process: subprocess.Popen) -> None:
+    deadline = time.monotonic() + 5
+    while time.monotonic() < deadline:
+        processes.reap()
+        tracked_processes = [
+            tracked.process for tracked in processes.tracked_processes()
+        ]
+        if process not in tracked_processes:
+            return
+        time.sleep(0.01)
+
+    msg = "The process was never reaped."
+    raise AssertionError(msg)
+
+
+def test_release_and_reap() -> None:
+    process = processes.spawn(SLEEP, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    assert any(tracked.process is process for tracked in processes.tracked_processes())
+
+    processes.release(process)
+    wait_until_reaped(process)
+
+    assert process.returncode is not None
+    assert process.stdout and process.stdout.closed
+    assert process.stderr and process.stderr.closed
+
+
+def test_unreleased_processes_are_not_reaped() -> None:
+    process = processes.spawn(
+        [sys.executable, "-c", "print('still unread')"],
+        stdout=subprocess.PIPE,
+    )
+    process.wait()
+
+    processes.reap()
+    assert any(tracked.process is process for tracked in processes.tracked_processes())
+    assert process.stdout and process.stdout.read() == b"still unread\n"
+
+    processes.release(process)
+    wait_until_reaped(process)
+
+
+def test_leaked_processes_are_released() -> None:
+    class Owner:
+        pass
+
+    owner = Owner()
+    process = processes.spawn(SLEEP)
+    processes.release_with(owner, [process])
+    leaked_before = processes.leaked_counter.value()
+
+    del owner
+    gc.collect()
+
+    assert processes.leaked_counter.value() == leaked_before + 1
+    wait_until_reaped(process)
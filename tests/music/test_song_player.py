@@ -0,0 +1,274 @@
+from __future__ import annotations
+
+import asyncio
+import sys
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Callable
+
+import pytest
+
+repository_directory = Path(__file__).parent.parent.parent
+sys.path.insert(0, str(repository_directory))
+
+from abilities.music import song_player as song_player_module  # noqa
+from abilities.music.song_player import QueuedSong, SongPlayer  # noqa
+from abilities.music.streaming.common import BufferedOpusAudioSource  # noqa
+
+
+def test_idle_players_are_evicted(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(song_player_module, "IDLE_PLAYER_LIFETIME", 0)
+    monkeypatch.setattr(SongPlayer, "song_player_by_guild", {})
+
+    guild = SimpleNamespace(id=1, voice_client=None)
+
+    async def main() -> None:
+        # never connected, like a `/play` that failed
+        idle = SongPlayer.get_or_create(guild)  # type: ignore[arg-type]
+        busy = SongPlayer.get_or_create(SimpleNamespace(id=2, voice_client=None))  # type: ignore[arg-type]
+        busy.queued_songs.append(SimpleNamespace())  # type: ignore[arg-type]
+        await asyncio.sleep(0.01)
+
+        assert SongPlayer.song_player_by_guild == {2: busy}
+        assert SongPlayer.get_or_create(guild) is not idle  # type: ignore[arg-type]
+
+        # still checked on while it's queued without connecting
+        busy.queued_songs.clear()
+        await asyncio.sleep(0.01)
+        assert 2 not in SongPlayer.song_player_by_guild
+
+    asyncio.run(main())
+
+
+class StandInVoiceClient:
+    def __init__(self: StandInVoiceClient, loop: asyncio.AbstractEventLoop) -> None:
+        self.loop = loop
+        self.channel = SimpleNamespace(members=[SimpleNamespace(id=2)])
+        self.sources: list[BufferedOpusAudioSource] = []
+        self.after: Callable[[BaseException | None], None] | None = None
+        self.paused = False
+
+    def play(
+        self: StandInVoiceClient,
+        source: BufferedOpusAudioSource,
+        after: Callable[[BaseException | None], None],
+    ) -> None:
+        self.sources.append(source)
+        self.after = after
+
+    def is_playing(self: StandInVoiceClient) -> bool:
+        return False
+
+    def is_paused(self: StandInVoiceClient) -> bool:
+        return self.paused
+
+    def pause(self: StandInVoiceClient) -> None:
+        self.paused = True
+
+    def resume(self: StandInVoiceClient) -> None:
+        self.paused = False
+
+    def is_connected(self: StandInVoiceClient) -> bool:
+        return True
+
+
+def test_songs_resume_after_the_connection_drops(
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    resumed_before = song_player_module.reconnect_counter.value("resumed")
+    song = SimpleNamespace(stream=BufferedOpusAudioSource(iter([b"first", b"second"])))
+    song_player = SongPlayer(SimpleNamespace(id=1, me=SimpleNamespace(id=1)))  # type: ignore[arg-type]
+    song_player.queued_songs.append(
+        QueuedSong(song, requested_by=None, followups=None, started=True),  # type: ignore[arg-type]
+    )
+
+    async def main() -> StandInVoiceClient:
+        voice_client = StandInVoiceClient(asyncio.get_running_loop())
+        monkeypatch.setattr(SongPlayer, "voice_client", voice_client)
+        song_player._play_recursively(voice_client)  # type: ignore[arg-type]
+        assert song.stream.read() == b"first"
+
+        # discord.py's player gives up on the connection from its own thread
+        assert voice_client.after
+        await asyncio.to_thread(voice_client.after, None)
+        await asyncio.sleep(0.01)
+        return voice_client
+
+    voice_client = asyncio.run(main())
+    assert voice_client.sources == [song.stream, song.stream]
+    assert song_player.currently_playing
+    assert not song_player.currently_playing.interrupted
+    assert song_player_module.reconnect_counter.value("resumed") == resumed_before + 1
+
+    # the packet that was never sent is played again
+    assert song.stream.read() == b"first"
+    assert song.stream.read() == b"second"
+
+
+def make_playing_song_player(
+    monkeypatch: pytest.MonkeyPatch,
+    loop: asyncio.AbstractEventLoop,
+) -> tuple[SongPlayer, StandInVoiceClient]:
+    song = SimpleNamespace(stream=BufferedOpusAudioSource(iter([b"packet"])))
+    song_player = SongPlayer(SimpleNamespace(id=1, me=SimpleNamespace(id=1)))  # type: ignore[arg-type]
+    song_player.queued_songs.append(
+        QueuedSong(song, requested_by=None, followups=None, started=True),  # type: ignore[arg-type]
+    )
+
+    voice_client = StandInVoiceClient(loop)
+    monkeypatch.setattr(SongPlayer, "voice_client", voice_client)
+    song_player._play_recursively(voice_client)  # type: ignore[arg-type]
+    monkeypatch.setattr(voice_client, "is_playing", lambda: not voice_client.paused)
+    return song_player, voice_client
+
+
+def test_pause_and_resume(monkeypatch: pytest.MonkeyPatch) -> None:
+    async def main() -> None:
+        loop = asyncio.get_running_loop()
+        song_player, voice_client = make_playing_song_player(monkeypatch, loop)
+
+        assert song_player.pause()
+        assert voice_client.paused
+        assert not song_player.pause()
+
+        # queueing more songs doesn't start playing over the paused one
+        song_player._play_recursively(voice_client)  # type: ignore[arg-type]
+        assert len(voice_client.sources) == 1
+
+        assert song_player.resume()
+        assert not voice_client.paused
+        assert not song_player.resume()
+
+    asyncio.run(main())
+
+
+def test_empty_channels_pause_until_someone_is_back(
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    monkeypatch.setattr(song_player_module, "empty_channel_grace_period", 0)
+    monkeypatch.setattr(song_player_module, "empty_channel_pause_limit", 60)
+
+    async def main() -> None:
+        loop = asyncio.get_running_loop()
+        song_player, voice_client = make_playing_song_player(monkeypatch, loop)
+
+        song_player.listener_count = 0
+        song_player._schedule_empty_channel_check()
+        await asyncio.sleep(0.01)
+        assert song_player.auto_paused
+        assert voice_client.paused
+        assert song_player.currently_playing
+
+        song_player.listener_count = 1
+        song_player._schedule_empty_channel_check()
+        assert not song_player.paused
+        assert not voice_client.paused
+
+    asyncio.run(main())
+
+
+def test_voice_connections_linger_after_the_queue_runs_out(
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    monkeypatch.setattr(song_player_module, "voice_linger_period", 0.05)
+    disconnects: list[float] = []
+
+    async def main() -> None:
+        loop = asyncio.get_running_loop()
+        song_player, voice_client = make_playing_song_player(monkeypatch, loop)
+
+        async def disconnect() -> None:
+            disconnects.append(loop.time())
+
+        monkeypatch.setattr(voice_client, "disconnect", disconnect, raising=False)
+
+        # the song plays to the end, leaving the queue empty
+        stream = voice_client.sources[0]
+        while stream.read():
+            pass
+        monkeypatch.setattr(voice_client, "is_playing", lambda: False)
+        assert voice_client.after
+        voice_client.after(None)
+        ended_at = loop.time()
+
+        await asyncio.sleep(0.01)
+        assert song_player._linger_task
+        assert not disconnects
+
+        await song_player._linger_task
+        assert disconnects
+        assert disconnects[0] - ended_at >= 0.05
+
+    asyncio.run(main())
+
+
+def test_stop_disconnects_straight_away(monkeypatch: pytest.MonkeyPatch) -> None:
+    async def main() -> None:
+        loop = asyncio.get_running_loop()
+        song_player, voice_client = make_playing_song_player(monkeypatch, loop)
+        disconnects: list[bool] = []
+
+        async def disconnect() -> None:
+            disconnects.append(True)
+
+        def stop() -> None:
+            assert voice_client.after
+            voice_client.after(None)
+
+        monkeypatch.setattr(voice_client, "disconnect", disconnect, raising=False)
+        monkeypatch.setattr(voice_client, "stop", stop, raising=False)
+        monkeypatch.setattr(voice_client, "is_playing", lambda: False)
+
+        await song_player.stop()
+        assert not song_player.queued_songs
+        assert disconnects == [True]
+
+    asyncio.run(main())
+
+
+def test_songs_queued_while_disconnecting_reconnect(
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    monkeypatch.setattr(song_player_module, "voice_linger_period", 0)
+
+    async def main() -> None:
+        loop = asyncio.get_running_loop()
+        song_player = SongPlayer(SimpleNamespace(id=1, me=SimpleNamespace(id=1)))  # type: ignore[arg-type]
+        monkeypatch.setattr(song_player, "_announce", lambda *_: None)
+        old_voice_client = StandInVoiceClient(loop)
+        monkeypatch.setattr(SongPlayer, "voice_client", old_voice_client)
+        events: list[str] = []
+
+        async def disconnect() -> None:
+            events.append("disconnecting")
+            await asyncio.sleep(0.05)
+            monkeypatch.setattr(SongPlayer, "voice_client", None)
+            events.append("disconnected")
+
+        new_voice_client = StandInVoiceClient(loop)
+
+        async def connect() -> None:
+            events.append("connected")
+            monkeypatch.setattr(SongPlayer, "voice_client", new_voice_client)
+
+        monkeypatch.setattr(old_voice_client, "disconnect", disconnect, raising=False)
+        channel = SimpleNamespace(guild=song_player.guild, connect=connect)
+
+        # the queue ran out a while ago, and the linger period is over
+        song_player._schedule_linger()
+        linger_task = song_player._linger_task
+        await asyncio.sleep(0.01)
+        assert events == ["disconnecting"]
+        song_player._schedule_linger()
+        assert song_player._linger_task is linger_task
+
+        song = SimpleNamespace(stream=BufferedOpusAudioSource(iter([b"packet"])))
+        await song_player.play_or_queue(song, channel, None, None)  # type: ignore[arg-type]
+
+        # plays on a new connection, instead of the one that was closing
+        assert events == ["disconnecting", "disconnected", "connected"]
+        assert new_voice_client.sources == [song.stream]
+        assert not old_voice_client.sources
+        assert not song_player._linger_task
+
+    asyncio.run(main())
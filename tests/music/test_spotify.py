@@ -0,0 +1,278 @@
+from __future__ import annotations
+
+import asyncio
+import sys
+import time
+from pathlib import Path
+from typing import Awaitable, Callable
+
+import pytest
+from aiohttp import web
+
+repository_directory = Path(__file__).parent.parent.parent
+sys.path.insert(0, str(repository_directory))
+
+from abilities.music.streaming import spotify  # noqa
+from abilities.music.streaming.spotify import (  # noqa
+    Priority,
+    RateLimited,
+    RateLimiter,
+    SpotifyClient,
+    SpotifyError,
+    retry_after,
+)
+
+
+def test_waiting_requests_are_served_by_priority() -> None:
+    served: list[str] = []
+
+    async def make_request(limiter: RateLimiter, priority: Priority, name: str) -> None:
+        await limiter.acquire(priority)
+        served.append(name)
+
+    async def main() -> None:
+        limiter = RateLimiter(rate=100, burst=1)
+        await limiter.acquire(Priority.PLAYBACK)  # empty the bucket
+
+        await asyncio.gather(
+            make_request(limiter, Priority.AUTOCOMPLETE, "autocomplete 1"),
+            make_request(limiter, Priority.IMPORT, "import"),
+            make_request(limiter, Priority.AUTOCOMPLETE, "autocomplete 2"),
+            make_request(limiter, Priority.PLAYBACK, "playback"),
+        )
+
+    asyncio.run(main())
+    assert served == ["playback", "import", "autocomplete 1", "autocomplete 2"]
+
+
+def test_back_off() -> None:
+    async def main() -> float:
+        limiter = RateLimiter(rate=100, burst=10)
+        limiter.back_off(0.2)
+
+        with pytest.raises(RateLimited):
+            await limiter.acquire(Priority.AUTOCOMPLETE, maximum_wait=0.1)
+
+        started_at = time.monotonic()
+        await limiter.acquire(Priority.PLAYBACK)
+        return time.monotonic() - started_at
+
+    assert asyncio.run(main()) >= 0.15
+
+
+@pytest.mark.parametrize(
+    ("error", "expected"),
+    [
+        (SpotifyError(429, "Too Many Requests", {"Retry-After": "7"}), 7.0),
+        (SpotifyError(429, "Too Many Requests"), 1.0),
+        (SpotifyError(429, "Too Many Requests", {"Retry-After": "soon"}), 1.0),
+        (SpotifyError(404, "Not Found", {"Retry-After": "7"}), None),
+    ],
+)
+def test_retry_after(error: SpotifyError, expected: float | None) -> None:
+    assert retry_after(error) == expected
+
+
+ALBUM = {
+    "images": [{"height": 64, "url": "small.jpg"}, {"height": 640, "url": "big.jpg"}],
+    "release_date": "2001",
+}
+
+
+def track_dict(track_id: str, album: dict | None = ALBUM) -> dict:
+    return {
+        "id": track_id,
+        "type": "track",
+        "name": f"Song {track_id}",
+        "duration_ms": 180_000,
+        "external_urls": {"spotify": f"https://open.spotify.com/track/{track_id}"},
+        "artists": [
+            {"name": "Artist", "external_urls": {"spotify": "https://artist"}},
+        ],
+        **({"album": album} if album else {}),
+    }
+
+
+class StubSpotify:
+    """
+    Just enough of the Spotify API, served on localhost.
+    """
+
+    def __init__(self: StubSpotify) -> None:
+        self.token_requests = 0
+        self.token_lifetime = 3600
+        self.throttle_next = 0
+        self.requests: list[str] = []
+
+    async def token(self: StubSpotify, request: web.Request) -> web.Response:
+        assert (await request.post())["grant_type"] == "client_credentials"
+        self.token_requests += 1
+        return web.json_response(
+            {
+                "access_token": f"token {self.token_requests}",
+                "expires_in": self.token_lifetime,
+            },
+        )
+
+    async def api(self: StubSpotify, request: web.Request) -> web.Response:
+        assert request.headers["Authorization"].startswith("Bearer token ")
+        self.requests.append(request.path_qs)
+        if self.throttle_next:
+            self.throttle_next -= 1
+            return web.Response(status=429, headers={"Retry-After": "0"})
+
+        path, query = request.path, request.query
+        if path == "/v1/search":
+            return web.json_response(
+                {"tracks": {"items": [track_dict("a"), None, track_dict("b")]}},
+            )
+        if path == "/v1/tracks":
+            ids = query["ids"].split(",")
+            return web.json_response(
+                {"tracks": [track_dict(i) if i != "missing" else None for i in ids]},
+            )
+        if path.startswith("/v1/tracks/"):
+            return web.json_response(track_dict(request.match_info["id"]))
+        if path == "/v1/playlists/p/tracks":
+            if "offset" not in query:
+                return web.json_response(
+                    {
+                        "items": [{"track": track_dict("a")}, {"track": None}],
+                        "next": f"{request.url.with_query(offset=2)}",
+                    },
+                )
+            episode = {**track_dict("e"), "type": "episode"}
+            return web.json_response(
+                {
+                    "items": [{"track": episode}, {"track": track_dict("b")}],
+                    "next": None,
+                },
+            )
+        if path == "/v1/albums/al":
+            return web.json_response(
+                {
+                    **ALBUM,
+                    "tracks": {
+                        "items": [
+                            track_dict("a", album=None),
+                            track_dict("b", album=None),
+                        ],
+                        "next": None,
+                    },
+                },
+            )
+
+        raise web.HTTPNotFound
+
+
+def run_against_stub(
+    test: Callable[[SpotifyClient, StubSpotify], Awaitable[None]],
+) -> StubSpotify:
+    stub = StubSpotify()
+
+    async def main() -> None:
+        app = web.Application()
+        app.router.add_post("/api/token", stub.token)
+        app.router.add_get("/v1/tracks/{id}", stub.api)
+        app.router.add_get("/v1/{path:.*}", stub.api)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        host, port = runner.addresses[0][:2]
+
+        client = SpotifyClient(
+            "id",
+            "secret",
+            api_url=f"http://{host}:{port}/v1",
+            token_url=f"http://{host}:{port}/api/token",
+            rate_limiter=RateLimiter(rate=1000, burst=1000),
+        )
+        try:
+            await test(client, stub)
+        finally:
+            await client.close()
+            await runner.cleanup()
+
+    asyncio.run(main())
+    return stub
+
+
+def test_endpoints_are_parsed_into_track_metadata() -> None:
+    async def test(client: SpotifyClient, _: StubSpotify) -> None:
+        tracks = await client.search("song")
+        assert [track.track_id for track in tracks] == ["a", "b"]
+        assert tracks[0].youtube_search_term == '"Song a" by Artist'
+        assert tracks[0].image_url == "big.jpg"
+
+        track = await client.track("c")
+        assert track.url == "https://open.spotify.com/track/c"
+
+        playlist = await client.playlist("p")
+        assert [track.track_id for track in playlist] == ["a", "b"]
+
+        album = await client.album("al")
+        assert [track.track_id for track in album] == ["a", "b"]
+        assert album[0].released_at == 978307200  # 2001-01-01
+
+    stub = run_against_stub(test)
+    assert stub.token_requests == 1  # reused across requests
+
+
+def test_tracks_are_batched(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(spotify, "TRACKS_PER_REQUEST", 2)
+
+    async def test(client: SpotifyClient, _: StubSpotify) -> None:
+        tracks = await client.tracks(["a", "missing", "b", "c", "d"])
+        assert [track.track_id for track in tracks] == ["a", "b", "c", "d"]
+
+    stub = run_against_stub(test)
+    assert len(stub.requests) == 3
+
+
+def test_tokens_are_refreshed_before_they_expire() -> None:
+    async def test(client: SpotifyClient, stub: StubSpotify) -> None:
+        stub.token_lifetime = spotify.TOKEN_REFRESH_MARGIN + 1
+        await client.track("a")
+        assert stub.token_requests == 1
+
+        # inside the margin, the old token is still used while a new one is fetched
+        stub.token_lifetime = 3600
+        client._token_expires_at = time.monotonic() + 10
+        await client.track("a")
+        await asyncio.sleep(0.1)
+        assert stub.token_requests == 2
+        assert await client.access_token() == "token 2"
+
+    run_against_stub(test)
+
+
+def test_throttled_requests_are_retried() -> None:
+    async def test(client: SpotifyClient, stub: StubSpotify) -> None:
+        stub.throttle_next = 1
+        assert (await client.track("a")).track_id == "a"
+
+        stub.throttle_next = spotify.MAXIMUM_RETRIES + 1
+        with pytest.raises(SpotifyError) as error:
+            await client.track("a")
+        assert error.value.http_status == 429
+
+    run_against_stub(test)
+
+
+def test_shared_client_is_closed_on_shutdown() -> None:
+    spotify.get_spotify_client.cache_clear()
+
+    async def main() -> None:
+        # never used, so there's nothing to close
+        await spotify.close_spotify_client()
+        assert spotify.get_spotify_client.cache_info().currsize == 0
+
+        session = spotify.get_spotify_client().session
+        await spotify.close_spotify_client()
+        assert session.closed
+
+    try:
+        asyncio.run(main())
+    finally:
+        spotify.get_spotify_client.cache_clear()
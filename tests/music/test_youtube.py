@@ -0,0 +1,234 @@
+from __future__ import annotations
+
+import io
+import struct
+import sys
+import time
+from pathlib import Path
+
+import pytest
+
+repository_directory = Path(__file__).parent.parent.parent
+sys.path.insert(0, str(repository_directory))
+
+from abilities.music.streaming import broadcast, youtube  # noqa
+from abilities.music.streaming.broadcast import (  # noqa
+    Broadcast,
+    BroadcastAudioSource,
+)
+
+
+def make_extraction(
+    video_id: str,
+    duration: float,
+    expires_in: float,
+) -> youtube.Extraction:
+    expires_at = time.time() + expires_in
+    return youtube.Extraction(
+        video_id,
+        "title",
+        "thumbnail",
+        "20240101",
+        str(duration),
+        "0",
+        "uploader",
+        "https://example.com/channel",
+        "0",
+        stream_url=f"https://example.com/videoplayback?expire={expires_at:.0f}",
+        http_headers={},
+        expires_at=expires_at,
+    )
+
+
+@pytest.fixture(autouse=True)
+def extractions(monkeypatch: pytest.MonkeyPatch) -> dict[str, youtube.Extraction]:
+    cache: dict[str, youtube.Extraction] = {}
+    monkeypatch.setattr(youtube, "extractions", cache)
+    monkeypatch.setattr(youtube, "stream_url_is_live", lambda _: True)
+    return cache
+
+
+def test_stream_url_expiry() -> None:
+    assert (
+        youtube.stream_url_expiry("https://example.com/a?b=c&expire=1700000000")
+        == 1700000000
+    )
+
+    # missing or garbled, assume it lasts the default lifetime
+    for stream_url in ("https://example.com/a", "https://example.com/a?expire=soon"):
+        expires_in = youtube.stream_url_expiry(stream_url) - time.time()
+        assert expires_in == pytest.approx(youtube.DEFAULT_STREAM_URL_LIFETIME, abs=5)
+
+
+def test_cached_extraction(extractions: dict[str, youtube.Extraction]) -> None:
+    extractions["fresh"] = make_extraction("fresh", 60, 60 * 60)
+    assert youtube.cached_extraction("fresh") is extractions["fresh"]
+    assert youtube.cached_extraction("missing") is None
+
+
+def test_stream_urls_that_expire_during_the_song_are_dropped(
+    extractions: dict[str, youtube.Extraction],
+) -> None:
+    extractions["long"] = make_extraction("long", 60 * 60, 30 * 60)
+    assert youtube.cached_extraction("long") is None
+    assert "long" not in extractions
+
+
+def test_revoked_stream_urls_are_dropped(
+    monkeypatch: pytest.MonkeyPatch,
+    extractions: dict[str, youtube.Extraction],
+) -> None:
+    monkeypatch.setattr(youtube, "stream_url_is_live", lambda _: False)
+    extractions["revoked"] = make_extraction("revoked", 60, 60 * 60)
+    expired_before = youtube.stream_url_cache_counter.value("expired")
+
+    assert youtube.cached_extraction("revoked") is None
+    assert youtube.stream_url_cache_counter.value("expired") == expired_before + 1
+
+
+@pytest.fixture
+def search_index(monkeypatch: pytest.MonkeyPatch, tmp_path: Path) -> Path:
+    index_file = tmp_path / "youtube_search_index.json"
+    monkeypatch.setattr(youtube, "SEARCH_INDEX_FILE", index_file)
+    monkeypatch.setattr(youtube, "_search_index", None)
+    return index_file
+
+
+def test_search_results_are_remembered(
+    monkeypatch: pytest.MonkeyPatch,
+    search_index: Path,
+) -> None:
+    assert youtube.cached_search("Some Song") is None
+
+    youtube.record_search("Some Song", "dQw4w9WgXcQ")
+    assert youtube.cached_search("  some   song ") == "dQw4w9WgXcQ"
+
+    # and survive restarts
+    monkeypatch.setattr(youtube, "_search_index", None)
+    assert search_index.exists()
+    assert youtube.cached_search("some song") == "dQw4w9WgXcQ"
+
+    youtube.record_search("some song", None)
+    assert youtube.cached_search("some song") is None
+
+
+def test_search_results_expire(
+    monkeypatch: pytest.MonkeyPatch,
+    search_index: Path,
+) -> None:
+    youtube.record_search("old song", "dQw4w9WgXcQ")
+
+    later = time.time() + youtube.SEARCH_RESULT_LIFETIME + 1
+    monkeypatch.setattr(youtube.time, "time", lambda: later)
+    assert youtube.cached_search("old song") is None
+
+
+def test_extraction_error_reason() -> None:
+    errors = (
+        b"WARNING: [youtube] Falling back to generic n function search\n"
+        b"ERROR: [youtube] dQw4w9WgXcQ: Video unavailable\n"
+    )
+    assert youtube.extraction_error_reason(errors) == "Video unavailable"
+    assert youtube.extraction_error_reason(b"ERROR: Unable to download\n") == (
+        "Unable to download"
+    )
+    assert youtube.extraction_error_reason(b"") is None
+
+
+def test_choose_candidate() -> None:
+    candidates = [
+        youtube.Candidate("ten hours", 10 * 60 * 60),
+        youtube.Candidate("live", None),
+        youtube.Candidate("music video", 250),
+        youtube.Candidate("audio", 212),
+    ]
+    # the best ranked one that's close enough
+    assert youtube.choose_candidate(candidates, 210).video_id == "audio"
+    assert youtube.choose_candidate(candidates, 240).video_id == "music video"
+    # or else the closest
+    assert youtube.choose_candidate(candidates, 500).video_id == "music video"
+
+    assert youtube.choose_candidate(candidates[1:2], 210).video_id == "live"
+    assert youtube.choose_candidate([], 210) is None
+
+
+def make_live_song(video_id: str, stream: io.BytesIO | None = None) -> youtube.Song:
+    shared = Broadcast(stream or io.BytesIO())
+    return youtube.Song(
+        video_id,
+        "artist",
+        "https://example.com/artist",
+        f"https://youtu.be/{video_id}",
+        "https://example.com/image",
+        200,
+        shared.source(),
+        video_id,
+        0,
+        0,
+        0,
+    )
+
+
+def test_find_live_song(monkeypatch: pytest.MonkeyPatch) -> None:
+    first = make_live_song("aaaaaaaaaaa")
+    second = make_live_song("bbbbbbbbbbb")
+    monkeypatch.setattr(
+        youtube,
+        "live_songs",
+        {"first song": first, "aaaaaaaaaaa": first, "second song": second},
+    )
+
+    # each key finds its own song, sharing that song's pipeline
+    for key, live_song in (
+        ("first song", first),
+        ("aaaaaaaaaaa", first),
+        ("second song", second),
+    ):
+        found = youtube.find_live_song(key)
+        assert found
+        assert found.title == live_song.title
+        assert isinstance(found.stream, BroadcastAudioSource)
+        assert found.stream.broadcast is live_song.stream.broadcast
+        assert found.stream is not live_song.stream
+        found.stream.cleanup()
+
+    assert youtube.find_live_song("third song") is None
+
+    # songs whose pipelines have closed are forgotten
+    second.stream.cleanup()
+    assert youtube.find_live_song("second song") is None
+    assert "second song" not in youtube.live_songs
+    first.stream.cleanup()
+
+
+def ogg_stream(packet_count: int) -> io.BytesIO:
+    """
+    One (single byte) packet per page.
+    """
+    pages = b""
+    for sequence in range(packet_count):
+        pages += struct.pack("<4sBBqIIIB", b"OggS", 0, 0, 0, 1, sequence, 0, 1)
+        pages += b"\x01\x00"
+
+    return io.BytesIO(pages)
+
+
+def test_trimmed_live_songs_are_not_shared(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(broadcast, "HISTORY_LIMIT", 10)
+    monkeypatch.setattr(broadcast, "TRIM_INTERVAL", 5)
+
+    live_song = make_live_song("aaaaaaaaaaa", ogg_stream(100))
+    monkeypatch.setattr(youtube, "live_songs", {"aaaaaaaaaaa": live_song})
+    for _ in range(50):
+        next(live_song.stream.packets_iterator)
+    assert live_song.stream.broadcast.first_index > 0
+
+    # rather than starting mid-song
+    assert youtube.find_live_song("aaaaaaaaaaa") is None
+    assert live_song.stream.broadcast.subscriber_count == 1
+    live_song.stream.cleanup()
+
+
+def test_private_urls_are_not_given_to_yt_dlp() -> None:
+    with pytest.raises(youtube.ExtractionError, match="private"):
+        youtube.extract("http://192.168.1.1/admin")
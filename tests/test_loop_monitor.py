@@ -0,0 +1,63 @@
+from __future__ import annotations
+
+import asyncio
+import sys
+import threading
+import time
+from pathlib import Path
+
+repository_directory = Path(__file__).parent.parent
+sys.path.insert(0, str(repository_directory))
+
+from loop_monitor import LoopMonitor, lag_histogram  # noqa
+
+
+def block_the_loop() -> None:
+    time.sleep(0.2)
+
+
+def test_blocking_calls_are_caught() -> None:
+    monitor = LoopMonitor(sample_interval=0.01, slow_callback_threshold=0.05)
+    observed_before = lag_histogram.count
+
+    async def main() -> None:
+        monitor.start(asyncio.get_running_loop())
+        await asyncio.sleep(0.05)
+        block_the_loop()
+        await asyncio.sleep(0.05)
+        monitor.stop()
+
+    asyncio.run(main())
+    assert lag_histogram.count > observed_before
+    assert any(slow.duration >= 0.1 for slow in monitor.slow_callbacks)
+    assert any("block_the_loop" in slow.stack for slow in monitor.slow_callbacks)
+
+
+def test_restarting_leaves_one_watcher() -> None:
+    monitor = LoopMonitor(sample_interval=0.01, slow_callback_threshold=0.02)
+
+    async def main() -> None:
+        loop = asyncio.get_running_loop()
+        monitor.start(loop)
+        first_thread = monitor._thread
+        assert first_thread
+        await asyncio.sleep(0.05)
+
+        def restart() -> None:
+            time.sleep(0.1)  # until the watcher is waiting on the blocked loop
+            monitor.stop()
+            monitor.start(loop)
+
+        restarter = threading.Thread(target=restart)
+        restarter.start()
+        time.sleep(0.2)  # block the loop
+        restarter.join()
+
+        # the first watcher exits, even though the monitor was started again
+        await asyncio.to_thread(first_thread.join, 1)
+        assert not first_thread.is_alive()
+        assert monitor.running
+        monitor.stop()
+        assert not monitor.running
+
+    asyncio.run(main())
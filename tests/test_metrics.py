@@ -0,0 +1,61 @@
+from __future__ import annotations
+
+import socket
+import sys
+from pathlib import Path
+from urllib.request import urlopen
+
+repository_directory = Path(__file__).parent.parent
+sys.path.insert(0, str(repository_directory))
+
+import metrics  # noqa
+from metrics_exporter import MetricsExporter  # noqa
+
+
+def test_render_prometheus() -> None:
+    counter = metrics.counter("test_requests_total", "Requests.", label_name="result")
+    counter.inc(label="hit")
+    counter.inc(2, label='a "quoted" label')
+    histogram = metrics.histogram("test_latency_seconds", "Latency.")
+    for value in (1, 2, 3):
+        histogram.observe(value)
+
+    gauge = metrics.gauge("test_scraped", "Set by a scrape callback.")
+
+    def scrape() -> None:
+        gauge.set(7)
+
+    metrics.scrape_callbacks.append(scrape)
+    try:
+        lines = metrics.render_prometheus().splitlines()
+    finally:
+        metrics.scrape_callbacks.remove(scrape)
+
+    assert "# TYPE test_requests_total counter" in lines
+    assert 'test_requests_total{result="hit"} 1' in lines
+    assert 'test_requests_total{result="a \\"quoted\\" label"} 2' in lines
+    assert "# TYPE test_latency_seconds summary" in lines
+    assert 'test_latency_seconds{quantile="0.5"} 2' in lines
+    assert "test_latency_seconds_sum 6.0" in lines
+    assert "test_latency_seconds_count 3" in lines
+    assert "test_scraped 7" in lines
+
+
+def test_exporter_serves_metrics() -> None:
+    metrics.counter("test_exported_total", "Exported.").inc()
+    exporter = MetricsExporter()
+    exporter.start(0)
+    assert not exporter.running
+
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        port = probe.getsockname()[1]
+
+    exporter.start(port)
+    try:
+        with urlopen(f"http://127.0.0.1:{port}/metrics", timeout=5) as response:
+            content_type = response.headers["Content-Type"]
+            assert content_type.startswith("text/plain; version=0.0.4")
+            assert "test_exported_total 1" in response.read().decode().splitlines()
+    finally:
+        exporter.stop()
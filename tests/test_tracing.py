@@ -0,0 +1,87 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import sys
+import time
+from pathlib import Path
+
+import pytest
+
+repository_directory = Path(__file__).parent.parent
+sys.path.insert(0, str(repository_directory))
+
+import tracing  # noqa
+from tracing import current_trace, span, start_trace  # noqa
+
+
+def test_spans_follow_the_trace_into_threads() -> None:
+    def resolve() -> None:
+        with span("resolve"):
+            time.sleep(0.01)
+
+    async def command() -> tracing.Trace:
+        trace = start_trace("test_command")
+        with span("defer"):
+            await asyncio.sleep(0)
+        await asyncio.to_thread(resolve)
+        return trace
+
+    async def untraced() -> None:
+        # each task has its own trace, or none
+        assert current_trace.get() is None
+        with span("ignored"):
+            pass
+
+    async def main() -> tracing.Trace:
+        trace, _ = await asyncio.gather(command(), untraced())
+        return trace
+
+    trace = asyncio.run(main())
+    assert [s.name for s in trace.spans] == ["defer", "resolve"]
+    assert trace.spans[1].duration >= 0.01
+
+
+def test_finish_counts_once_by_outcome() -> None:
+    counter = tracing.outcome_counter("test_outcomes")
+
+    succeeded = tracing.Trace("test_outcomes")
+    succeeded.finish()
+    succeeded.finish("error")
+    assert succeeded.outcome == "ok"
+    assert [s.name for s in succeeded.spans] == ["total"]
+    assert succeeded in tracing.recent_traces
+
+    failed = tracing.Trace("test_outcomes")
+    failed.finish("unplayable")
+    # failures don't skew the total
+    assert failed.spans == []
+
+    assert counter.value("ok") == 1
+    assert counter.value("unplayable") == 1
+    assert counter.value("error") == 0
+
+
+def test_stage_percentiles() -> None:
+    trace = tracing.Trace("test_percentiles")
+    for milliseconds in range(1, 101):
+        trace.add("fetch", 0, milliseconds / 1000)
+    trace.add("connect", 0, 0.5)
+
+    summaries = tracing.stage_summaries("test_percentiles")
+    assert set(summaries) == {"fetch", "connect"}
+    assert summaries["fetch"] == {"p50": 0.051, "p90": 0.091, "p99": 0.1}
+    assert summaries["connect"]["p99"] == 0.5
+    assert tracing.stage_summaries("never traced") == {}
+
+
+def test_export_chrome_trace() -> None:
+    trace = tracing.Trace("test_export")
+    trace.add("fetch", trace.started_at, trace.started_at + 0.25)
+    trace.finish("unplayable")
+
+    events = json.loads(tracing.export_chrome_trace([trace]))["traceEvents"]
+    assert events[0]["args"]["name"] == f"test_export #{trace.id} (unplayable)"
+    assert events[1]["name"] == "fetch"
+    assert events[1]["dur"] == pytest.approx(250_000)
+    assert events[1]["tid"] == trace.id
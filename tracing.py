@@ -0,0 +1,167 @@
+"""
+Lightweight request tracing, for finding out where `/play` spends its time.
+
+A trace is started per command and carried through `await`s (and into
+`asyncio.to_thread`) by a context variable, so each stage only needs to wrap
+itself in `span(...)`. Code that runs on other threads later, such as the
+audio player, records spans on the `Trace` object directly.
+
+Every span is also observed by a per-stage histogram, every finished trace is
+counted by outcome (only successful ones contribute a "total" stage, so that
+commands which fail early don't skew it), and recent traces can be exported in
+Chrome's trace event format (open them in https://ui.perfetto.dev).
+"""
+
+from __future__ import annotations
+
+import itertools
+import json
+import re
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Iterator
+
+import metrics
+
+RECENT_TRACES = 200
+
+_trace_ids = itertools.count(1)
+
+
+@dataclass
+class Span:
+    name: str
+    started_at: float  # time.perf_counter()
+    duration: float  # seconds
+
+
+@dataclass
+class Trace:
+    name: str
+    id: int = field(default_factory=lambda: next(_trace_ids))
+    started_at: float = field(default_factory=time.perf_counter)
+    spans: list[Span] = field(default_factory=list)
+    finished: bool = False
+    outcome: str | None = None
+
+    def add(self: Trace, name: str, started_at: float, ended_at: float) -> None:
+        duration = ended_at - started_at
+        self.spans.append(Span(name, started_at, duration))
+        stage_histogram(self.name, name).observe(duration)
+
+    def finish(self: Trace, outcome: str = "ok") -> None:
+        """
+        Records how the trace ended and, if it succeeded, the total time since
+        it started. Only the first call counts.
+        """
+        with _recent_traces_lock:
+            if self.finished:
+                return
+
+            self.finished = True
+            self.outcome = outcome
+            recent_traces.append(self)
+
+        outcome_counter(self.name).inc(label=outcome)
+        if outcome == "ok":
+            self.add("total", self.started_at, time.perf_counter())
+
+
+current_trace: ContextVar[Trace | None] = ContextVar("current_trace", default=None)
+recent_traces: deque[Trace] = deque(maxlen=RECENT_TRACES)
+_recent_traces_lock = threading.Lock()
+
+
+# {trace name: {stage: histogram}}
+_stage_histograms: dict[str, dict[str, metrics.Histogram]] = {}
+
+
+def stage_histogram(trace_name: str, stage: str) -> metrics.Histogram:
+    histograms = _stage_histograms.setdefault(trace_name, {})
+    if stage not in histograms:
+        slug = re.sub(r"\W+", "_", stage.lower())
+        histograms[stage] = metrics.histogram(
+            f"{trace_name}_stage_seconds_{slug}",
+            f"Time spent in the {stage!r} stage of {trace_name!r}.",
+        )
+
+    return histograms[stage]
+
+
+def outcome_counter(trace_name: str) -> metrics.Counter:
+    return metrics.counter(
+        f"{trace_name}_traces_total",
+        f"Finished {trace_name!r} traces, by outcome.",
+        label_name="outcome",
+    )
+
+
+def start_trace(name: str) -> Trace:
+    """
+    Starts a trace for the current task (and anything it awaits).
+    """
+    trace = Trace(name)
+    current_trace.set(trace)
+    return trace
+
+
+@contextmanager
+def span(name: str) -> Iterator[None]:
+    """
+    Times the enclosed block as a stage of the current trace, if there is one.
+    """
+    trace = current_trace.get()
+    if trace is None:
+        yield
+        return
+
+    started_at = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.add(name, started_at, time.perf_counter())
+
+
+def stage_summaries(trace_name: str) -> dict[str, dict[str, float]]:
+    """
+    Percentiles of every stage that has been recorded for `trace_name`.
+    """
+    return {
+        stage: histogram.summary()
+        for stage, histogram in _stage_histograms.get(trace_name, {}).items()
+    }
+
+
+def export_chrome_trace(traces: list[Trace]) -> str:
+    """
+    Each trace is drawn as its own row, with its spans nested by time.
+    """
+    events = []
+    for trace in traces:
+        outcome = "" if trace.outcome in (None, "ok") else f" ({trace.outcome})"
+        events.append(
+            {
+                "name": "thread_name",
+                "ph": "M",
+                "pid": 1,
+                "tid": trace.id,
+                "args": {"name": f"{trace.name} #{trace.id}{outcome}"},
+            },
+        )
+        events.extend(
+            {
+                "name": span.name,
+                "ph": "X",
+                "pid": 1,
+                "tid": trace.id,
+                "ts": span.started_at * 1_000_000,
+                "dur": span.duration * 1_000_000,
+            }
+            for span in sorted(trace.spans, key=lambda span: -span.duration)
+        )
+
+    return json.dumps({"traceEvents": events, "displayTimeUnit": "ms"})